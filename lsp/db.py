@@ -4,3 +4,17 @@ class DB:
 
     def complete(*args):
         return []
+
+    def didClose(self, uri):
+        pass
+
+    def didChangeWatchedFiles(self, params):
+        pass
+
+    def get_line(self, uri, n):
+        """Line n of the document at uri, which isn't open, or None"""
+        return None
+
+    def get_stats(self):
+        """Returns a dict with statistics for the $/lua/stats request"""
+        return {}
@@ -326,6 +326,32 @@ class DidCloseTextDocumentParams:
         return DidCloseTextDocumentParams(textDocument)
 
 
+class FileChangeType:
+    Created = 1
+    Changed = 2
+    Deleted = 3
+
+
+class FileEvent:
+    def __init__(self, uri, type):
+        self.uri = uri
+        self.type = type
+
+    @staticmethod
+    def fromDict(d):
+        return FileEvent(d["uri"], d["type"])
+
+
+class DidChangeWatchedFilesParams:
+    def __init__(self, changes):
+        self.changes = changes
+
+    @staticmethod
+    def fromDict(d):
+        changes = [FileEvent.fromDict(c) for c in d["changes"]]
+        return DidChangeWatchedFilesParams(changes)
+
+
 class InitializeResult:
     def __init__(self, capabilities, serverInfo):
         assert isinstance(capabilities, dict)  # TODO: Hack for now
@@ -437,6 +463,24 @@ class Hover:
         return d
 
 
+class ErrorCodes:
+    """Error codes for ResponseError (subset)"""
+    ParseError = -32700
+    InvalidRequest = -32600
+    MethodNotFound = -32601
+    InvalidParams = -32602
+    InternalError = -32603
+
+    # The client has canceled a request and a server has detected
+    # the cancel.
+    RequestCancelled = -32800
+
+    # The server detected that the content of a document got
+    # modified outside normal conditions, e.g. the result of a
+    # request was computed for an outdated document version.
+    ContentModified = -32801
+
+
 class ResponseError:
     def __init__(self, code, message):
         self.code = code
@@ -447,9 +491,26 @@ class ResponseError:
 
 
 class CompletionItem:
-    def __init__(self, label: str, kind: CompletionItemKind = None):
+    def __init__(
+            self,
+            label: str,
+            kind: CompletionItemKind = None,
+            sortText: str = None):
         self.label = label
         self.kind = kind
+        self.sortText = sortText
+
+    def toDict(self):
+        return make_dict(label=self.label, kind=self.kind,
+                         sortText=self.sortText)
+
+
+class CompletionList:
+    def __init__(self, isIncomplete: bool, items):
+        self.isIncomplete = isIncomplete
+        self.items = items
 
     def toDict(self):
-        return make_dict(label=self.label, kind=self.kind)
+        return {
+            "isIncomplete": self.isIncomplete,
+            "items": make_dicts(self.items)}
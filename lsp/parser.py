@@ -1,48 +1,140 @@
+import os
 import sys
 import json
 
 from . util import parse_header, header_end
 
+# Number of bytes requested per read from the underlying stream
+CHUNK_SIZE = 65536
+
+
+def fd_read_f(fd, chunk_size=CHUNK_SIZE):
+    """Returns a function that reads a block of at most chunk_size bytes
+    from the file descriptor fd.
+
+    """
+    def read():
+        return os.read(fd, chunk_size)
+    return read
+
+
+def stream_read_f(stream, chunk_size=CHUNK_SIZE):
+    """Returns a function that reads a block of at most chunk_size bytes
+    from a binary stream, without waiting for more data than is
+    available (if the stream supports read1).
+
+    """
+    read1 = getattr(stream, "read1", None)
+    if read1 is not None:
+        return lambda: read1(chunk_size)
+    return lambda: stream.read(chunk_size)
+
+
+class FrameReader:
+    """Splits a byte stream into LSP messages (header + content).
+
+    Reads large blocks using read_f into a buffer that is reused
+    between messages, so that a burst of messages that arrive in a
+    single read are framed without further reads.
+
+    """
+    def __init__(self, read_f):
+        self.read_f = read_f
+        self.buffer = bytearray()
+        self.pos = 0  # Start of the first unconsumed byte in buffer
+        self.eof = False
+
+    def feed(self, data):
+        if self.pos != 0 and self.pos >= len(self.buffer) // 2:
+            # Compact, instead of letting the buffer grow with
+            # consumed messages
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer += data
+
+    def _fill(self):
+        data = self.read_f()
+        if len(data) == 0:
+            self.eof = True
+            return False
+        self.feed(data)
+        return True
+
+    def next_buffered(self):
+        """Returns (header, content) for the next complete message in the
+        buffer, or None if more data must be read first.
+
+        """
+        header_stop = self.buffer.find(header_end, self.pos)
+        if header_stop == -1:
+            return None
+
+        header = parse_header(bytes(self.buffer[self.pos:header_stop + 2]))
+        content_start = header_stop + len(header_end)
+        content_stop = content_start + int(header[b"Content-Length"])
+        if content_stop > len(self.buffer):
+            return None
+
+        content = bytes(self.buffer[content_start:content_stop])
+        self.pos = content_stop
+        return header, content
+
+    def read(self):
+        """Returns (header, content) for the next message, reading from the
+        stream as required, or None at end of stream.
+
+        """
+        while True:
+            message = self.next_buffered()
+            if message is not None:
+                return message
+            if not self._fill():
+                return None
+
+    def __iter__(self):
+        while True:
+            message = self.read()
+            if message is None:
+                return
+            yield message
+
 
 class Parser:
     """Parses LSP header and content."""
     def __init__(self, log):
         self.content = []
         self.log = log.prefixed("[Parser]")
+        self.readers = {}
 
     def _quit(self, msg):
         self.log.info(f"Quitting: {msg}")
         exit(1)
 
-    def _read_header(self, stream):
-        content = []
-        while True:
-            # Read the header character-by-character
-            data = stream.read(1)
-            if len(data) == 0:
-                self._quit("Handle closed")
-
-            content.append(data)
-            if data == b"\n":
-                if content[-4:] == header_end:
-                    return parse_header(b"".join(content[:-2]))
-
-    def _read_content(self, length):
-        raw_content = sys.stdin.buffer.read(length)
-        return json.loads(raw_content.decode("utf-8"))
+    def _reader(self, stream, read_f):
+        reader = self.readers.get(id(stream))
+        if reader is None:
+            reader = FrameReader(read_f)
+            self.readers[id(stream)] = reader
+        return reader
+
+    def _read_message(self, reader):
+        message = reader.read()
+        if message is None:
+            self._quit("Handle closed")
+        return message
 
     def read(self):
-        header = self._read_header(sys.stdin.buffer)
+        stdin = sys.stdin.buffer
+        reader = self._reader(stdin, fd_read_f(stdin.fileno()))
+        header, raw_content = self._read_message(reader)
         self.log.info(f"Header: {str(header)}")
-        length = int(header[b"Content-Length"])
-        self.log.info(f"Length: {length}")
-        content = self._read_content(length)
+        self.log.info(f"Length: {len(raw_content)}")
+        content = json.loads(raw_content.decode("utf-8"))
         assert(type(content) == dict)
         self.log.info(str(content))
         return content
 
     def read_response(self, stream):
-        header = self._read_header(stream)
-        length = int(header[b"Content-Length"])
-        raw_content = stream.read(length)
+        reader = self._reader(stream, stream_read_f(stream))
+        header, raw_content = self._read_message(reader)
         return json.loads(raw_content.decode("utf-8"))
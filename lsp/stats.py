@@ -0,0 +1,80 @@
+"""Measurements of server performance"""
+import math
+
+# Latencies are counted in logarithmic buckets, bucket n holding
+# latencies up to _MIN_LATENCY * _GROWTH ** n seconds. This gives
+# percentiles with at most ~10% error, using constant memory.
+_MIN_LATENCY = 1e-6
+_GROWTH = 1.1
+_LOG_GROWTH = math.log(_GROWTH)
+_NUM_BUCKETS = 200  # Up to ~3.5 minutes
+
+
+def _bucket(seconds):
+    if seconds <= _MIN_LATENCY:
+        return 0
+    n = math.ceil(math.log(seconds / _MIN_LATENCY) / _LOG_GROWTH)
+    return min(n, _NUM_BUCKETS - 1)
+
+
+def _bucket_limit(n):
+    return _MIN_LATENCY * _GROWTH ** n
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * _NUM_BUCKETS
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[_bucket(seconds)] += 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Returns (an upper bound for) the latency in seconds that p
+        percent of the measured latencies do not exceed.
+
+        """
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for n, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return min(_bucket_limit(n), self.max)
+        return self.max
+
+    def toDict(self):
+        """Returns the count, and the percentiles and max in
+        milliseconds.
+
+        """
+        def ms(seconds):
+            return round(seconds * 1000, 3)
+
+        return {
+            "count": self.count,
+            "p50": ms(self.percentile(50)),
+            "p95": ms(self.percentile(95)),
+            "p99": ms(self.percentile(99)),
+            "max": ms(self.max)}
+
+
+class MethodLatencies:
+    """LatencyHistograms per LSP method"""
+    def __init__(self):
+        self.histograms = {}
+
+    def add(self, method, seconds):
+        histogram = self.histograms.get(method)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            self.histograms[method] = histogram
+        histogram.add(seconds)
+
+    def toDict(self):
+        return {method: histogram.toDict()
+                for method, histogram in sorted(self.histograms.items())}
@@ -2,7 +2,7 @@ import json
 from . lsp_defs import ResponseError
 
 
-header_end = [b"\r", b"\n", b"\r", b"\n"]
+header_end = b"\r\n\r\n"
 
 
 def parse_header(b):
@@ -58,6 +58,8 @@ def make_response(request_id, result_or_error):
         data["result"] = None
     elif isinstance(result_or_error, ResponseError):
         data["error"] = result_or_error.toDict()
+    elif isinstance(result_or_error, dict):
+        data["result"] = result_or_error
     elif isinstance(result_or_error, list):
         data["result"] = [item.toDict() for item in result_or_error]
     else:
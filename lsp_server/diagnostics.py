@@ -0,0 +1,158 @@
+import threading
+import time
+
+from lsp.lsp_defs import NotificationMessage, make_dicts
+
+
+class DiagnosticsScheduler:
+    """Publishes textDocument/publishDiagnostics notifications for
+    changed documents.
+
+    The diagnostics are computed on a separate thread, once no
+    document has been scheduled for quiet_period seconds, so that a
+    burst of changes results in a single computation. Publishing is
+    skipped if the diagnostics for a document are the same as when
+    last published.
+
+    The scheduled documents should be snapshots (see
+    Document.snapshot), which stay the same while they are read.
+    Diagnostics for a snapshot older than the one last scheduled for
+    the document are discarded.
+
+    get_params(doc) returns PublishDiagnosticsParams or None and is
+    called while holding lock. publish(message) receives the
+    notification as a dict.
+
+    """
+    def __init__(self, get_params, publish, quiet_period, lock, log):
+        self.get_params = get_params
+        self.publish = publish
+        self.quiet_period = quiet_period
+        self.lock = lock
+        self.log = log.prefixed("[Diagnostics] ")
+
+        # URI to document waiting for the quiet period to pass
+        self.pending = {}
+        self.deadline = None
+
+        # URI to the version last scheduled
+        self.versions = {}
+
+        # URI to the diagnostics (as dicts) last published
+        self.published = {}
+        self.num_published = 0
+        self.num_suppressed = 0
+        self.num_discarded = 0
+
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, doc):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.pending[doc.uri] = doc
+            self.versions[doc.uri] = doc.version
+            self.deadline = time.monotonic() + self.quiet_period
+            self.cond.notify()
+
+    def forget(self, uri):
+        """Drop state for a closed document"""
+        with self.cond:
+            self.pending.pop(uri, None)
+            self.versions.pop(uri, None)
+        with self.lock:
+            self.published.pop(uri, None)
+
+    def flush(self):
+        """Publish for all scheduled documents now, on the calling
+        thread.
+
+        """
+        self._publish_all(self._take_pending())
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def _superseded(self, doc):
+        with self.cond:
+            version = self.versions.get(doc.uri)
+        return version is not None and version > doc.version
+
+    def _take_pending(self):
+        with self.cond:
+            pending = self.pending
+            self.pending = {}
+            return pending
+
+    def _wait_for_quiet(self):
+        """Waits until the quiet period has passed for scheduled
+        documents and returns them, or returns None when stopped.
+
+        """
+        with self.cond:
+            while not self.stopped:
+                if len(self.pending) == 0:
+                    self.cond.wait()
+                    continue
+
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+
+                pending = self.pending
+                self.pending = {}
+                return pending
+            return None
+
+    def _run(self):
+        while True:
+            pending = self._wait_for_quiet()
+            if pending is None:
+                return
+            self._publish_all(pending)
+
+    def _publish_all(self, docs):
+        for doc in docs.values():
+            with self.lock:
+                message = self.message(doc)
+            if message is not None:
+                self.publish(message)
+
+    def message(self, doc):
+        """Returns the publishDiagnostics notification for the doc, or None
+        if there are no diagnostics, they are unchanged since last
+        published, or the doc is superseded by a later version.
+
+        Must be called while holding the lock.
+
+        """
+        if self._superseded(doc):
+            self.num_discarded += 1
+            self.log.info(f"Superseded version {doc.version} of {doc.uri}")
+            return None
+
+        params = self.get_params(doc)
+        # A later version can be scheduled while computing
+        if self._superseded(doc):
+            self.num_discarded += 1
+            return None
+        if params is None:
+            return None
+
+        diagnostics = make_dicts(params.diagnostics)
+        if self.published.get(doc.uri) == diagnostics:
+            self.num_suppressed += 1
+            self.log.info(f"Unchanged diagnostics for {doc.uri}")
+            return None
+
+        self.published[doc.uri] = diagnostics
+        self.num_published += 1
+        return NotificationMessage(
+            "textDocument/publishDiagnostics",
+            params).toDict()
@@ -1,4 +1,10 @@
+from array import array
+import bisect
+import functools
+import itertools
+
 from lsp.log import NullLog
+from lsp.lsp_defs import Position, Range, TextDocumentContentChangeEvent
 
 # TODO: HORRID
 WORD_CHARS = "abcdefghijklmnopqrstuvxyzABCDEFGHIJKLMNOPQRSTUVXYZ0123456789_"
@@ -24,10 +30,234 @@ def word_at(s, at):
     return s[start:end + 1]
 
 
+# Position encodings (the unit of Position.character), in order of
+# preference. With utf-32, the characters are Python string indices, so
+# no conversion is needed.
+POSITION_ENCODINGS = ["utf-32", "utf-16", "utf-8"]
+
+# Used if the client doesn't say
+DEFAULT_POSITION_ENCODING = "utf-16"
+
+
+def choose_position_encoding(client_encodings):
+    """The position encoding to use, given the ones supported by the
+    client (or None).
+
+    """
+    for encoding in POSITION_ENCODINGS:
+        if encoding in (client_encodings or []):
+            return encoding
+    return DEFAULT_POSITION_ENCODING
+
+
+@functools.lru_cache(maxsize=1024)
+def _unit_offsets(line, encoding):
+    """The offset in code units of each character in the line, and of
+    its end.
+
+    """
+    offsets = array('i', [0])
+    n = 0
+    for c in line:
+        n += len(c.encode(encoding)) // (2 if encoding == "utf-16-le" else 1)
+        offsets.append(n)
+    return offsets
+
+
+_CODECS = {"utf-16": "utf-16-le", "utf-8": "utf-8"}
+
+
+def to_units(line, character, encoding):
+    """The column in code units for the character index in line"""
+    if encoding == "utf-32" or line.isascii():
+        return character
+    offsets = _unit_offsets(line, _CODECS[encoding])
+    return offsets[min(character, len(line))]
+
+
+def from_units(line, units, encoding):
+    """The character index in line for the column in code units.
+
+    A column inside a character (e.g. between the surrogates of a
+    UTF-16 pair) gives the start of the character.
+
+    """
+    if encoding == "utf-32" or line.isascii():
+        return units
+    offsets = _unit_offsets(line, _CODECS[encoding])
+    if units >= offsets[-1]:
+        return len(line) + units - offsets[-1]
+    return bisect.bisect_right(offsets, units) - 1
+
+
 def lines_from_text(text):
     return text.split("\n") + [""]
 
 
+class Lines:
+    """The lines of a document, in blocks of about BLOCK_SIZE lines.
+
+    Replacing lines only changes the blocks containing them (and the
+    block start numbers), so edits don't move all the following lines,
+    and lookups are a binary search on the block starts.
+
+    The blocks are shared with copies made by snapshot(), and copied
+    before being changed, so a copy costs a list of block references
+    and an edit after it a copy of one block.
+
+    """
+    BLOCK_SIZE = 512
+
+    def __init__(self, lines):
+        size = self.BLOCK_SIZE
+        self.blocks = [lines[n:n + size] for n in range(0, len(lines), size)]
+        if len(self.blocks) == 0:
+            self.blocks.append([])
+        # Whether each block is used only by this Lines, and so can be
+        # changed in place
+        self.owned = [True] * len(self.blocks)
+        # Number of characters in each block, counting a line break
+        # after each line
+        self.block_chars = [_num_chars(block) for block in self.blocks]
+        self._update_starts(0)
+
+    def _update_starts(self, first_block):
+        """Recompute the start line and offset of the blocks from
+        first_block.
+
+        """
+        if first_block == 0:
+            starts = []
+            offsets = []
+            n = 0
+            offset = 0
+        else:
+            starts = self.starts[:first_block]
+            offsets = self.offsets[:first_block]
+            n = starts[-1] + len(self.blocks[first_block - 1])
+            offset = offsets[-1] + self.block_chars[first_block - 1]
+        for block, num_chars in zip(self.blocks[first_block:],
+                                    self.block_chars[first_block:]):
+            starts.append(n)
+            offsets.append(offset)
+            n += len(block)
+            offset += num_chars
+        self.starts = starts
+        self.offsets = offsets
+        self.num_lines = n
+
+    def snapshot(self):
+        """A copy sharing the blocks, unaffected by later changes"""
+        copy = Lines.__new__(Lines)
+        copy.blocks = list(self.blocks)
+        copy.block_chars = list(self.block_chars)
+        copy.starts = list(self.starts)
+        copy.offsets = list(self.offsets)
+        copy.num_lines = self.num_lines
+        self.owned = [False] * len(self.blocks)
+        copy.owned = list(self.owned)
+        return copy
+
+    def _own(self, b):
+        """Block b, copied first if it is shared"""
+        if not self.owned[b]:
+            self.blocks[b] = list(self.blocks[b])
+            self.owned[b] = True
+        return self.blocks[b]
+
+    def _locate(self, n):
+        """The block containing line n, and the index in the block"""
+        b = bisect.bisect_right(self.starts, n) - 1
+        return b, n - self.starts[b]
+
+    def __len__(self):
+        return self.num_lines
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.num_lines
+        if not 0 <= n < self.num_lines:
+            raise IndexError("line out of range")
+        b, i = self._locate(n)
+        return self.blocks[b][i]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def offset(self, position):
+        """The offset in the text for the Position, which must be within
+        the lines.
+
+        """
+        b, i = self._locate(position.line)
+        block = self.blocks[b]
+        return (self.offsets[b] + _num_chars(block[:i])
+                + min(position.character, len(block[i])))
+
+    def append(self, line):
+        self._own(len(self.blocks) - 1).append(line)
+        self.block_chars[-1] += len(line) + 1
+        self.num_lines += 1
+
+    def replace(self, first, last, new_lines):
+        """Replace the lines first to last (exclusive) with new_lines"""
+        size = self.BLOCK_SIZE
+        b0, i0 = self._locate(first)
+        if last > first:
+            b1, i1 = self._locate(last - 1)
+            i1 += 1
+        else:
+            b1, i1 = b0, i0
+
+        block = self.blocks[b0]
+        num_lines = len(block) - (i1 - i0) + len(new_lines)
+        if b0 == b1 and num_lines <= 2 * size and (
+                num_lines >= size // 2 or len(self.blocks) == 1):
+            # Within a block (e.g. typing)
+            block = self._own(b0)
+            delta = _num_chars(new_lines) - _num_chars(block[i0:i1])
+            block[i0:i1] = new_lines
+            self.block_chars[b0] += delta
+            line_delta = len(new_lines) - (i1 - i0)
+            self.num_lines += line_delta
+            starts = self.starts
+            offsets = self.offsets
+            for b in range(b0 + 1, len(offsets)):
+                starts[b] += line_delta
+                offsets[b] += delta
+            return
+
+        lines = self.blocks[b0][:i0] + new_lines + self.blocks[b1][i1:]
+
+        # Join small blocks with the previous one, so that the number
+        # of blocks stays low
+        if len(lines) < size // 2 and b0 > 0:
+            b0 -= 1
+            lines = self.blocks[b0] + lines
+
+        if len(lines) <= 2 * size:
+            new_blocks = [lines]
+        else:
+            new_blocks = [lines[n:n + size]
+                          for n in range(0, len(lines), size)]
+        if len(new_blocks[0]) == 0 and len(self.blocks) > b1 - b0 + 1:
+            new_blocks = []
+        self.blocks[b0:b1 + 1] = new_blocks
+        self.owned[b0:b1 + 1] = [True] * len(new_blocks)
+        self.block_chars[b0:b1 + 1] = [_num_chars(b) for b in new_blocks]
+        self._update_starts(b0)
+
+    def text(self):
+        return "\n".join("\n".join(block) for block in self.blocks)
+
+
+def _num_chars(lines):
+    return sum(map(len, lines)) + len(lines)
+
+
 def partial_update(lines, rng, text):
     if rng.start.line == len(lines):
         lines.append("")  # TODO: Hack
@@ -40,54 +270,168 @@ def partial_update(lines, rng, text):
     pre = l0[:rng.start.character]
     post = l1[rng.end.character:]
 
-    if len(new_content) == 0:
-        new_content.append([pre + post])
-    else:
-        new_content[0] = pre + new_content[0]
-        new_content[-1] = new_content[-1] + post
+    new_content[0] = pre + new_content[0]
+    new_content[-1] = new_content[-1] + post
+
+    lines.replace(rng.start.line, rng.end.line + 1, new_content)
 
-    del lines[rng.start.line:rng.end.line + 1]
-    for i in range(len(new_content)):
-        lines.insert(rng.start.line + i, new_content[i])
 
+class BaseDocument:
+    """The reading of a document, shared by Document and
+    DocumentSnapshot.
 
-class Document:
-    def __init__(self, uri, text, log=None):
+    encoding is the position encoding used by the client, see
+    from_client and to_client.
+
+    """
+    def __init__(self, uri, lines, version, encoding):
         self.uri = uri
+        self._lines = lines
+        self.version = version
+        self.encoding = encoding
+
+        # The joined lines when last retrieved, and the changes since
+        # then (as offsets in the text)
+        self._text = None
+        self._text_changes = []
+
+    @property
+    def lines(self):
+        return self._lines
+
+    def from_client(self, position):
+        """The Position for a position from the client, with the
+        character as an index in the line.
+
+        """
+        if self.encoding == "utf-32" or position.line >= len(self.lines):
+            return position
+        line = self.lines[position.line]
+        return Position(position.line, from_units(
+            line, position.character, self.encoding))
+
+    def to_client(self, position):
+        """The inverse of from_client"""
+        if self.encoding == "utf-32" or position.line >= len(self.lines):
+            return position
+        line = self.lines[position.line]
+        return Position(position.line, to_units(
+            line, position.character, self.encoding))
+
+    def range_to_client(self, rng):
+        if self.encoding == "utf-32":
+            return rng
+        return Range(self.to_client(rng.start), self.to_client(rng.end))
+
+    def getText(self):
+        if self._text is None:
+            self._text = self.lines.text()
+        elif len(self._text_changes) != 0:
+            text = self._text
+            for start, end, new_text in self._text_changes:
+                text = text[:start] + new_text + text[end:]
+            self._text = text
+        self._text_changes = []
+        return self._text
+
+    def line_n(self, n):
+        return self.lines[n]
+
+    def line_at(self, position):
+        return self.lines[position.line]
+
+    def word_at(self, position):
+        # TODO: Probably Lua-specific
+        ln = self.lines[position.line]
+        return word_at(ln, position.character)
+
+
+class DocumentSnapshot(BaseDocument):
+    """A version of a Document, which doesn't change when the Document
+    does, e.g. for reading it on another thread.
+
+    """
+    def __init__(self, doc):
+        super().__init__(
+            doc.uri, doc.lines.snapshot(), doc.version, doc.encoding)
+        # The text is joined when needed, from the text of the
+        # document if there is one
+        self._text = doc._text
+        self._text_changes = list(doc._text_changes)
+
+
+class Document(BaseDocument):
+    # Changes kept for updating the joined text, before it is instead
+    # joined again
+    MAX_TEXT_CHANGES = 4
+
+    def __init__(self, uri, text, log=None, encoding="utf-32"):
+        super().__init__(uri, None, 0, encoding)
         self.lines = lines_from_text(text)
-        self.version = 0
 
         if log is None:
             log = NullLog()
         self.log = log.prefixed("Doc")
 
+    @property
+    def lines(self):
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        self._lines = Lines(lines)
+        self._text = None
+        self._text_changes = []
+
+    def snapshot(self):
+        """The current version of the document, as a DocumentSnapshot.
+
+        The lines are shared with the document until changed, so this
+        doesn't copy the text.
+
+        """
+        return DocumentSnapshot(self)
+
     def contentChanges(self, changes, version):
+        """Applies the TextDocumentContentChangeEvent:s from the client.
+
+        Returns the changes with the positions converted by from_client.
+
+        """
         # TODO: If no range given, maybe this is OK and document can
         # be initialized?
         # .. no,  lsp-mode is still unsynchronized.
         assert version == self.version + 1, (
             f"Unsynchronized, {version} vs {self.version}")
         self.version = version  # TODO: Change first
+        applied = []
         for ch in changes:
             rng = ch.range
             if rng is None:
                 # Full document change
                 self.log.info("Full document change")
                 self.lines = lines_from_text(ch.text)
-                continue
             else:
+                if self.encoding != "utf-32":
+                    rng = Range(self.from_client(rng.start),
+                                self.from_client(rng.end))
+                    ch = TextDocumentContentChangeEvent(rng, ch.text)
+                self._update_text(rng, ch.text)
                 partial_update(self.lines, rng, ch.text)
+            applied.append(ch)
+        return applied
 
-    def getText(self):
-        return "\n".join(self.lines)
-
-    def line_n(self, n):
-        return self.lines[n]
+    def _update_text(self, rng, text):
+        """Keep the change for updating the joined text, if there is
+        one, which is cheaper than joining the lines again for a few
+        changes.
 
-    def line_at(self, position):
-        return self.lines[position.line]
-
-    def word_at(self, position):
-        # TODO: Probably Lua-specific
-        ln = self.lines[position.line]
-        return word_at(ln, position.character)
+        """
+        if self._text is None:
+            return
+        if (rng.end.line >= len(self.lines)
+                or len(self._text_changes) == self.MAX_TEXT_CHANGES):
+            self._text = None
+            return
+        self._text_changes.append(
+            (self.lines.offset(rng.start), self.lines.offset(rng.end), text))
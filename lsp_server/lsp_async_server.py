@@ -0,0 +1,185 @@
+"""An asyncio-based alternative to lsp_io_server.run.
+
+Messages are read continuously on a separate thread, so that
+$/cancelRequest-notifications are seen while earlier messages are
+still being handled. The messages are handled by LSP_state.method on a
+single worker thread, which keeps the order of all notifications (and
+thereby the per-document ordering) intact.
+
+Queued completion, hover and signatureHelp requests are dropped when
+cancelled, or when a later didChange makes them stale. The result of
+such a request that is already running is discarded.
+
+"""
+import asyncio
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lsp.lsp_defs import ErrorCodes, ResponseError
+from lsp.parser import Parser
+from lsp.util import make_response, send_message
+from lsp_server.lsp_state import LSP_state
+
+# Requests that can be dropped without consequence for the state of
+# the server
+CANCELLABLE = {
+    "textDocument/completion",
+    "textDocument/hover",
+    "textDocument/signatureHelp",
+}
+
+
+class Job:
+    """A received message waiting for, or being, handled"""
+    def __init__(self, content):
+        self.content = content
+        self.method = content.get("method")
+        self.id = content.get("id")
+        params = content.get("params")
+        if isinstance(params, dict) and "textDocument" in params:
+            self.uri = params["textDocument"].get("uri")
+        else:
+            self.uri = None
+
+        # ResponseError to reply with instead of the result, if the
+        # job was cancelled
+        self.cancelled = None
+
+    def cancellable(self):
+        return self.method in CANCELLABLE
+
+
+class AsyncServer:
+    def __init__(self, db, read_message, write, log, diagnostics_delay=0.0):
+        self.read_message = read_message
+        self.write = write
+        self.log = log.prefixed("[AsyncServer] ")
+        self.lsp_state = LSP_state(db, log, self._notify, diagnostics_delay)
+
+        # Request id to queued or running cancellable Job
+        self.pending = {}
+        self.queue = None
+        self.loop = None
+
+        # LSP_state is not thread safe, so everything it does runs on
+        # this single thread.
+        self.worker = ThreadPoolExecutor(max_workers=1)
+
+    def _read_thread(self):
+        while True:
+            try:
+                content = self.read_message()
+            except SystemExit:
+                content = None
+            except Exception as e:
+                # E.g. a malformed message. The input can't be trusted
+                # after that, so it is handled as closed, which ends
+                # serve instead of leaving it waiting.
+                self.log.error(f"Reading a message failed: {e!r}")
+                content = None
+            self.loop.call_soon_threadsafe(self._received, content)
+            if content is None:
+                return
+
+    def _received(self, content):
+        if content is None:
+            self.queue.put_nowait(None)
+            return
+
+        job = Job(content)
+        if job.method == "$/cancelRequest":
+            self._cancel(
+                content["params"]["id"],
+                ResponseError(ErrorCodes.RequestCancelled,
+                              "Request cancelled"))
+            return
+
+        if job.method == "textDocument/didChange":
+            self._drop_stale(job.uri)
+
+        if job.id is not None and job.cancellable():
+            self.pending[job.id] = job
+        self.queue.put_nowait(job)
+
+    def _cancel(self, request_id, error):
+        job = self.pending.get(request_id)
+        if job is not None and job.cancelled is None:
+            self.log.info(f"Cancelling request {request_id}: {job.method}")
+            job.cancelled = error
+
+    def _drop_stale(self, uri):
+        for job in list(self.pending.values()):
+            if job.uri == uri:
+                self._cancel(
+                    job.id,
+                    ResponseError(ErrorCodes.ContentModified,
+                                  "Document changed"))
+
+    def _send(self, response):
+        if response is not None:
+            send_message(self.write, json.dumps(response))
+
+    def _notify(self, message):
+        # Called from other threads
+        try:
+            self.loop.call_soon_threadsafe(self._send, message)
+        except RuntimeError:
+            self.log.info("Notification after event loop closed")
+
+    async def _dispatch(self):
+        while True:
+            job = await self.queue.get()
+            if job is None:
+                self.log.info("Input closed.")
+                return
+
+            if job.cancelled is not None:
+                self.log.info(f"Dropped queued request {job.id}")
+                response = make_response(job.id, job.cancelled)
+            else:
+                response = await self.loop.run_in_executor(
+                    self.worker, self.lsp_state.method, job.content)
+                if job.cancelled is not None:
+                    # Cancelled while running, discard the result
+                    response = make_response(job.id, job.cancelled)
+            self.pending.pop(job.id, None)
+            self._send(response)
+
+            if self.lsp_state.exit:
+                self.log.info(
+                    "State has received exit notification. Exiting.")
+                return
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+        # A daemon thread, since a blocking read can not be
+        # interrupted when exiting.
+        reader = threading.Thread(target=self._read_thread, daemon=True)
+        reader.start()
+        try:
+            await self._dispatch()
+        finally:
+            self.worker.shutdown(wait=True)
+
+
+def run(db, log, diagnostics_delay=0.0):
+
+    def write(message):
+        sys.stdout.buffer.write(message)
+        sys.stdout.flush()
+
+    log.info("--------------------")
+    p = Parser(log)
+    server = AsyncServer(db, p.read, write, log, diagnostics_delay)
+    asyncio.run(server.serve())
+
+    lsp_state = server.lsp_state
+
+    if lsp_state.shutdown and lsp_state.exit:
+        return 0
+    else:
+        return 1
@@ -1,5 +1,6 @@
 import sys
 import json
+import threading
 from pathlib import Path
 
 from lsp.db import DB
@@ -17,14 +18,19 @@ def get_server_log_path():
     return get_top_dir() / "server.log"
 
 
-def run(db, log):
+def run(db, log, diagnostics_delay=0.0):
+    write_lock = threading.Lock()
 
     def write(message):
-        sys.stdout.buffer.write(message)  # TODO: Why did I encode it? :)
-        sys.stdout.flush()
+        with write_lock:
+            sys.stdout.buffer.write(message)  # TODO: Why did I encode it? :)
+            sys.stdout.flush()
+
+    def notify(message):
+        send_message(write, json.dumps(message))
 
     log.info("--------------------")
-    lsp_state = LSP_state(db, log)
+    lsp_state = LSP_state(db, log, notify, diagnostics_delay)
     p = Parser(log)
 
     while True:
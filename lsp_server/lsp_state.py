@@ -1,21 +1,44 @@
+import threading
+import time
+
+from lsp.stats import MethodLatencies
 from lsp.util import make_response
 from lsp.lsp_defs import (
     CompletionParams,
     DefinitionParams,
+    DidChangeWatchedFilesParams,
     DidCloseTextDocumentParams,
     InitializeResult,
-    NotificationMessage,
+    Location,
     Position,
+    Range,
     SignatureHelpParams,
     TextDocumentContentChangeEvent,
     TextDocumentIdentifier,
     TextDocumentPositionParams,
 )
-from . doc import Document
+from . doc import (
+    DEFAULT_POSITION_ENCODING,
+    Document,
+    choose_position_encoding,
+    to_units,
+)
+from . diagnostics import DiagnosticsScheduler
+
+# Custom request for retrieving server statistics, e.g. latencies
+STATS_METHOD = "$/lua/stats"
 
 
 class LSP_state:
-    def __init__(self, db, log):
+    def __init__(self, db, log, notify=None, diagnostics_delay=0.0):
+        """notify, if given, is used for sending notifications outside of
+        responses, which allows publishing diagnostics from a separate
+        thread, diagnostics_delay seconds after the last change.
+
+        Otherwise diagnostics are returned as the response to
+        didOpen/didChange.
+
+        """
         self.log = log.prefixed("[LSP_State] ")
         self.initialized = False
         self.shutdown = False
@@ -23,61 +46,72 @@ class LSP_state:
         self.db = db
         self.didOpen = {}
 
-    def method(self, content):
-        if content["method"] == "initialize":
-            self.log.info("Request: initialize")
-            return self._initialize(content)
-
-        elif content["method"] == "initialized":
-            self.log.info("Notification: initialized")
-            return self._initialized(content)
-
-        elif content["method"] == "textDocument/didOpen":
-            self.log.info("Notification: textDocument/didOpen")
-            return self._textDocument_didOpen(content)
-
-        elif content["method"] == "textDocument/didClose":
-            return self._textDocument_didClose(content)
-
-        elif content["method"] == "textDocument/didChange":
-            self.log.info("Notification: textDocument/didChange")
-            return self._textDocument_didChange(content)
-
-        elif content["method"] == "textDocument/completion":
-            self.log.info("Request: textDocument/completion")
-            return self._textDocument_completion(content)
-
-        elif content["method"] == "textDocument/definition":
-            # The go to definition request is sent from the client to
-            # the server to resolve the definition location of a
-            # symbol at a given text document position.
-            self.log.info("Request: textDocument/definition")
-            return self._textDocument_definition(content)
-
-        elif content["method"] == "textDocument/typeDefinition":
-            self.log.info("Request: textDocument/typeDefinition")
-            return self._textDocument_typeDefinition(content)
-
-        elif content["method"] == "textDocument/signatureHelp":
-            return self._textDocument_signatureHelp(content)
-
-        elif content["method"] == "textDocument/hover":
-            return self._textDocument_hover(content)
+        # The unit for Position.character, negotiated in initialize
+        self.position_encoding = DEFAULT_POSITION_ENCODING
+
+        # Held while handling a message, and by other threads using
+        # the state or db.
+        self.lock = threading.RLock()
+
+        self.notify = notify
+        self.diagnostics = DiagnosticsScheduler(
+            self._get_PublishDiagnosticsParams,
+            notify,
+            diagnostics_delay,
+            self.lock,
+            self.log)
+
+        self.latencies = MethodLatencies()
+        self.handlers = {}
+        for method, handler in (
+                ("initialize", self._initialize),
+                ("initialized", self._initialized),
+                ("shutdown", self._shutdown),
+                ("exit", self._exit),
+                ("$/cancelRequest", self._cancelRequest),
+                (STATS_METHOD, self._stats),
+                ("textDocument/didOpen", self._textDocument_didOpen),
+                ("textDocument/didClose", self._textDocument_didClose),
+                ("textDocument/didChange", self._textDocument_didChange),
+                ("textDocument/completion", self._textDocument_completion),
+                # The go to definition request is sent from the client
+                # to the server to resolve the definition location of
+                # a symbol at a given text document position.
+                ("textDocument/definition", self._textDocument_definition),
+                ("textDocument/typeDefinition",
+                 self._textDocument_typeDefinition),
+                ("textDocument/signatureHelp",
+                 self._textDocument_signatureHelp),
+                ("textDocument/hover", self._textDocument_hover),
+                ("textDocument/documentLink",
+                 self._textDocument_documentLink),
+                ("workspace/didChangeWatchedFiles",
+                 self._workspace_didChangeWatchedFiles)):
+            self.register(method, handler)
+
+    def register(self, method, handler):
+        """Use handler(content) for handling the method"""
+        self.handlers[method] = handler
 
-        elif content["method"] == "shutdown":
-            self.log.info("Request: shutdown")
-            return self._shutdown(content)
-
-        elif content["method"] == "textDocument/documentLink":
-            return self._textDocument_documentLink(content)
+    def method(self, content):
+        with self.lock:
+            return self._method(content)
+
+    def _method(self, content):
+        method = content["method"]
+        handler = self.handlers.get(method)
+        if handler is None:
+            self.log.info(f"unknown request/notification: {method}")
+            return None
 
-        elif content["method"] == "exit":
-            self.log.info("Notification: exit")
-            return self._exit(content)
+        kind = "Request" if "id" in content else "Notification"
+        self.log.info(f"{kind}: {method}")
 
-        else:
-            # TODO: Use presence of id to determine if notification or request
-            self.log.info(f'unknown request/notification: {content["method"]}')
+        start = time.perf_counter()
+        try:
+            return handler(content)
+        finally:
+            self.latencies.add(method, time.perf_counter() - start)
 
     def _initialize(self, content):
         self.log.info("Initializing")
@@ -88,7 +122,14 @@ class LSP_state:
         # .. an initialize request.
         # TODO: Move capabilities to lua_db etc.
 
-        capabilities = self.db.get_capabilities()
+        general = content.get("params", {}).get(
+            "capabilities", {}).get("general", {})
+        self.position_encoding = choose_position_encoding(
+            general.get("positionEncodings"))
+        self.log.info(f"Position encoding: {self.position_encoding}")
+
+        capabilities = dict(self.db.get_capabilities())
+        capabilities["positionEncoding"] = self.position_encoding
         return make_response(content["id"], InitializeResult(
             capabilities=capabilities,
             serverInfo={
@@ -98,6 +139,7 @@ class LSP_state:
     def _shutdown(self, content):
         self.log.info("Shutting down")
         self.shutdown = True
+        self.diagnostics.stop()
         return make_response(content["id"], None)
 
     def _initialized(self, content):
@@ -111,6 +153,20 @@ class LSP_state:
         self.exit = True
         return None
 
+    def _cancelRequest(self, content):
+        # Requests are handled in order, so there's nothing left to
+        # cancel when this is reached.
+        return None
+
+    def _stats(self, content):
+        return make_response(content["id"], {
+            "methods": self.latencies.toDict(),
+            "diagnostics": {
+                "published": self.diagnostics.num_published,
+                "suppressed": self.diagnostics.num_suppressed,
+                "discarded": self.diagnostics.num_discarded},
+            "db": self.db.get_stats()})
+
     def _textDocument_completion(self, content):
         self.log.info(str(content))
         p = CompletionParams.fromDict(content["params"])
@@ -120,7 +176,8 @@ class LSP_state:
         if p.textDocument.uri in self.didOpen:  # TODO: Shouldn't be required
             doc = self.didOpen[p.textDocument.uri]
             try:
-                completions = self.db.completions(doc, p.position)
+                completions = self.db.completions(
+                    doc, doc.from_client(p.position))
             except IndexError as e:
                 self.log.error(f"Completion failed with IndexError: {e}")
                 completions = []
@@ -135,12 +192,13 @@ class LSP_state:
         if p.textDocument.uri in self.didOpen:  # TODO: Shouldn't be required
             doc = self.didOpen[p.textDocument.uri]
             try:
-                location = self.db.definition(doc, p.position)
+                location = self.db.definition(
+                    doc, doc.from_client(p.position))
             except IndexError:
                 # TODO: Return what
                 return make_response(content["id"], None)
 
-        return make_response(content["id"], location)
+        return make_response(content["id"], self._location(location))
 
     def _textDocument_typeDefinition(self, content):
         self.log.info(content)
@@ -151,8 +209,8 @@ class LSP_state:
 
         # TODO: Should work also for unopened docs
         doc = self.didOpen[textDocument.uri]
-        location = self.db.typeDefinition(doc, position)
-        return make_response(id_, location)
+        location = self.db.typeDefinition(doc, doc.from_client(position))
+        return make_response(id_, self._location(location))
 
     def _textDocument_didOpen(self, content):
         # TODO:
@@ -172,21 +230,18 @@ class LSP_state:
         uri = content["params"]["textDocument"]["uri"]
         self.log.info(f"textDocument/didOpen: {uri}")
         text = content["params"]["textDocument"]["text"]
-        doc = Document(uri, text, self.log)
+        doc = Document(uri, text, self.log, self.position_encoding)
         self.didOpen[uri] = doc
         self.db.didOpen(doc)
-
-        # TODO: Only if client has
-        # PublishDiagnosticsClientCapabilities
-        msg_diag = self._get_diagnostics_notification(doc)
-        if msg_diag is not None:
-            return msg_diag.toDict()
+        return self._publish_diagnostics(doc)
 
     def _textDocument_didClose(self, content):
         p = DidCloseTextDocumentParams.fromDict(content["params"])
         uri = p.textDocument.uri
         if uri in self.didOpen:
             del self.didOpen[uri]
+            self.db.didClose(uri)
+            self.diagnostics.forget(uri)
             self.log.info(f"Closed: {uri}")
         else:
             # TODO: "A close notification requires a previous open
@@ -207,35 +262,72 @@ class LSP_state:
         contentChanges = params["contentChanges"]
         CE = TextDocumentContentChangeEvent
         changes = [CE.fromDict(d) for d in contentChanges]
-        doc.contentChanges(changes, version)
-        self.db.didChange(doc)
-
-        # TODO: Only if client has
-        # PublishDiagnosticsClientCapabilities
-        msg_diag = self._get_diagnostics_notification(doc)
-        if msg_diag is not None:
-            return msg_diag.toDict()
+        changes = doc.contentChanges(changes, version)
+        self.db.didChange(doc, changes)
+        return self._publish_diagnostics(doc)
 
     def _textDocument_signatureHelp(self, content):
         p = SignatureHelpParams.fromDict(content["params"])
         doc = self.didOpen[p.textDocument.uri]
-        signatureHelp = self.db.signatureHelp(doc, p.position)
+        signatureHelp = self.db.signatureHelp(doc, doc.from_client(p.position))
         return make_response(content["id"], signatureHelp)
 
     def _textDocument_hover(self, content):
         p = TextDocumentPositionParams.fromDict(content["params"])
-        hover = self.db.hover(self.didOpen[p.textDocument.uri], p)
+        doc = self.didOpen[p.textDocument.uri]
+        hover = self.db.hover(doc, TextDocumentPositionParams(
+            p.textDocument, doc.from_client(p.position)))
+        if hover is not None and hover.range is not None:
+            hover.range = doc.range_to_client(hover.range)
         return make_response(content["id"], hover)
 
     def _textDocument_documentLink(self, content):
         return make_response(content["id"], None)
 
-    def _get_diagnostics_notification(self, doc) -> NotificationMessage:
+    def _workspace_didChangeWatchedFiles(self, content):
+        p = DidChangeWatchedFilesParams.fromDict(content["params"])
+        self.db.didChangeWatchedFiles(p)
+
+    def _location(self, location):
+        """The Location with the range converted for the client.
+
+        For documents that aren't open the lines are from the db (see
+        DB.get_line), and the range is left as is if they can't be
+        read.
+
+        """
+        if location is None or self.position_encoding == "utf-32":
+            return location
+        doc = self.didOpen.get(location.uri)
+        if doc is not None:
+            return Location(location.uri, doc.range_to_client(location.range))
+
+        def to_client(position):
+            line = self.db.get_line(location.uri, position.line)
+            if line is None:
+                return position
+            return Position(position.line, to_units(
+                line, position.character, self.position_encoding))
+
+        rng = location.range
+        return Location(location.uri, Range(
+            to_client(rng.start), to_client(rng.end)))
+
+    def _get_PublishDiagnosticsParams(self, doc):
+        params = self.db.get_PublishDiagnosticsParams(doc)
+        if params is not None:
+            for diagnostic in params.diagnostics:
+                diagnostic.range = doc.range_to_client(diagnostic.range)
+        return params
+
+    def _publish_diagnostics(self, doc):
+        """Schedules publishing diagnostics for the doc, or returns the
+        notification if there's no way to send it separately.
+
+        """
         # TODO: Only if client has
         # PublishDiagnosticsClientCapabilities
-        diagnostics = self.db.get_PublishDiagnosticsParams(doc)
-        if diagnostics is None:
+        if self.notify is not None:
+            self.diagnostics.schedule(doc.snapshot())
             return None
-        return NotificationMessage(
-            "textDocument/publishDiagnostics",
-            diagnostics)
+        return self.diagnostics.message(doc)
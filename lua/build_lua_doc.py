@@ -6,19 +6,67 @@ to a certain point.
 
 """
 
-from . tokenize import tokenize
-from . scope import find_scopes_plus_errors
+from . tokenize import tokenize, read_next
+from . scope import (
+    find_scopes_plus_errors,
+    find_scopes_in_stream,
+    find_scopes_resumable,
+)
 from . lua_doc import LuaDoc
 from . error import LuaError
 
-def read_lua(text, g_env, file_path=None) -> LuaDoc:
+def read_lua(text, g_env, file_path=None, recover=True) -> LuaDoc:
+    """Parses text, skipping the statements with errors if recover
+    (otherwise stopping at the first error).
+
+    """
     tokens, token_errors = tokenize(text)
-    scopes, errors = find_scopes_plus_errors(tokens, g_env, file_path)
+    return read_lua_tokens(tokens, token_errors, g_env, file_path, recover)
+
+
+def read_lua_tokens(tokens, token_errors, g_env, file_path=None,
+                    recover=True) -> LuaDoc:
+    """Like read_lua, but for already tokenized Lua source code"""
+    scopes, errors, spans = find_scopes_plus_errors(
+        tokens, g_env, file_path, recover)
+    return _lua_doc(scopes, errors, spans, token_errors)
+
+
+def read_lua_tokens_resumable(tokens, token_errors, g_env, file_path=None,
+                              previous=None, first_changed=0, lazy=False):
+    """Like read_lua_tokens, but also returns the parser state, which can
+    be given as previous when the tokens have changed from token
+    first_changed, to only parse them from the last top-level statement
+    before that.
+
+    With lazy, function bodies are parsed when LuaDoc.scope_at first
+    needs them.
+
+    See scope.find_scopes_resumable.
+
+    """
+    scopes, errors, spans, state = find_scopes_resumable(
+        tokens, g_env, file_path, previous, first_changed, lazy)
+    return _lua_doc(scopes, errors, spans, token_errors,
+                    state.lazy_bodies), state
+
+
+def read_lua_streaming(text, g_env, file_path=None) -> LuaDoc:
+    """Like read_lua, but parses the tokens as they are read instead of
+    tokenizing all of the text first. Parsing stops at the first error.
+
+    """
+    scopes, errors, spans, token_errors = find_scopes_in_stream(
+        read_next(text), g_env, file_path)
+    return _lua_doc(scopes, errors, spans, token_errors)
+
 
+def _lua_doc(scopes, errors, spans, token_errors, lazy_bodies=()):
     for te in token_errors:
         errors.append(LuaError(f'Unexpected "{te.value}"', te.line, te.column))
 
-    return LuaDoc(scopes=scopes, errors=errors)
+    return LuaDoc(scopes=scopes, errors=errors, spans=spans,
+                  lazy_bodies=lazy_bodies)
 
 
 def read_file(file_path, g_env) -> LuaDoc:
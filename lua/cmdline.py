@@ -12,6 +12,8 @@ def _get_parser():
         ("local-env", "Disable local environments, only do completion on names in globals parsed as a library on start-up with --load-module"),
         ("built-ins", "Disable hard-coded definitions for built-in Lua functions"),
         ("diagnostics", "Disable diagnostics notifications for Lua code errors (as interpreted by the hacky lua-parser). Only relevant when not using --disable-local-env"),
+        ("completion-cache", "Disable reusing the completions for a word while it is being typed"),
+        ("module-cache", "Disable caching the parsed --load-module modules on disk"),
     ]
 
     group = parser.add_argument_group(
@@ -31,6 +33,49 @@ def _get_parser():
                         metavar="<path>",
                         default=[],
                         help="Specify a module to load on start-up for initializing globals. Can be repeated.")
+    parser.add_argument("--load-workers",
+                        type=int,
+                        default=1,
+                        metavar="<n>",
+                        help="Number of processes for parsing the --load-module modules in parallel (default: %(default)s).")
+    parser.add_argument("--module-cache-dir",
+                        metavar="<path>",
+                        default=None,
+                        help="Directory for caching the parsed --load-module modules (default: module_cache in the server folder).")
+    parser.add_argument("--diagnostics-delay",
+                        type=int,
+                        default=300,
+                        metavar="<ms>",
+                        help="Time without changes before publishing diagnostics, in milliseconds (default: %(default)s).")
+
+    parser.add_argument("--closed-doc-cache-size",
+                        type=int,
+                        default=64,
+                        metavar="<MiB>",
+                        help="Estimated memory for keeping the parsed state of closed documents, for when they are opened again, 0 to not keep it (default: %(default)s).")
+    parser.add_argument("--module-poll-interval",
+                        type=float,
+                        default=2.0,
+                        metavar="<s>",
+                        help="Minimum time between checks for added or removed Lua modules when completing in require(), in seconds, 0 to never check. Checking stops when the client sends workspace/didChangeWatchedFiles (default: %(default)s).")
+
+    parser.add_argument("--fuzzy-completion",
+                        action="store_true",
+                        help="Complete names that fuzzy match the typed text (e.g. gfn -> get_file_name), ranked by the server, instead of only names starting with it.")
+    parser.add_argument("--max-completions",
+                        type=int,
+                        default=100,
+                        metavar="<n>",
+                        help="Maximum number of completions returned with --fuzzy-completion (default: %(default)s).")
+
+    parser.add_argument("--lazy-function-bodies",
+                        action="store_true",
+                        help="Parse the body of a function when first completing or hovering in it, instead of when the file is opened. Opening large files is then faster, but errors in the bodies aren't reported before that, and return types are only deduced from parsed bodies.")
+
+    parser.add_argument("--async",
+                        action="store_true",
+                        dest="use_async",
+                        help="Use the asyncio-based server loop, which reads messages while handling earlier ones and supports $/cancelRequest.")
     return parser
 
 
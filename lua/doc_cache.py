@@ -0,0 +1,93 @@
+"""Parsed state kept for closed documents, so that reopening them
+doesn't require reading them again.
+
+"""
+import collections
+
+# Estimated memory use per token, for the tokens, the LuaDoc, the
+# globals and the parser state (measured with tracemalloc on files in
+# test/testdata)
+_BYTES_PER_TOKEN = 145
+
+
+class ClosedDoc:
+    """What LuaDB has for a document, kept when it is closed.
+
+    The parser state (see scope.State) is detached, so that the fields
+    the document assigned to tables from other files are removed while
+    it is closed.
+
+    """
+    def __init__(self, tokenizer, lua_doc, contribution, state=None):
+        self.tokenizer = tokenizer
+        self.lua_doc = lua_doc
+        self.contribution = contribution  # Globals, see GlobalEnv
+        self.state = state
+        self.size = estimate_size(tokenizer)
+
+    @property
+    def text(self):
+        return self.tokenizer.text
+
+
+def estimate_size(tokenizer):
+    """Estimated bytes used for a document, from its tokens"""
+    return len(tokenizer.text) + len(tokenizer.tokens) * _BYTES_PER_TOKEN
+
+
+class ClosedDocCache:
+    """ClosedDoc:s by URI, evicting the least recently closed ones when
+    their estimated size exceeds max_bytes.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.docs = collections.OrderedDict()
+        self.num_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def put(self, uri, closed_doc):
+        self.discard(uri)
+        if closed_doc.size > self.max_bytes:
+            self.evictions += 1
+            return
+        self.docs[uri] = closed_doc
+        self.num_bytes += closed_doc.size
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.docs.popitem(last=False)
+            self.num_bytes -= evicted.size
+            self.evictions += 1
+
+    def take(self, uri, text):
+        """Removes and returns the ClosedDoc for uri, if it is for text"""
+        closed_doc = self.docs.get(uri)
+        if closed_doc is None or closed_doc.text != text:
+            self.misses += 1
+            self.discard(uri)
+            return None
+        self.hits += 1
+        self.discard(uri)
+        return closed_doc
+
+    def peek(self, uri):
+        """The ClosedDoc for uri, if any, leaving it in the cache"""
+        return self.docs.get(uri)
+
+    def discard(self, uri):
+        closed_doc = self.docs.pop(uri, None)
+        if closed_doc is not None:
+            self.num_bytes -= closed_doc.size
+
+    def toDict(self):
+        return {
+            "docs": len(self.docs),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions}
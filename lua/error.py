@@ -15,7 +15,8 @@ class LuaBaseError(Exception):
     Subclasses are:
 
     - Raised as an exception for "unrecoverable" errors, which ends the
-      parsing at that point.
+      parsing of the statement at that point. The parser then skips to
+      the next statement.
 
     - Added to a list for errors that don't have to end the parsing.
 
@@ -26,6 +27,10 @@ class LuaBaseError(Exception):
         self.line_num = line_num
         self.char_num = char_num
 
+    def __reduce__(self):
+        # For pickling, e.g. in the module cache
+        return (self.__class__, (self.args[0], self.line_num, self.char_num))
+
     def get_message(self):
         return f"{self.get_prefix()} {self.args[0]}"
 
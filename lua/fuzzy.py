@@ -0,0 +1,191 @@
+"""Fuzzy matching and ranking of names for completion.
+
+A query matches a name if the characters of the query occur in order
+in the name (ignoring case), with the first character at a word start.
+Word starts are the start of the name and the starts of camelCase and
+snake_case parts, e.g. "gfn" matches "get_file_name" and "getFileName".
+
+"""
+import heapq
+
+# Score for a matched character
+_MATCH = 1
+# Extra score for a match at a word start, or directly after the
+# previous match
+_WORD_START = 10
+_CONSECUTIVE = 10
+# Extra score for matching case, and for matching at the start
+_SAME_CASE = 1
+_PREFIX = 8
+# Penalty for skipping characters between matches
+_GAP = 5
+
+
+def char_mask(s):
+    """Bitmask with a bit set per (lowercase) character in s"""
+    mask = 0
+    for c in s.lower():
+        mask |= 1 << (ord(c) & 63)
+    return mask
+
+
+def word_starts(name):
+    """Booleans telling if each character in name starts a word"""
+    starts = []
+    prev = ""
+    for c in name:
+        starts.append(
+            prev == ""
+            or (prev == "_" and c != "_")
+            or (prev.islower() and c.isupper())
+            or (not prev.isdigit() and c.isdigit()))
+        prev = c
+    return starts
+
+
+class Candidate:
+    """A name with data precomputed for matching"""
+    def __init__(self, name):
+        self.name = name
+        self.lower = name.lower()
+        self.mask = char_mask(name)
+        self.starts = word_starts(name)
+
+
+def score(query, candidate):
+    """Returns the score for the best match of the query in the
+    Candidate, or None if it doesn't match.
+
+    """
+    name = candidate.name
+    lower = candidate.lower
+    starts = candidate.starts
+    query_lower = query.lower()
+
+    # Best score with the previous query character matched at each
+    # position in the name (None if unmatched).
+    prev = None
+    for i, q in enumerate(query_lower):
+        cur = [None] * len(name)
+        # Best score in prev for positions before j - 1
+        best_before = None
+        for j in range(i, len(name)):
+            if prev is not None and j >= 2 and prev[j - 2] is not None:
+                if best_before is None or prev[j - 2] > best_before:
+                    best_before = prev[j - 2]
+            if lower[j] != q:
+                continue
+
+            bonus = _MATCH
+            if starts[j]:
+                bonus += _WORD_START
+            if name[j] == query[i]:
+                bonus += _SAME_CASE
+
+            if prev is None:
+                if not starts[j]:
+                    continue
+                cur[j] = bonus + (_PREFIX if j == 0 else 0)
+                continue
+
+            options = []
+            if j >= 1 and prev[j - 1] is not None:
+                options.append(prev[j - 1] + _CONSECUTIVE)
+            if best_before is not None:
+                options.append(best_before - _GAP)
+            if len(options) != 0:
+                cur[j] = bonus + max(options)
+        prev = cur
+
+    if prev is None:
+        return 0  # Empty query
+    matched = [s for s in prev if s is not None]
+    if len(matched) == 0:
+        return None
+    return max(matched)
+
+
+class CandidateIndex:
+    """Candidates for names, grouped by the characters starting their
+    words.
+
+    """
+    def __init__(self):
+        self.candidates = {}  # name to Candidate
+        self.by_start = {}  # lowercase character to set of names
+
+    def add(self, name):
+        if name in self.candidates:
+            return
+        candidate = Candidate(name)
+        self.candidates[name] = candidate
+        for c, start in zip(candidate.lower, candidate.starts):
+            if start:
+                self.by_start.setdefault(c, set()).add(name)
+
+    def remove(self, name):
+        candidate = self.candidates.pop(name, None)
+        if candidate is None:
+            return
+        for c, start in zip(candidate.lower, candidate.starts):
+            if start:
+                self.by_start[c].discard(name)
+
+    def sync(self, names):
+        """Add and remove candidates so that they are the given names"""
+        names = set(names)
+        for name in [n for n in self.candidates if n not in names]:
+            self.remove(name)
+        for name in names:
+            self.add(name)
+
+    def matches(self, query):
+        """Yields (score, name) for the candidates matching query"""
+        if len(query) == 0:
+            for name in self.candidates:
+                yield 0, name
+            return
+
+        mask = char_mask(query)
+        for name in self.by_start.get(query[0].lower(), ()):
+            candidate = self.candidates[name]
+            if candidate.mask & mask != mask:
+                continue
+            s = score(query, candidate)
+            if s is not None:
+                yield s, name
+
+
+def match_names(query, names):
+    """Yields (score, name) for the names matching query"""
+    mask = char_mask(query)
+    for name in names:
+        candidate = Candidate(name)
+        if candidate.mask & mask != mask:
+            continue
+        s = score(query, candidate)
+        if s is not None:
+            yield s, name
+
+
+def best(matches, limit):
+    """Returns the limit best (score, name) pairs, best first, and
+    whether any were left out.
+
+    Higher scores are better, then shorter names, then names in
+    alphabetical order.
+
+    """
+    num_matches = 0
+
+    def counted():
+        nonlocal num_matches
+        for m in matches:
+            num_matches += 1
+            yield m
+
+    top = heapq.nsmallest(
+        limit,
+        counted(),
+        key=lambda m: (-m[0], len(m[1]), m[1]))
+    return top, num_matches > limit
@@ -0,0 +1,229 @@
+"""Loading of the modules given with --load-module into the globals.
+
+Each module is parsed on its own, into a fresh GlobalEnv, which gives
+the globals it defines (its contribution). The contributions are then
+added to the shared GlobalEnv in command-line order, so that the last
+definition of a name wins.
+
+A module that looks up a global defined by an earlier module (e.g. to
+add fields to its table) can't be parsed on its own, so it is parsed
+again into the shared GlobalEnv.
+
+Parsed modules can be stored in a ModuleCache, keyed by a hash of
+their contents, so that unchanged modules aren't parsed again on the
+next start.
+
+The modules can be parsed in parallel, on a pool of worker processes,
+since the contributions are independent of each other.
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import pickle
+import tempfile
+
+from lua import build_lua_doc
+from lua.lua_types import GlobalEnv
+
+# Increase when the parser or the parsed representation changes, to
+# ignore entries from older versions
+CACHE_FORMAT = 4
+
+
+class RecordingGlobalEnv(GlobalEnv):
+    """A GlobalEnv that records the names looked up but not found"""
+    def __init__(self):
+        super().__init__()
+        self.missing = set()
+
+    def get(self, key):
+        value = super().get(key)
+        if value is None and key not in self.names:
+            self.missing.add(key)
+        return value
+
+
+class ModuleContribution:
+    """The result of parsing a module on its own.
+
+    names are the globals defined by the module, missing the globals
+    it looked up without finding them.
+
+    """
+    def __init__(self, file_path, names, missing, lua_doc):
+        self.file_path = file_path
+        self.names = names
+        self.missing = missing
+        self.lua_doc = lua_doc
+
+
+def read_text(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def parse_module(file_path, text):
+    """Returns the ModuleContribution for the Lua code in text"""
+    g_env = RecordingGlobalEnv()
+    lua_doc = build_lua_doc.read_lua(text, g_env, file_path)
+    names = {key: value for key, value in g_env.names.items()
+             if key != "_G"}
+    return ModuleContribution(file_path, names, g_env.missing, lua_doc)
+
+
+class ModuleCache:
+    """ModuleContribution:s stored as files in directory, named by a
+    hash of the module text and path.
+
+    An entry that can't be read is treated as missing, and replaced.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _path(self, file_path, text):
+        h = hashlib.sha256()
+        h.update(str(file_path).encode("utf-8") + b"\0")
+        h.update(text.encode("utf-8"))
+        return os.path.join(self.directory, h.hexdigest() + ".pickle")
+
+    def get(self, file_path, text):
+        """Returns the cached ModuleContribution, or None"""
+        path = self._path(file_path, text)
+        try:
+            with open(path, "rb") as f:
+                format, contribution = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Corrupt or from an incompatible version
+            self.errors += 1
+            return None
+
+        if format != CACHE_FORMAT:
+            self.errors += 1
+            return None
+        self.hits += 1
+        return contribution
+
+    def put(self, text, contribution):
+        """Stores the ModuleContribution, replacing any earlier entry"""
+        path = self._path(contribution.file_path, text)
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Written to a temporary file first, so that a partly written
+        # entry is never read
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((CACHE_FORMAT, contribution), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def _store(cache, text, contribution):
+    """Stores the contribution in the cache (if any), returns False if
+    that failed.
+
+    """
+    if cache is None:
+        return True
+    try:
+        cache.put(text, contribution)
+    except OSError:
+        return False
+    return True
+
+
+def _parse_and_store(file_path, text, cache):
+    """parse_module, storing the result in the cache. Run in the worker
+    processes.
+
+    """
+    contribution = parse_module(file_path, text)
+    return contribution, _store(cache, text, contribution)
+
+
+def read_module(file_path, cache=None):
+    """Returns the ModuleContribution for the file, from the cache if
+    possible.
+
+    """
+    text = read_text(file_path)
+    if cache is not None:
+        contribution = cache.get(file_path, text)
+        if contribution is not None:
+            return contribution
+
+    contribution = parse_module(file_path, text)
+    if not _store(cache, text, contribution):
+        cache.errors += 1
+    return contribution
+
+
+def read_modules(file_paths, cache=None, workers=1):
+    """Returns the ModuleContribution:s for the files, in order.
+
+    With more than one worker, the modules that aren't cached are
+    parsed on a pool of that many processes.
+
+    """
+    if workers <= 1 or len(file_paths) <= 1:
+        return [read_module(file_path, cache) for file_path in file_paths]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for file_path in file_paths:
+            text = read_text(file_path)
+            contribution = None
+            if cache is not None:
+                contribution = cache.get(file_path, text)
+            if contribution is None:
+                results.append(
+                    pool.submit(_parse_and_store, file_path, text, cache))
+            else:
+                results.append(contribution)
+
+        contributions = []
+        for result in results:
+            if isinstance(result, ModuleContribution):
+                contributions.append(result)
+                continue
+            contribution, stored = result.result()
+            if not stored:
+                cache.errors += 1
+            contributions.append(contribution)
+    return contributions
+
+
+def add_contribution(g_env, contribution):
+    """Adds the globals from the ModuleContribution to g_env, or returns
+    False if the module depends on the globals already in g_env.
+
+    """
+    if any(g_env.has(name) for name in contribution.missing):
+        return False
+    for name, value in contribution.names.items():
+        g_env[name] = value
+    return True
+
+
+def load_modules(file_paths, g_env, log, cache=None, workers=1):
+    """Adds the globals defined in the Lua files to g_env, in order.
+
+    See read_modules for workers.
+
+    """
+    contributions = read_modules(file_paths, cache, workers)
+    for file_path, contribution in zip(file_paths, contributions):
+        if not add_contribution(g_env, contribution):
+            log.info(f"Reading {file_path} after earlier modules")
+            build_lua_doc.read_file(file_path, g_env)
@@ -1,4 +1,5 @@
 from . import fragment
+from . import fuzzy
 from lsp import db
 from . import lua_types
 from lua.sillyparse import (
@@ -7,10 +8,15 @@ from lua.sillyparse import (
     find_indexing_before,
 )
 from lua.lua_doc import LuaDoc, EMPTY_ENV
-from lua.build_lua_doc import read_lua
+from lua.build_lua_doc import read_lua_tokens_resumable
+from lua.tokenize import IncrementalTokenizer
+from lua.module_index import ModuleIndex, normalized
+from lua.doc_cache import ClosedDoc, ClosedDocCache
+from lua.load_modules import read_text
 from lsp.lsp_defs import (
     CompletionItem,
     CompletionItemKind,
+    CompletionList,
     CompletionOptions,
     DefinitionParams,
     Hover,
@@ -26,7 +32,6 @@ from lsp.lsp_defs import (
 )
 import lsp.lsp_defs as lsp_defs
 from . import lua_re
-from pathlib import Path
 from typing import Mapping
 import lua.error
 from lua.cmdline import get_default_lua_server_options
@@ -97,20 +102,70 @@ def complete_all(g_env):
     return [make_completion(key, g_env[key]) for key in g_env if key != "_G"]
 
 
+def single_candidates(prefix, g_env, l_env):
+    """Returns (name, object) for the local and global names starting
+    with prefix.
+
+    """
+    local_keys = {}  # Dict as ordered set
+    for key in l_env.recursive_names():
+        if key.startswith(prefix):
+            local_keys[key] = None
+    return ([(key, l_env[key]) for key in local_keys]
+            + [(key, g_env[key]) for key in g_env.keys_with_prefix(prefix)
+               if key != "_G" and key not in local_keys])
+
+
 def complete_single(prefix, g_env, l_env) -> [CompletionItem]:
-    local_keys = [key for key in l_env.recursive_names()
-                  if key.startswith(prefix)]
-    local_completions = [make_completion(key, l_env[key])
-                         for key in local_keys]
+    return [make_completion(key, obj)
+            for key, obj in single_candidates(prefix, g_env, l_env)]
 
-    global_completions = [make_completion(key, g_env[key])
-                          for key in g_env
-                          if key != "_G" and key.startswith(prefix)
-                          and key not in local_keys]
-    return local_completions + global_completions
 
+def fuzzy_single_matches(query, g_env, l_env, index):
+    """Returns (score, name, object) for the local and global names
+    fuzzy matching query.
 
-def complete_index_list(index_list, g_env, l_env, include_f):
+    The index is a fuzzy.CandidateIndex for the names in g_env.
+
+    """
+    local_keys = dict.fromkeys(l_env.recursive_names())
+    return ([(s, key, l_env[key])
+             for s, key in fuzzy.match_names(query, local_keys)]
+            + [(s, key, g_env[key]) for s, key in index.matches(query)
+               if key != "_G" and key not in local_keys])
+
+
+def fuzzy_rematch(query, candidates):
+    """Returns (score, name, object) for the (name, object) candidates
+    fuzzy matching query.
+
+    """
+    objects = dict(candidates)
+    return [(s, key, objects[key])
+            for s, key in fuzzy.match_names(query, objects)]
+
+
+def rank_fuzzy(matches, limit):
+    """Returns a CompletionList with the limit best matches"""
+    top, incomplete = fuzzy.best(matches, limit)
+    return CompletionList(isIncomplete=incomplete, items=[
+        CompletionItem(label=key, kind=lsp_kind(obj), sortText=f"{n:05}")
+        for n, (_, key, obj) in enumerate(top)])
+
+
+def complete_single_fuzzy(query, g_env, l_env, index, limit):
+    """Returns a CompletionList with the limit best fuzzy matches for
+    query among the local and global names.
+
+    """
+    return rank_fuzzy(fuzzy_single_matches(query, g_env, l_env, index), limit)
+
+
+def index_list_candidates(index_list, g_env, l_env, include_f):
+    """Returns (key, object) for the fields of the table at
+    index_list[:-1] starting with index_list[-1].
+
+    """
     o = l_env.get(index_list[0])
     if o is None:
         o = g_env.get(index_list[0])
@@ -127,41 +182,72 @@ def complete_index_list(index_list, g_env, l_env, include_f):
         if o is None:
             return []
 
-    if isinstance(o, lua_types.Table):
-        prefix = index_list[-1]
-        return [make_completion(key, o[key])
-                for key in o
-                if key.startswith(prefix)
-                and include_f(o[key])]
+    if not isinstance(o, lua_types.Table):
+        return []
+
+    prefix = index_list[-1]
+    return [(key, o[key])
+            for key in o
+            if key.startswith(prefix)
+            and include_f(o[key])]
+
+
+def complete_index_list(index_list, g_env, l_env, include_f):
+    return [make_completion(key, obj)
+            for key, obj in index_list_candidates(
+                index_list, g_env, l_env, include_f)]
+
 
+class CompletionSession:
+    """Completion candidates for a word being typed.
 
-def simple_paths_hack(lua_path):
-    # Hack for simple require completion for paths like
-    #   c:/some_folder/?.lua
-    # TODO: I should also allow stuff like
-    #   c:/some_folder/?/the_file.lua or
-    #   c:/some_folder/?/?.lua
-    simple_paths = [p for p in lua_path.split(";") if p.endswith("?.lua")]
-    simple_paths = [p[:-5] for p in simple_paths]
-    for p in simple_paths:
-        assert "?" not in p
-    return [Path(p) for p in simple_paths]
+    While the word is extended, the candidates are narrowed down
+    instead of searched for again.
 
+    The key is (uri, line, start column of the word, index path to
+    the word, method completion).
 
-def complete_require(uri, prefix_full, lua_path):
+    """
+    def __init__(self, key, word, candidates, g_env_changes):
+        self.key = key
+        self.word = word
+        self.candidates = candidates  # (name, object)
+
+        # GlobalEnv.num_changes when the candidates were found
+        self.g_env_changes = g_env_changes
+
+    def extended_by(self, key, word, g_env_changes):
+        return (key == self.key
+                and word.startswith(self.word)
+                and g_env_changes == self.g_env_changes)
+
+    def unaffected_by(self, changes):
+        """True if the TextDocumentContentChangeEvent:s are all within
+        the line of the word
+
+        """
+        if changes is None:
+            return False
+        line = self.key[1]
+        for change in changes:
+            if change.range is None or "\n" in change.text:
+                return False
+            if change.range.start.line != line:
+                return False
+            if change.range.end.line != line:
+                return False
+        return True
+
+
+def complete_require(uri, prefix_full, module_index):
     """Completion within a require()-call"""
     prefix = lua_re.match_require(prefix_full).group(2)
-    current_file = uri_to_path(uri)
-
-    def match_prefix(f):
-        return f.is_file() and f.name.startswith(prefix)
+    only_current = {normalized(uri_to_path(uri))}
 
     candidates = []
-    for p in simple_paths_hack(lua_path):
-        if p.exists() and p.is_dir():
-            for f in p.iterdir():
-                if match_prefix(f) and not f.samefile(current_file):
-                    candidates.append(f.stem)
+    for name in module_index.names_with_prefix(prefix):
+        if module_index.paths(name) != only_current:
+            candidates.append(name)
 
     return [make_file_completion(c) for c in candidates]
 
@@ -234,12 +320,123 @@ class LuaDB(db.DB):
         # URI to LuaDoc
         self.lua_docs = {}
 
+        # URIs for documents changed since their LuaDoc was read
+        self.stale = set()
+
+        # URI to IncrementalTokenizer, and to the changes not yet
+        # applied to it
+        self.tokenizers = {}
+        self.pending_changes = {}
+
+        # URI to the parser state when the LuaDoc was read, for
+        # resuming parsing after a change
+        self.parse_states = {}
+
+        # Number of documents read, and of tokens parsed, for
+        # measuring
+        self.parse_count = 0
+        self.parsed_tokens = 0
+
+        # For fuzzy completion of global names, synchronized with
+        # g_env when its generation changes
+        self.fuzzy_index = fuzzy.CandidateIndex()
+        self.fuzzy_generation = None
+
+        # URI to CompletionSession for the word last completed
+        self.completion_sessions = {}
+        self.completion_cache_hits = 0
+        self.completion_cache_misses = 0
+
+        # Modules for require() completion, created when first needed
+        self.module_index = None
+
+        # Whether the client has sent file events, so that the module
+        # index doesn't have to poll
+        self.files_watched = False
+
+        # Parsed state for recently closed documents
+        self.closed_docs = ClosedDocCache(
+            self.options.closed_doc_cache_size * 1024 * 1024)
+
+    def _tokenize(self, doc):
+        text = doc.getText()
+        changes = self.pending_changes.pop(doc.uri, [])
+        tokenizer = self.tokenizers.get(doc.uri)
+        if tokenizer is None:
+            tokenizer = IncrementalTokenizer(text)
+            self.tokenizers[doc.uri] = tokenizer
+            return tokenizer
+
+        for change in changes:
+            tokenizer.apply_change(change)
+        if tokenizer.text != text:
+            self.log.info(f"Re-tokenizing {doc.uri}, changes didn't match")
+            tokenizer.reset(text)
+        return tokenizer
+
+    def _get_module_index(self):
+        if self.module_index is None:
+            interval = self.options.module_poll_interval
+            if interval <= 0 or self.files_watched:
+                interval = None
+            self.module_index = ModuleIndex(self.lua_path, interval)
+            self.log.info(
+                f"Found {len(self.module_index.modules)} Lua modules")
+        else:
+            self.module_index.poll()
+        return self.module_index
+
+    def _read_lua_doc(self, doc):
+        self.parse_count += 1
+        tokenizer = self._tokenize(doc)
+
+        # The globals assigned in the document replace those from
+        # when it was last read. Parsing resumes before the first
+        # changed token, if the document was parsed before.
+        previous = self.parse_states.pop(doc.uri, None)
+        if previous is None:
+            env = lua_types.ContributionEnv(self.g_env)
+        else:
+            env = previous.g_env
+        lua_doc, state = read_lua_tokens_resumable(
+            tokenizer.tokens, tokenizer.errors, env, doc.uri,
+            previous, tokenizer.first_changed,
+            self.options.lazy_function_bodies)
+        tokenizer.clear_changes()
+        self.parsed_tokens += state.n - state.start
+        self.parse_states[doc.uri] = state
+        self.g_env.set_contribution(doc.uri, env.contribution())
+        self.lua_docs[doc.uri] = lua_doc
+        return lua_doc
+
+    def get_lua_doc(self, doc):
+        """Returns the LuaDoc for the doc, or None.
+
+        Re-reads the document first if it has changed since it was
+        last read.
+
+        """
+        if doc.uri in self.stale:
+            self.stale.discard(doc.uri)
+            lua_doc = self._read_lua_doc(doc)
+            self.log.info(
+                f"re-read LuaDoc with {len(lua_doc.scopes)} scopes")
+            return lua_doc
+        return self.lua_docs.get(doc.uri)
+
     def get_local_env(self, doc, position):
-        ld = self.lua_docs.get(doc.uri)
+        ld = self.get_lua_doc(doc)
         if ld is None:
             self.log.info(f"{doc.uri} not in lua_docs")
             return EMPTY_ENV
+        num_parsed = ld.num_parsed_bodies
         l_env = ld.scope_at(position)
+        if ld.num_parsed_bodies != num_parsed:
+            # Function bodies were parsed, which can assign globals
+            state = self.parse_states.get(doc.uri)
+            if state is not None:
+                self.g_env.set_contribution(
+                    doc.uri, state.g_env.contribution())
         if l_env is EMPTY_ENV:
             self.log.info(
                 f"Got EMPTY_ENV at {position.line}, {position.character}")
@@ -252,7 +449,8 @@ class LuaDB(db.DB):
 
         if lua_re.in_require(prefix):
             self.log.info(f"in require: {prefix}, uri={doc.uri}")
-            return complete_require(doc.uri, prefix, self.lua_path)
+            return complete_require(
+                doc.uri, prefix, self._get_module_index())
         else:
             self.log.info(f"not in require: {prefix}")
         path = as_index_list(prefix)
@@ -265,22 +463,62 @@ class LuaDB(db.DB):
         else:
             self.log.info("Not method: " + "|".join(path))
 
-        l_env = self.get_local_env(doc, position)
-        if len(path) == 1 and not method:
-            return complete_single(path[0], self.g_env, l_env)
+        word = path[-1]
+        key = (doc.uri, position.line, position.character - len(word),
+               tuple(path[:-1]), method)
+        use_fuzzy = (self.options.fuzzy_completion
+                     and len(path) == 1 and not method)
+
+        session = self.completion_sessions.get(doc.uri)
+        if (session is not None
+                and session.extended_by(key, word, self.g_env.num_changes)):
+            self.completion_cache_hits += 1
+            session.word = word
+            if use_fuzzy:
+                matches = fuzzy_rematch(word, session.candidates)
+                session.candidates = [(k, o) for _, k, o in matches]
+            else:
+                session.candidates = [(k, o) for k, o in session.candidates
+                                      if k.startswith(word)]
         else:
-            if method:
-                # Only complete to functions
-                # TODO: Only complete to methods with matching type (or
-                #       unspecified) type of first argument (self)?
-                # (at least exclude 0-args? Maybe wrong due to Lua silliness)
-                def include_f(o):
-                    return isinstance(o, lua_types.Function)
+            l_env = self.get_local_env(doc, position)
+            if use_fuzzy:
+                matches = fuzzy_single_matches(
+                    word, self.g_env, l_env, self._get_fuzzy_index())
+                candidates = [(k, o) for _, k, o in matches]
+            elif len(path) == 1 and not method:
+                candidates = single_candidates(word, self.g_env, l_env)
             else:
-                # Complete to any object
-                def include_f(o):
-                    return True
-            return complete_index_list(path, self.g_env, l_env, include_f)
+                if method:
+                    # Only complete to functions
+                    # TODO: Only complete to methods with matching type
+                    #       (or unspecified) type of first argument
+                    #       (self)? (at least exclude 0-args? Maybe
+                    #       wrong due to Lua silliness)
+                    def include_f(o):
+                        return isinstance(o, lua_types.Function)
+                else:
+                    # Complete to any object
+                    def include_f(o):
+                        return True
+                candidates = index_list_candidates(
+                    path, self.g_env, l_env, include_f)
+
+            session = CompletionSession(
+                key, word, candidates, self.g_env.num_changes)
+            if self.options.enable_completion_cache:
+                self.completion_cache_misses += 1
+                self.completion_sessions[doc.uri] = session
+
+        if use_fuzzy:
+            return rank_fuzzy(matches, self.options.max_completions)
+        return [make_completion(k, o) for k, o in session.candidates]
+
+    def _get_fuzzy_index(self):
+        if self.fuzzy_generation != self.g_env.generation:
+            self.fuzzy_index.sync(self.g_env)
+            self.fuzzy_generation = self.g_env.generation
+        return self.fuzzy_index
 
     def typeDefinition(self, doc, position):
         l_env = self.get_local_env(doc, position)
@@ -376,21 +614,49 @@ class LuaDB(db.DB):
             Position(line=end_line, character=end_char)))
 
     def didOpen(self, doc):
+        self.completion_sessions.pop(doc.uri, None)
         if not self.options.enable_local_env:
             return
-        text = "\n".join(doc.lines)  # TODO: I just had it as text
-        lua_doc = read_lua(text, self.g_env, doc.uri)
+        self.stale.discard(doc.uri)
+        self.tokenizers.pop(doc.uri, None)
+        self.pending_changes.pop(doc.uri, None)
+        previous = self.parse_states.pop(doc.uri, None)
+        if previous is not None:
+            previous.detach()
+
+        closed_doc = self.closed_docs.take(doc.uri, doc.getText())
+        if closed_doc is not None:
+            self.tokenizers[doc.uri] = closed_doc.tokenizer
+            self.lua_docs[doc.uri] = closed_doc.lua_doc
+            self.g_env.set_contribution(doc.uri, closed_doc.contribution)
+            if closed_doc.state is not None:
+                closed_doc.state.attach()
+                self.parse_states[doc.uri] = closed_doc.state
+            self.log.info("reused LuaDoc from when the document was closed")
+            return
+
+        lua_doc = self._read_lua_doc(doc)
         self.log.info(f"read LuaDoc with {len(lua_doc.scopes)} scopes")
         self.log.info(lua_doc.pretty_str())
-        self.lua_docs[doc.uri] = lua_doc
 
-    def didChange(self, doc):
+    def didChange(self, doc, changes=None):
+        """Marks the LuaDoc for the doc as stale.
+
+        The document is re-read when the LuaDoc is next needed, so
+        that a burst of changes only costs one parse. Only the parts
+        affected by the changes (TextDocumentContentChangeEvent:s) are
+        re-tokenized.
+
+        """
+        session = self.completion_sessions.get(doc.uri)
+        if session is not None and not session.unaffected_by(changes):
+            del self.completion_sessions[doc.uri]
+
         if not self.options.enable_local_env:
             return
-        text = "\n".join(doc.lines)
-        lua_doc = read_lua(text, self.g_env, doc.uri)
-        self.log.info(f"re-read LuaDoc with {len(lua_doc.scopes)} scopes")
-        self.lua_docs[doc.uri] = lua_doc
+        self.stale.add(doc.uri)
+        if changes is not None:
+            self.pending_changes.setdefault(doc.uri, []).extend(changes)
 
     def get_PublishDiagnosticsParams(self, doc):
         """Returns PublishDiagnosticsParams or None."""
@@ -398,7 +664,7 @@ class LuaDB(db.DB):
             return None
 
         def get_diagnostics():
-            lua_doc = self.lua_docs.get(doc.uri)
+            lua_doc = self.get_lua_doc(doc)
             return (
                 [] if lua_doc is None else
                 [lua.error.to_diagnostic(e) for e in lua_doc.errors])
@@ -408,6 +674,75 @@ class LuaDB(db.DB):
             version=doc.version,
             diagnostics=get_diagnostics())
 
+    def didClose(self, uri):
+        """Drops the state for the document, including its globals and
+        the fields it assigned to tables from other files.
+
+        The LuaDoc etc. are kept in closed_docs, if up to date, for
+        when the document is opened again.
+
+        """
+        contribution = self.g_env.contributions.get(uri, {})
+        self.g_env.release(uri)
+        lua_doc = self.lua_docs.pop(uri, None)
+        tokenizer = self.tokenizers.pop(uri, None)
+        state = self.parse_states.pop(uri, None)
+        if state is not None:
+            state.detach()
+        if (lua_doc is not None and tokenizer is not None
+                and uri not in self.stale):
+            self.closed_docs.put(
+                uri, ClosedDoc(tokenizer, lua_doc, contribution, state))
+        self.stale.discard(uri)
+        self.pending_changes.pop(uri, None)
+        self.completion_sessions.pop(uri, None)
+
+    def didChangeWatchedFiles(self, params):
+        """Updates the module index from the file events. The client
+        watches the files, so the index doesn't have to poll.
+
+        """
+        self.files_watched = True
+        index = self.module_index
+        if index is None:
+            return
+        index.poll_interval = None
+        for event in params.changes:
+            path = uri_to_path(event.uri)
+            if event.type == lsp_defs.FileChangeType.Created:
+                index.created(path)
+            elif event.type == lsp_defs.FileChangeType.Deleted:
+                index.deleted(path)
+
+    def get_line(self, uri, n):
+        """Line n of the document at uri, which isn't open, from
+        closed_docs or else the file, or None if it can't be read.
+
+        """
+        closed_doc = self.closed_docs.peek(uri)
+        if closed_doc is not None:
+            text = closed_doc.text
+        else:
+            try:
+                text = read_text(uri_to_path(uri))
+            except (OSError, UnicodeDecodeError):
+                return None
+        lines = text.split("\n")
+        return lines[n] if n < len(lines) else None
+
+    def get_stats(self):
+        return {
+            "parse_count": self.parse_count,
+            "parsed_tokens": self.parsed_tokens,
+            "lua_docs": len(self.lua_docs),
+            "globals": len(self.g_env),
+            "modules": (None if self.module_index is None
+                        else len(self.module_index.modules)),
+            "completion_cache": {
+                "hits": self.completion_cache_hits,
+                "misses": self.completion_cache_misses},
+            "closed_docs": self.closed_docs.toDict()}
+
     def get_capabilities(self):
         capabilities = {}
 
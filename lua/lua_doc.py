@@ -1,8 +1,64 @@
+import bisect
+
 from lua.lua_types import EmptyEnv
 
 EMPTY_ENV = EmptyEnv()
 
 
+def _scope_index(spans, scopes):
+    """Returns the positions where the narrowest scope changes, and the
+    scope (or None) from each position to the next.
+
+    The spans (start, end) must be nested, i.e. not partially overlap.
+
+    """
+    boundaries = []
+    owners = []
+
+    def change(pos, scope):
+        if len(boundaries) != 0 and boundaries[-1] == pos:
+            owners[-1] = scope
+        else:
+            boundaries.append(pos)
+            owners.append(scope)
+
+    # Sorted by start, outer scope first for equal starts
+    order = sorted(range(len(spans)),
+                   key=lambda n: (spans[n][0], _negated(spans[n][1]), n))
+    stack = []
+
+    def close_until(pos):
+        while len(stack) != 0 and (pos is None or stack[-1][0] <= pos):
+            end, _ = stack.pop()
+            change(end, stack[-1][1] if len(stack) != 0 else None)
+
+    for n in order:
+        start, end = spans[n]
+        close_until(start)
+        stack.append((end, scopes[n][1]))
+        change(start, scopes[n][1])
+    close_until(None)
+    return boundaries, owners
+
+
+def _splice_index(index, span, owner, spans, scopes):
+    """Adds the scopes, with spans nested in the span of the owner
+    scope, to an index from _scope_index.
+
+    """
+    boundaries, owners = index
+    new_boundaries, new_owners = _scope_index(spans, scopes)
+    new_owners = [owner if o is None else o for o in new_owners]
+    first = bisect.bisect_right(boundaries, span[0])
+    last = bisect.bisect_left(boundaries, span[1])
+    boundaries[first:last] = new_boundaries
+    owners[first:last] = new_owners
+
+
+def _negated(pos):
+    return (-pos[0], -pos[1])
+
+
 class LuaDoc:
     """A parsed representation of a Lua file.
 
@@ -13,9 +69,24 @@ class LuaDoc:
           (range(0,3): LocalEnv(..)),
           ...
         }
+
+    and optionally column-precise spans for the scopes:
+
+        spans = [
+          ((0, 0), (12, 0)),
+          ((0, 12), (2, 3)),
+          ...
+        ]
+
+    where the end (line, column) is exclusive.
+
+    lazy_bodies are the scope.LazyBody:s for functions whose bodies
+    weren't parsed. The scope of such a function is empty until
+    scope_at is asked for a position in it, which parses the body and
+    adds its scopes and errors.
     """
 
-    def __init__(self, scopes, errors=None):
+    def __init__(self, scopes, errors=None, spans=None, lazy_bodies=()):
         assert isinstance(scopes, list)
         self.scopes = scopes
         if errors is None:
@@ -23,23 +94,46 @@ class LuaDoc:
         else:
             self.errors = errors
 
+        if spans is None:
+            spans = [((r.start, 0), (r.stop, 0)) for r, _ in scopes]
+        assert len(spans) == len(scopes)
+        self.spans = spans
+
+        # Built by scope_at when first needed
+        self._index = None
+
+        # Function scope to LazyBody
+        self.lazy_bodies = {body.scope: body for body in lazy_bodies}
+        self.num_parsed_bodies = 0
+
     def scope_at(self, pos):
-        narrowest_matching = None
+        """Returns the narrowest scope containing the position, or
+        EMPTY_ENV.
 
-        def shorter_range(lhs):
-            if narrowest_matching is None:
-                return True
-            rhs = narrowest_matching[0]
-            return (lhs.stop - lhs.start) < (rhs.stop - rhs.start)
+        """
+        if self._index is None:
+            self._index = _scope_index(self.spans, self.scopes)
+        boundaries, owners = self._index
 
-        for r, scope in self.scopes:
-            if pos.line in r:
-                if shorter_range(r):
-                    narrowest_matching = (r, scope)
+        while True:
+            n = bisect.bisect_right(boundaries, (pos.line, pos.character)) - 1
+            if n < 0 or owners[n] is None:
+                return EMPTY_ENV
+            body = self.lazy_bodies.pop(owners[n], None)
+            if body is None:
+                return owners[n]
+            self._parse_body(body)
 
-        if narrowest_matching is None:
-            return EMPTY_ENV
-        return narrowest_matching[1]
+    def _parse_body(self, body):
+        scopes, spans, errors, lazy_bodies = body.parse()
+        self.num_parsed_bodies += 1
+        self.scopes.extend(scopes)
+        self.spans.extend(spans)
+        self.errors.extend(errors)
+        for nested in lazy_bodies:
+            self.lazy_bodies[nested.scope] = nested
+        if len(scopes) != 0:
+            _splice_index(self._index, body.span, body.scope, spans, scopes)
 
     def pretty_str(self):
         lines = []
@@ -1,8 +1,8 @@
 from lua.cmdline import get_lua_server_options
-from lsp_server import lsp_io_server
+from lsp_server import lsp_io_server, lsp_async_server
 import lsp.log
-from lua import build_lua_doc
 from lua.builtins import add_built_ins
+from lua.load_modules import ModuleCache, load_modules
 from lua.lua_db import LuaDB
 from lua.lua_types import GlobalEnv
 
@@ -23,10 +23,23 @@ def get_lua_path():
     return lua_path
 
 
+def get_module_cache(options):
+    if not options.enable_module_cache:
+        return None
+    cache_dir = options.module_cache_dir
+    if cache_dir is None:
+        cache_dir = lsp_io_server.get_top_dir() / "module_cache"
+    return ModuleCache(cache_dir)
+
+
 def create_db(log, options):
     g_env = GlobalEnv()
-    for module_path in options.load_modules:
-        build_lua_doc.read_file(module_path, g_env)
+    cache = get_module_cache(options)
+    load_modules(
+        options.load_modules, g_env, log, cache, options.load_workers)
+    if cache is not None:
+        log.info(f"Module cache: {cache.hits} hits, {cache.misses} misses,"
+                 f" {cache.errors} errors")
 
     if options.enable_built_ins:
         add_built_ins(g_env)
@@ -47,5 +60,7 @@ def run():
     options = get_lua_server_options()
     with get_logger(options) as log:
         db = create_db(log, options)
-        exit_code = lsp_io_server.run(db, log)
+        server = lsp_async_server if options.use_async else lsp_io_server
+        exit_code = server.run(
+            db, log, diagnostics_delay=options.diagnostics_delay / 1000)
         exit(exit_code)
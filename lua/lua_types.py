@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import bisect
+
 from . import annotations
 
 
@@ -12,7 +14,31 @@ def _no_sep_non_empty(*args):
     return "".join(filtered)
 
 
+class _EmptyNames(dict):
+    """A read-only empty dict, shared as the fields of tables and names
+    of scopes until the first is assigned, since most are never
+    assigned any.
+
+    """
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Shared empty names can't be changed")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # Unpickled as the shared instance
+        return "_EMPTY_NAMES"
+
+
+_EMPTY_NAMES = _EmptyNames()
+
+
 class LuaItem:
+    __slots__ = ("file_path", "line_num", "char_num")
+
     def __init__(self, file_path, line_num=None, char_num=None):
         self.file_path = file_path
         self.line_num = line_num
@@ -26,9 +52,29 @@ class LuaItem:
 
 
 class Comment:
+    """A comment, whose text without annotations and the annotations
+    are found when first needed, since most are never looked at.
+
+    """
+    __slots__ = ("raw_comment", "_comment_text", "_annotations")
+
     def __init__(self, raw_comment):
-        self.comment_text = annotations.strip_annotations(raw_comment)
-        self.annotations = annotations.parse_comment(raw_comment)
+        self.raw_comment = raw_comment
+        self._comment_text = None
+        self._annotations = None
+
+    @property
+    def comment_text(self):
+        if self._comment_text is None:
+            self._comment_text = annotations.strip_annotations(
+                self.raw_comment)
+        return self._comment_text
+
+    @property
+    def annotations(self):
+        if self._annotations is None:
+            self._annotations = annotations.parse_comment(self.raw_comment)
+        return self._annotations
 
     def get_annotations(self):
         return self.annotations
@@ -53,6 +99,8 @@ class Comment:
 
 
 class Uninitialized(LuaItem):
+    __slots__ = ("name",)
+
     def __init__(self, name, file_path):
         LuaItem.__init__(self, file_path)
         self.name = name
@@ -63,6 +111,8 @@ class Uninitialized(LuaItem):
 
 class Arg:
     """Function argument"""
+    __slots__ = ("name", "lua_type", "doc", "line_num", "char_num")
+
     def __init__(self, name, lua_type=None, doc=None, line_num=None, char_num=None):  # noqa: E501
         self.name = name
         self.lua_type = lua_type
@@ -95,6 +145,8 @@ def _python_bool_to_lua_str(python_bool):
 
 
 class Boolean(LuaItem):
+    __slots__ = ("value", "doc")
+
     def __init__(self, value, doc, line_num, char_num):
         if not isinstance(value, bool):
             self.value = _lua_str_to_python_bool(value)
@@ -139,10 +191,12 @@ def _returns_from_annotations(comment: Comment):
 
 
 class Function(LuaItem):
+    __slots__ = ("name", "_args", "doc", "names", "_returns", "_doc_applied")
+
     def __init__(self, name=None, names=None, args=None, doc=None, file_path=None, line_num=None, char_num=None):  # noqa: E501
         LuaItem.__init__(self, file_path)
         self.name = name
-        self.args = args
+        self._args = args
         self.doc = doc
         assert self.doc is None or isinstance(self.doc, Comment)
         self.line_num = line_num
@@ -151,13 +205,33 @@ class Function(LuaItem):
         # TODO: Hack, use some index/name type that forces figuring out which
         self.names = names
 
-        if self.doc is not None:
-            _assign_types_to_args(self.args, self.doc)
-
-        if self.doc is not None:
-            self.returns = _returns_from_annotations(self.doc)
-        else:
-            self.returns = []
+        # The arg types and returns from the annotations in doc are
+        # added when args or returns are first used, see _apply_doc
+        self._returns = ()  # Shared while there are none
+        self._doc_applied = self.doc is None
+
+    def _apply_doc(self):
+        self._doc_applied = True
+        _assign_types_to_args(self._args, self.doc)
+        self._returns = _returns_from_annotations(self.doc) or ()
+
+    @property
+    def args(self):
+        if not self._doc_applied:
+            self._apply_doc()
+        return self._args
+
+    @property
+    def returns(self):
+        if not self._doc_applied:
+            self._apply_doc()
+        return self._returns
+
+    @returns.setter
+    def returns(self, returns):
+        if not self._doc_applied:
+            self._apply_doc()
+        self._returns = returns
 
     def pretty_str(self, indent):
         if self.name is not None:
@@ -198,8 +272,8 @@ class Function(LuaItem):
             # TODO: Do something smarter, e.g. separate namespaces for
             #       annotations and deductions
             return
-        else:
-            self.returns.extend(returns)
+        elif len(returns) != 0:
+            self._returns = list(returns)
 
     def get_doc(self):
         if self.doc is not None:
@@ -209,6 +283,8 @@ class Function(LuaItem):
 
 
 class Any(LuaItem):
+    __slots__ = ("name",)
+
     def __init__(self, name=None, file_path=None):
         LuaItem.__init__(self, file_path)
         self.name = name
@@ -229,6 +305,7 @@ class Unknown(LuaItem):
     order of parsing"
 
     """
+    __slots__ = ("name",)
 
     def __init__(self, name, file_path):
         LuaItem.__init__(self, file_path)
@@ -244,6 +321,7 @@ class Unknown(LuaItem):
 class Unimplemented(LuaItem):
     """For avoiding None in output for unimplemented cases
     """
+    __slots__ = ("what",)
 
     def __init__(self, what, file_path):
         LuaItem.__init__(self, file_path)
@@ -257,6 +335,8 @@ class Unimplemented(LuaItem):
 
 
 class Number(LuaItem):
+    __slots__ = ("value",)
+
     def __init__(self, value, file_path, line_num=None, char_num=None):
         LuaItem.__init__(self, file_path)
         assert not isinstance(value, str)
@@ -275,6 +355,8 @@ class Number(LuaItem):
 
 
 class String(LuaItem):
+    __slots__ = ("value",)
+
     def __init__(self, value, file_path):
         LuaItem.__init__(self, file_path)
         self.value = value
@@ -284,11 +366,15 @@ class String(LuaItem):
 
 
 class Table(LuaItem):
+    __slots__ = ("fields",)
+
     def __init__(self, file_path):
         LuaItem.__init__(self, file_path)
-        self.fields = {}
+        self.fields = _EMPTY_NAMES
 
     def __setitem__(self, key, value):
+        if self.fields is _EMPTY_NAMES:
+            self.fields = {}
         self.fields[key] = value
 
     def __getitem__(self, key):
@@ -327,6 +413,28 @@ class GlobalEnv:
         self.names = {}
         self.names["_G"] = self
 
+        # Sorted names, for prefix searches. Names added since last
+        # sorted are kept in unsorted_keys.
+        self.sorted_keys = ["_G"]
+        self.unsorted_keys = []
+
+        # Increased when names are added, for keeping other indexes
+        # of the names up to date
+        self.generation = 0
+
+        # Increased on every assignment
+        self.num_changes = 0
+
+        # Names assigned by each owner (e.g. the URI of a document),
+        # see set_contribution, and the owners defining each of these
+        # names, the last one defining its value.
+        self.contributions = {}
+        self.definers = {}
+
+        # Values assigned without owner, for names since defined by
+        # owners
+        self.shadowed = {}
+
     def __len__(self):
         return len(self.names)
 
@@ -335,6 +443,10 @@ class GlobalEnv:
 
     def __setitem__(self, key, value):
         assert issubclass(value.__class__, LuaItem) or value is None
+        if key not in self.names:
+            self.unsorted_keys.append(key)
+            self.generation += 1
+        self.num_changes += 1
         self.names[key] = value
 
     def __iter__(self):
@@ -343,6 +455,83 @@ class GlobalEnv:
     def get(self, key):
         return self.names.get(key)
 
+    def fields_changed(self):
+        """Count a change to the fields of a table, which can be reached
+        from the globals
+
+        """
+        self.num_changes += 1
+
+    def _remove_key(self, key):
+        del self.names[key]
+        if key in self.unsorted_keys:
+            self.unsorted_keys.remove(key)
+        else:
+            del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+        self.generation += 1
+        self.num_changes += 1
+
+    def set_contribution(self, owner, names):
+        """Replace the names assigned by owner with names (a dict).
+
+        The value of a name is the one assigned last, by an owner or
+        directly. Names no longer assigned by owner revert to their
+        previous value, or are removed.
+
+        """
+        old = self.contributions.pop(owner, {})
+        for key in old:
+            if key in names:
+                continue
+            definers = self.definers[key]
+            definers.remove(owner)
+            if len(definers) != 0:
+                self.names[key] = self.contributions[definers[-1]][key]
+                self.num_changes += 1
+            else:
+                del self.definers[key]
+                if key in self.shadowed:
+                    self.names[key] = self.shadowed.pop(key)
+                    self.num_changes += 1
+                else:
+                    self._remove_key(key)
+
+        if len(names) != 0:
+            self.contributions[owner] = names
+        for key, value in names.items():
+            definers = self.definers.get(key)
+            if definers is None:
+                definers = self.definers[key] = []
+                if key in self.names:
+                    self.shadowed[key] = self.names[key]
+            elif owner in definers:
+                definers.remove(owner)
+            definers.append(owner)
+            # Unchanged values aren't assigned, which would count as a
+            # change (e.g. for the completion cache)
+            if key not in self.names or self.names[key] is not value:
+                self[key] = value
+
+    def release(self, owner):
+        """Remove the names assigned by owner"""
+        self.set_contribution(owner, {})
+
+    def keys_with_prefix(self, prefix):
+        """Returns the names starting with prefix, in sorted order"""
+        if len(self.unsorted_keys) != 0:
+            # The sort is linear for the already sorted part
+            self.sorted_keys.extend(self.unsorted_keys)
+            self.sorted_keys.sort()
+            self.unsorted_keys = []
+
+        keys = self.sorted_keys
+        result = []
+        for n in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[n].startswith(prefix):
+                break
+            result.append(keys[n])
+        return result
+
     def has(self, key):
         return key in self.names.keys()
 
@@ -368,6 +557,31 @@ class GlobalEnv:
         print(self.pretty_str(indent, heading))
 
 
+class ContributionEnv(GlobalEnv):
+    """The globals assigned when reading a file, for
+    GlobalEnv.set_contribution. Names not assigned are looked up in the
+    GlobalEnv base.
+
+    """
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def get(self, key):
+        if key in self.names:
+            return self.names[key]
+        return self.base.get(key)
+
+    def fields_changed(self):
+        # The tables can be shared through the base
+        super().fields_changed()
+        self.base.fields_changed()
+
+    def contribution(self):
+        return {key: value for key, value in self.names.items()
+                if key != "_G"}
+
+
 def _pretty_str(v, indent):
     if v is None:
         return "<None>"
@@ -399,9 +613,11 @@ class RecursiveEnvIterator:
 
 
 class LocalEnv:
+    __slots__ = ("names", "parent", "depth", "scopeName")
+
     def __init__(self, parent, scopeName=None, depth=0):
         assert parent is None or depth > 0
-        self.names = {}
+        self.names = _EMPTY_NAMES
         self.parent = parent
         self.depth = depth
         assert self.parent is None or isinstance(self.parent, LocalEnv)
@@ -437,8 +653,14 @@ class LocalEnv:
         return None
 
     def local_assign(self, key, value):
+        if self.names is _EMPTY_NAMES:
+            self.names = {}
         self.names[key] = value
 
+    def clear(self):
+        """Remove the names assigned in this scope"""
+        self.names = _EMPTY_NAMES
+
     def find_scope_with(self, key):
         if key in self.names:
             return self
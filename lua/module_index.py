@@ -0,0 +1,210 @@
+"""Index of the Lua modules that require() can find.
+
+The modules are found by scanning the directories named in a LUA_PATH
+(e.g. "c:/lib/?.lua;c:/lib/?/init.lua"), once, after which prefix
+lookups are served from memory. The index is kept up to date with
+file events from the client (workspace/didChangeWatchedFiles), or by
+polling the modification times of the scanned directories.
+
+"""
+import bisect
+import os
+import re
+import time
+
+
+def normalized(path):
+    """Path as a string, for comparing paths without touching the
+    file system.
+
+    """
+    return os.path.normcase(os.path.abspath(path))
+
+
+class PathTemplate:
+    """One of the templates in a LUA_PATH, split into the directory
+    to scan and a pattern for paths relative to it.
+
+    E.g. "c:/lib/?/init.lua" matches "c:/lib/" + "socket/init.lua"
+    for the module socket.
+
+    """
+    def __init__(self, template):
+        self.template = template
+        first = template.index("?")
+        split = max(template.rfind("/", 0, first),
+                    template.rfind("\\", 0, first))
+        self.directory = template[:split + 1] or "."
+        pattern = template[split + 1:].replace("\\", "/")
+
+        # The first "?" captures the module path, any others must
+        # repeat it (as in "?/?.lua")
+        parts = [re.escape(p) for p in pattern.split("?")]
+        regex = parts[0] + "(?P<m>[^.]+?)" + "(?P=m)".join(parts[1:])
+        self.regex = re.compile(regex + "$")
+
+    def module_name(self, relative_path):
+        """The module found at relative_path (with "/" separators), or
+        None.
+
+        """
+        mo = self.regex.match(relative_path)
+        if mo is None:
+            return None
+        return mo.group("m").replace("/", ".")
+
+
+def parse_lua_path(lua_path):
+    """Returns the PathTemplate:s in lua_path, skipping templates
+    without a "?".
+
+    """
+    return [PathTemplate(t) for t in lua_path.split(";") if "?" in t]
+
+
+class ModuleIndex:
+    """Module names to paths, for the templates in a LUA_PATH.
+
+    poll_interval is the minimum time in seconds between checks for
+    changed directories, None to not poll.
+
+    """
+    def __init__(self, lua_path, poll_interval=None):
+        self.templates = parse_lua_path(lua_path)
+        self.poll_interval = poll_interval
+        self.last_poll = None
+
+        # Templates per directory to scan
+        self.roots = {}
+        for template in self.templates:
+            root = normalized(template.directory)
+            self.roots.setdefault(root, []).append(template)
+
+        # Module name to set of (normalized) paths
+        self.modules = {}
+        self.sorted_names = []
+
+        # Root to {directory: modification time}, for polling
+        self.directories = {}
+
+        # Number of times a root was scanned, for measuring
+        self.num_scans = 0
+
+        for root in self.roots:
+            self._scan(root)
+        self.last_poll = time.monotonic()
+
+    def _add(self, name, path, keep_sorted=True):
+        paths = self.modules.get(name)
+        if paths is None:
+            paths = self.modules[name] = set()
+            if keep_sorted:
+                bisect.insort(self.sorted_names, name)
+        paths.add(path)
+
+    def _remove(self, name, path):
+        paths = self.modules.get(name)
+        if paths is None:
+            return
+        paths.discard(path)
+        if len(paths) == 0:
+            del self.modules[name]
+            del self.sorted_names[
+                bisect.bisect_left(self.sorted_names, name)]
+
+    def _names_at(self, path):
+        """Yields the module names that path is found as"""
+        for root, templates in self.roots.items():
+            prefix = os.path.join(root, "")
+            if not path.startswith(prefix):
+                continue
+            relative = path[len(prefix):].replace(os.sep, "/")
+            for template in templates:
+                name = template.module_name(relative)
+                if name is not None:
+                    yield name
+
+    def _walk(self, top, directories):
+        """Yields the (normalized) paths of the files under top, adding
+        the modification time of each directory to directories.
+
+        """
+        for directory, dirs, files in os.walk(top):
+            try:
+                directories[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for f in files:
+                yield os.path.normcase(os.path.join(directory, f))
+
+    def _scan(self, root):
+        """Add the modules found under root"""
+        self.num_scans += 1
+        directories = {}
+        for path in self._walk(root, directories):
+            for name in self._names_at(path):
+                self._add(name, path, keep_sorted=False)
+        self.directories[root] = directories
+        self.sorted_names = sorted(self.modules)
+
+    def _rescan(self, root):
+        prefix = os.path.join(root, "")
+        for name, paths in list(self.modules.items()):
+            for path in [p for p in paths if p.startswith(prefix)]:
+                self._remove(name, path)
+        self._scan(root)
+
+    def created(self, path):
+        """A file (or a directory, with everything in it) was created"""
+        path = normalized(path)
+        paths = [path]
+        if os.path.isdir(path):
+            paths = self._walk(path, {})
+        for p in paths:
+            for name in self._names_at(p):
+                self._add(name, p)
+
+    def deleted(self, path):
+        """A file (or a directory, with everything in it) was deleted"""
+        path = normalized(path)
+        prefix = os.path.join(path, "")
+        for name, paths in list(self.modules.items()):
+            for p in [p for p in paths if p == path or p.startswith(prefix)]:
+                self._remove(name, p)
+
+    def poll(self):
+        """Rescan the roots where a directory was changed, if
+        poll_interval has passed since the last check.
+
+        """
+        if self.poll_interval is None:
+            return
+        now = time.monotonic()
+        if now - self.last_poll < self.poll_interval:
+            return
+        self.last_poll = now
+
+        for root, directories in self.directories.items():
+            for directory, mtime in directories.items():
+                try:
+                    changed = os.stat(directory).st_mtime_ns != mtime
+                except OSError:
+                    changed = True
+                if changed:
+                    self._rescan(root)
+                    break
+            else:
+                if len(directories) == 0 and os.path.isdir(root):
+                    self._rescan(root)
+
+    def names_with_prefix(self, prefix):
+        """Yields the module names starting with prefix, sorted"""
+        names = self.sorted_names
+        for n in range(bisect.bisect_left(names, prefix), len(names)):
+            if not names[n].startswith(prefix):
+                break
+            yield names[n]
+
+    def paths(self, name):
+        return self.modules.get(name, set())
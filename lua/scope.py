@@ -1,4 +1,6 @@
-from . tokenize import token_str
+import bisect
+
+from . tokenize import token_str, TokenError, CATEGORIES
 from . lua_types import (
     Uninitialized,
     Number,
@@ -28,37 +30,68 @@ class Name(LuaItem):  # TODO: Needed?
         return self.t.value
 
 
+# Old value in State.journal for names that weren't assigned
+_MISSING = object()
+
+
 class State:
-    def __init__(self, tokens, g_env, file_path):
+    def __init__(self, tokens, g_env, file_path, lazy=False, recover=True):
+        self.outer = lt.LocalEnv(None, scopeName="outer")
         self.scopeStack = []
-        self.scopeStack.append((0, lt.LocalEnv(None, scopeName="outer")))
+        self.scopeStack.append(((0, 0), self.outer))
         self.g_env = g_env
         self.file_path = file_path
         self.scopes = []  # (range, scope)
+        self.spans = []  # ((line, column), (line, column)) per scope
         self.n = 0  # Token num
         self.tokens = tokens
+        self.num_tokens = len(tokens)
         self.file_returns = []
 
+        # Errors in the statements parsed so far. With recover, the
+        # statement with an error is skipped, see skip_statement,
+        # otherwise parsing stops at the first error.
+        self.errors = []
+        self.recover = recover
+
+        # Assignments to the outer scope, globals and tables, as
+        # (target, key, old value), for undoing them in rewind
+        self.journal = []
+
+        # Where parsing can be resumed, before each top-level
+        # statement: (token num, number of scopes, journal length,
+        # number of file returns, number of lazy bodies, number of
+        # errors)
+        self.checkpoints = []
+
+        # Whether to skip function bodies, see LazyBody
+        self.lazy = lazy
+        self.lazy_bodies = []
+
+        # Token num where parsing started, for measuring
+        self.start = 0
+
+        # Fields undone by detach, as (table, key, value)
+        self.detached = []
+
     def done(self):
-        return self.n == len(self.tokens)
+        return self.n == self.num_tokens
 
     def peek(self, category, value):
-        t = self.tokens[self.n]
-        return t.category == category and t.value == value
+        return (self.tokens.category(self.n) == category
+                and self.tokens.value(self.n) == value)
 
     def at(self):
-        if self.n < len(self.tokens):
-            t = self.tokens[self.n]
-            return (t.line, t.column)
-        elif len(self.tokens) == 0:
+        if self.n < self.num_tokens:
+            n = self.n
+        elif self.num_tokens == 0:
             return (0, 0)
         else:
-            t = self.tokens[-1]
-            return (t.line, t.column)
+            n = self.num_tokens - 1
+        return (self.tokens.lines[n], self.tokens.columns[n])
 
     def peek_category(self, category):
-        t = self.tokens[self.n]
-        return t.category == category
+        return self.tokens.category(self.n) == category
 
     def take(self):
         t = self.tokens[self.n]
@@ -77,24 +110,152 @@ class State:
         assert len(self.scopeStack) != 0
         return self.scopeStack[-1]
 
-    def push_scope(self, start, name):
+    def push_scope(self, start, name, column=0):
         _, top = self.inner_scope()
         new = top.push_new(scopeName=name)
-        self.scopeStack.append((start, new))
+        self.scopeStack.append(((start, column), new))
+
+    def _record(self, target, key):
+        """Add the current value of target[key] to the journal"""
+        if isinstance(target, Table):
+            names = target.fields
+        elif isinstance(target, (GlobalEnv, lt.LocalEnv)):
+            names = target.names
+        else:
+            return
+        self.journal.append((target, key, names.get(key, _MISSING)))
 
     def global_assign(self, name, value):
+        self._record(self.g_env, name)
         self.g_env[name] = value
 
     def local_assign(self, name, value):
         _, l_env = self.inner_scope()
+        if l_env is self.outer:
+            # Inner scopes are created anew when parsing is resumed
+            self._record(l_env, name)
         l_env.local_assign(name, value)
 
-    def pop_scope(self, end):
+    def table_assign(self, target, key, value):
+        self._record(target, key)
+        target[key] = value
+        self.g_env.fields_changed()
+
+    def add_returns(self, func, returns):
+        self.journal.append((func, None, list(func.returns)))
+        func.add_returns(returns)
+
+    def detach(self):
+        """Undo the assignments to fields of tables from other files,
+        which can be shared with them, e.g. tables in the globals.
+        attach assigns them again.
+
+        """
+        for target, key, old in reversed(self.journal):
+            if (isinstance(target, Table)
+                    and target.file_path != self.file_path):
+                self.detached.append(
+                    (target, key, target.fields.get(key, _MISSING)))
+                _undo(target, key, old)
+                self.g_env.fields_changed()
+
+    def attach(self):
+        """Assign the fields undone by detach again"""
+        for target, key, value in reversed(self.detached):
+            if value is _MISSING:
+                del target.fields[key]
+            else:
+                target[key] = value
+            self.g_env.fields_changed()
+        self.detached = []
+
+    def checkpoint(self):
+        self.checkpoints.append((self.n, len(self.scopes), len(self.journal),
+                                 len(self.file_returns),
+                                 len(self.lazy_bodies), len(self.errors)))
+
+    def resume(self, tokens, first_changed):
+        """Prepare for parsing tokens, which are the same as the tokens
+        parsed before up to token first_changed, from the last
+        top-level statement before that.
+
+        The scopes before it are kept, and the assignments after it
+        are undone.
+
+        """
+        self.tokens = tokens
+        self.num_tokens = len(tokens)
+
+        # A statement can depend on the token after it (e.g. whether
+        # "local x" is followed by "="), so the token at the
+        # checkpoint must be unchanged too
+        n = bisect.bisect_left(self.checkpoints, (first_changed,)) - 1
+        if n < 0:
+            checkpoint = (0, 0, 0, 0, 0, 0)
+            del self.checkpoints[:]
+        else:
+            checkpoint = self.checkpoints[n]
+            del self.checkpoints[n:]
+        (self.n, num_scopes, num_changes, num_returns, num_bodies,
+         num_errors) = checkpoint
+
+        # Also undoes what was assigned when parsing lazy bodies
+        journal = self.journal
+        while len(journal) > num_changes:
+            target, key, old = journal.pop()
+            _undo(target, key, old)
+            if isinstance(target, Table):
+                self.g_env.fields_changed()
+        self.scopes = self.scopes[:num_scopes]
+        self.spans = self.spans[:num_scopes]
+        self.file_returns = self.file_returns[:num_returns]
+        del self.errors[num_errors:]
+        del self.lazy_bodies[num_bodies:]
+        for body in self.lazy_bodies:
+            body.unparse()
+        self.scopeStack = [((0, 0), self.outer)]
+        self.start = self.n
+
+    def skip_statement(self, start):
+        """Skip the rest of the statement from token start, after an
+        error in it.
+
+        Parsing continues at the first token after the tokens taken
+        that seems to start a statement (see _starts_statement), and
+        isn't inside a block opened after start. That can be the "end"
+        closing the block around the statement.
+
+        """
+        tokens = self.tokens
+        categories = tokens.categories
+        depth = 0
+        for i in range(start, self.num_tokens):
+            if (depth == 0 and i > start and i >= self.n
+                    and _starts_statement(tokens, i)):
+                self.n = i
+                return
+            if categories[i] == _KEYWORD:
+                value = tokens.value(i)
+                if value in _BLOCK_STARTS:
+                    depth += 1
+                elif value == "end" and depth > 0:
+                    depth -= 1
+        self.n = self.num_tokens
+
+    def pop_scope(self, end, column=None):
+        """Pops the inner scope, ending at the given line and (exclusive)
+        column, or including the whole line if column is None.
+
+        """
         assert len(self.scopeStack) != 0
         start, top = self.scopeStack.pop()
         # Include terminating line
         range_end = end + 1
-        self.scopes.append((range(start, range_end), top))
+        self.scopes.append((range(start[0], range_end), top))
+        if column is None:
+            self.spans.append((start, (range_end, 0)))
+        else:
+            self.spans.append((start, (end, column)))
 
     def get_object(self, name):
         _, l_env = self.inner_scope()
@@ -111,6 +272,201 @@ class State:
         self.file_returns.append(returns)
 
 
+def _undo(target, key, old):
+    """Revert an assignment recorded by State._record, or returns added
+    by State.add_returns
+
+    """
+    if isinstance(target, Function):
+        target.returns = old
+        return
+    names = target.fields if isinstance(target, Table) else target.names
+    if old is not _MISSING:
+        names[key] = old
+    elif isinstance(target, GlobalEnv):
+        target._remove_key(key)
+    else:
+        del names[key]
+    if isinstance(target, GlobalEnv):
+        target.num_changes += 1
+
+
+class LazyBody:
+    """A function body skipped when parsing lazily, which is parsed
+    when first needed, by parse.
+
+    scope is the LocalEnv of the function, span the span of the scope,
+    and tokens first up to the "end" of the function are the body.
+
+    """
+    def __init__(self, st, func, scope, first, end):
+        self.st = st
+        self.func = func
+        self.scope = scope
+        self.first = first
+        self.end = end
+        start, _ = st.inner_scope()
+        end_column = st.tokens.columns[end] + len("end")
+        self.span = (start, (st.tokens.lines[end], end_column))
+        self.parsed = False
+
+    def parse(self):
+        """Parses the body into scope.
+
+        Returns the scopes and spans of the functions in the body, the
+        errors and the LazyBody:s of these functions, which are also
+        parsed lazily. The assignments are added to the journal of the
+        State which skipped the body, so that resuming it undoes them.
+
+        """
+        assert not self.parsed
+        self.parsed = True
+        st = self.st
+        body_st = State(st.tokens, st.g_env, st.file_path, lazy=True)
+        body_st.journal = st.journal
+        body_st.outer = None
+        body_st.scopeStack = [(self.span[0], self.scope)]
+        body_st.n = self.first
+        resolve_body(body_st, self.func)
+        return (body_st.scopes, body_st.spans, body_st.errors,
+                body_st.lazy_bodies)
+
+    def unparse(self):
+        """Forget the result of parse, whose assignments must have been
+        undone.
+
+        """
+        if self.parsed:
+            self.scope.clear()
+            self.parsed = False
+
+
+_KEYWORD = CATEGORIES.index("KEYWORD")
+_ID = CATEGORIES.index("ID")
+_COMMENT = CATEGORIES.index("COMMENT")
+
+# Keywords starting blocks closed by "end"
+_BLOCK_STARTS = ("function", "if", "do")
+
+
+def _find_end(tokens, n):
+    """Index of the "end" closing the block starting at token n, or
+    None.
+
+    """
+    categories = tokens.categories
+    depth = 0
+    for i in range(n, len(tokens)):
+        if categories[i] != _KEYWORD:
+            continue
+        value = tokens.value(i)
+        if value == "end":
+            if depth == 0:
+                return i
+            depth -= 1
+        elif value in _BLOCK_STARTS:
+            depth += 1
+    return None
+
+
+def _starts_statement(tokens, n):
+    """Whether token n seems to start a statement: "local" or "end",
+    or a name, comment, "function" or "return" first on its line.
+
+    """
+    category = tokens.categories[n]
+    if category == _KEYWORD:
+        value = tokens.value(n)
+        if value in ("local", "end"):
+            return True
+        if value not in ("function", "return"):
+            return False
+    elif category != _ID and category != _COMMENT:
+        return False
+    return n == 0 or tokens.lines[n] > tokens.lines[n - 1]
+
+
+class StreamState(State):
+    """A State which pulls the tokens from an iterator while parsing.
+
+    Only the current and the previous token are kept, in a ring
+    buffer. A TokenError from the iterator ends the tokens, and is
+    kept in token_errors. Since the tokens of a statement with an
+    error are gone, parsing stops at the first error.
+
+    """
+    RING_SIZE = 2
+
+    def __init__(self, token_iter, g_env, file_path):
+        super().__init__((), g_env, file_path, recover=False)
+        self.token_iter = token_iter
+        self.ring = [None] * self.RING_SIZE
+        self.num_read = 0
+        self.exhausted = False
+        self.token_errors = []
+
+    def _fill(self):
+        """Reads the token at n, returns False if there is none"""
+        if self.n < self.num_read:
+            return True
+        if self.exhausted:
+            return False
+        try:
+            t = next(self.token_iter)
+        except StopIteration:
+            self.exhausted = True
+            return False
+        except TokenError as e:
+            self.token_errors.append(e)
+            self.exhausted = True
+            return False
+        self.ring[self.num_read % self.RING_SIZE] = t
+        self.num_read += 1
+        return True
+
+    def _current(self):
+        if not self._fill():
+            raise IndexError("No more tokens")
+        return self.ring[self.n % self.RING_SIZE]
+
+    def drain(self):
+        """Read the remaining tokens, to find any TokenError"""
+        while self._fill():
+            self.n += 1
+
+    def done(self):
+        return not self._fill()
+
+    def peek(self, category, value):
+        t = self._current()
+        return t.category == category and t.value == value
+
+    def at(self):
+        if self._fill():
+            t = self.ring[self.n % self.RING_SIZE]
+        elif self.num_read == 0:
+            return (0, 0)
+        else:
+            t = self.ring[(self.num_read - 1) % self.RING_SIZE]
+        return (t.line, t.column)
+
+    def peek_category(self, category):
+        return self._current().category == category
+
+    def take(self):
+        t = self._current()
+        self.n += 1
+        return t
+
+    def prev(self):
+        if self.n > 0:
+            return self.ring[(self.n - 1) % self.RING_SIZE]
+        return None
+
+    def get(self):
+        return self._current()
+
+
 def resolve_field(st, comment=None):
     if not peek_assign(st):
         raise LuaError("Invalid field?", *st.at())
@@ -530,7 +886,22 @@ def resolve_arg_list(st):
 
 def resolve_body(st, func):
     while not st.done() and not peek_end(st):
-        resolve_token(st, outer_scope=False, func=func)
+        resolve_statement(st, outer_scope=False, func=func)
+
+
+def resolve_function_body(st, func):
+    """resolve_body, or if parsing lazily, skip to the "end" of the
+    function and add a LazyBody for it.
+
+    """
+    if st.lazy:
+        end = _find_end(st.tokens, st.n)
+        if end is not None:
+            _, scope = st.inner_scope()
+            st.lazy_bodies.append(LazyBody(st, func, scope, st.n, end))
+            st.n = end
+            return
+    resolve_body(st, func)
 
 
 def resolve_function(st, comment=None):
@@ -550,7 +921,7 @@ def resolve_function(st, comment=None):
     if st.done():
         raise LuaError("Unexpected EOF", *st.at())
     rp = st.take()
-    st.push_scope(rp.line, name)  # TODO: Include column + add args to scope
+    st.push_scope(rp.line, name, rp.column + 1)  # TODO: Add args to scope
 
     func = Function(
         name=name,
@@ -560,12 +931,12 @@ def resolve_function(st, comment=None):
         line_num=name_token.line,
         char_num=name_token.column,
         names=names)
-    resolve_body(st, func)
+    resolve_function_body(st, func)
 
     if not peek_end(st):
         raise LuaError("Missing end", *st.at())
     kw_end = st.take()
-    st.pop_scope(kw_end.line)
+    st.pop_scope(kw_end.line, kw_end.column + len(kw_end.value))
     return func
 
 
@@ -574,7 +945,7 @@ def resolve_anonymous_function(st, comment):
     fn = st.take()
     args = resolve_arg_list(st)
     rp = st.take()
-    st.push_scope(rp.line, f"anonymous at {fn.line}:{fn.column}")  # TODO: Include args, column # noqa: E501
+    st.push_scope(rp.line, f"anonymous at {fn.line}:{fn.column}", rp.column + 1)  # TODO: Include args # noqa: E501
     func = Function(
         name=None,
         args=args,
@@ -582,10 +953,10 @@ def resolve_anonymous_function(st, comment):
         file_path=st.file_path,
         line_num=fn.line,
         char_num=fn.column)
-    resolve_body(st, func)
+    resolve_function_body(st, func)
     assert peek_end(st)
     kw_end = st.take()
-    st.pop_scope(kw_end.line)
+    st.pop_scope(kw_end.line, kw_end.column + len(kw_end.value))
     return func
 
 
@@ -703,7 +1074,7 @@ def indexed_assign(st, index_list, value):
     but_last = index_list[:-1]
     target = get_object(st, but_last)
     name = index_list[-1]
-    target[name] = value
+    st.table_assign(target, name, value)
 
 
 def resolve_indexed_assign(st, index):
@@ -731,7 +1102,7 @@ def resolve_indexed_assign(st, index):
 
     name = index[-1]
     value = get_object(st, rhs)
-    target[name] = value
+    st.table_assign(target, name, value)
 
 
 def resolve_token(st, outer_scope=True, func=None):
@@ -803,7 +1174,7 @@ def resolve_token(st, outer_scope=True, func=None):
         else:
             returns = resolve_rhs_list(st)
             if func is not None:
-                func.add_returns(returns)
+                st.add_returns(func, returns)
             elif outer_scope:
                 st.add_file_returns(returns)
             else:
@@ -821,18 +1192,36 @@ def resolve_token(st, outer_scope=True, func=None):
         raise(LuaError(f"Unhandled token: {token_str(t2)}", *st.at()))
 
 
-def find_scopes_plus_errors(tokens, g_env, file_path):
-    assert isinstance(g_env, GlobalEnv)
-    st = State(tokens, g_env, file_path)
+def resolve_statement(st, outer_scope=True, func=None):
+    """resolve_token, adding any error to st.errors and skipping the
+    rest of the statement, if st.recover.
+
+    The scopes of functions missing their "end" end where parsing
+    continues.
+
+    """
+    start = st.n
+    num_scopes = len(st.scopeStack)
+    try:
+        resolve_token(st, outer_scope, func)
+    except (LuaError, TODOError) as e:
+        if not st.recover:
+            raise
+        st.errors.append(e)
+        st.skip_statement(start)
+        while len(st.scopeStack) > num_scopes:
+            st.pop_scope(st.at()[0])
 
-    errors = []
+
+def _find_scopes(st):
     try:
-        while st.n < len(tokens):
-            resolve_token(st)
+        while not st.done():
+            st.checkpoint()
+            resolve_statement(st)
     except LuaError as e:
-        errors.append(e)
+        st.errors.append(e)
     except TODOError as e:
-        errors.append(e)
+        st.errors.append(e)
 
     # Pop file scope
     prev = st.prev()
@@ -840,9 +1229,64 @@ def find_scopes_plus_errors(tokens, g_env, file_path):
     epicycle = 1
     st.pop_scope(last_token_line + epicycle)
 
-    return st.scopes, errors
+    return st.scopes, list(st.errors), st.spans
+
+
+def find_scopes_plus_errors(tokens, g_env, file_path, recover=True):
+    """Returns the scopes, errors and the span (start and end position)
+    of each scope.
+
+    With recover, a statement with an error is skipped, otherwise
+    parsing stops at the first error.
+
+    """
+    assert isinstance(g_env, GlobalEnv)
+    return _find_scopes(State(tokens, g_env, file_path, recover=recover))
+
+
+def find_scopes_resumable(tokens, g_env, file_path, previous=None,
+                          first_changed=0, lazy=False):
+    """Like find_scopes_plus_errors, but also returns the State, which
+    can be given as previous for parsing the tokens again after they
+    have changed from token first_changed.
+
+    With lazy, function bodies are skipped, and added to the
+    lazy_bodies of the State, see LazyBody. tokens must then not be
+    changed while they can be parsed, other than by resuming.
+
+    Parsing then resumes from the last top-level statement before the
+    change, with the scopes before it reused. The result is the same as
+    from parsing all of the tokens, as long as the globals not assigned
+    in the file are unchanged. g_env must be the one given for
+    previous, and neither previous nor the scopes from it can be used
+    afterwards.
+
+    """
+    assert isinstance(g_env, GlobalEnv)
+    if previous is None:
+        st = State(tokens, g_env, file_path, lazy)
+    else:
+        assert previous.g_env is g_env and previous.lazy == lazy
+        st = previous
+        st.resume(tokens, first_changed)
+    scopes, errors, spans = _find_scopes(st)
+    return scopes, errors, spans, st
+
+
+def find_scopes_in_stream(token_iter, g_env, file_path):
+    """Like find_scopes_plus_errors, but pulls the tokens from
+    token_iter while parsing.
+
+    Returns the scopes, errors, spans and TokenError:s.
+
+    """
+    assert isinstance(g_env, GlobalEnv)
+    st = StreamState(token_iter, g_env, file_path)
+    scopes, errors, spans = _find_scopes(st)
+    st.drain()
+    return scopes, errors, spans, st.token_errors
 
 
 def find_scopes(*args):
-    scopes, errors = find_scopes_plus_errors(*args)
+    scopes, errors, spans = find_scopes_plus_errors(*args)
     return scopes
@@ -1,4 +1,7 @@
+from array import array
+import bisect
 import collections
+import re
 import lua.lua_re as lua_re
 
 # Based on the pretty neat example at
@@ -13,50 +16,340 @@ Token = collections.namedtuple(
 
 
 class TokenError(Exception):
-    def __init__(self, value, line, column):
+    def __init__(self, value, line, column, offset=None):
         super().__init__(self, f'Unexpected "{value}" at {line}:{column}')
         self.value = value
         self.line = line
         self.column = column
+        self.offset = offset  # Position in the text
 
 
-def read_next(text):
-    line_num = 0
-    line_start = 0
-    for mo in lua_re.TOKEN.finditer(text):
+# Category names, indexed by the category ids in TokenBuffer
+CATEGORIES = [name for name, _ in lua_re.token_specification] + ["KEYWORD"]
+_CATEGORY_ID = {name: n for n, name in enumerate(CATEGORIES)}
+_KEYWORD_ID = _CATEGORY_ID["KEYWORD"]
+_KEYWORDS = frozenset(lua_re.keywords)
+
+
+class TokenBuffer:
+    """The tokens for a text, stored column-wise in arrays.
+
+    Indexing gives Token:s, with the value sliced from the text.
+
+    The start offset of a token is the start of its line (as counted
+    by the tokenizer, see line_starts) plus its column, so that the
+    columns don't change when text before the line is edited.
+
+    """
+    def __init__(self, text, line_starts=None):
+        self.text = text
+
+        # Start offset for each line as counted by the tokenizer,
+        # where a line break inside a string doesn't start a new line.
+        self.line_starts = [0] if line_starts is None else line_starts
+
+        self.categories = array('i')
+        self.lines = array('i')
+        self.columns = array('i')
+        self.lengths = array('i')
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, n):
+        if type(n) is slice:
+            return [self[i] for i in range(*n.indices(len(self)))]
+        line = self.lines[n]
+        column = self.columns[n]
+        start = self.line_starts[line] + column
+        return Token(
+            CATEGORIES[self.categories[n]],
+            self.text[start:start + self.lengths[n]],
+            line,
+            column)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def __eq__(self, other):
+        if not isinstance(other, TokenBuffer):
+            return list(self) == list(other)
+        return (self.categories == other.categories
+                and self.lines == other.lines
+                and self.columns == other.columns
+                and self.lengths == other.lengths
+                and all(self.value(n) == other.value(n)
+                        for n in range(len(self))))
+
+    def category(self, n):
+        return CATEGORIES[self.categories[n]]
+
+    def value(self, n):
+        start = self.line_starts[self.lines[n]] + self.columns[n]
+        return self.text[start:start + self.lengths[n]]
+
+    def first_on_line(self, line):
+        """Index of the first token on or after line"""
+        return bisect.bisect_left(self.lines, line)
+
+    def replace(self, first, last, other, line_shift):
+        """Replace the tokens first to last with the tokens in other,
+        adding line_shift to the line of the tokens after.
+
+        """
+        self.categories[first:last] = other.categories
+        self.columns[first:last] = other.columns
+        self.lengths[first:last] = other.lengths
+        if line_shift == 0:
+            self.lines[first:last] = other.lines
+        else:
+            lines = self.lines
+            self.lines = lines[:first] + other.lines + array(
+                'i', [line + line_shift for line in lines[last:]])
+
+
+def _read(text, pos, line_num, line_start, column, tokens):
+    """Appends the tokens from pos in text to the TokenBuffer tokens,
+    and yields the start offset of each new line.
+
+    line_num and line_start are the line number and start offset for
+    the line containing pos (as counted by the tokenizer), column the
+    column of the preceding token.
+
+    """
+    add_category = tokens.categories.append
+    add_line = tokens.lines.append
+    add_column = tokens.columns.append
+    add_length = tokens.lengths.append
+    category_id = _CATEGORY_ID
+
+    for mo in lua_re.TOKEN.finditer(text, pos):
         kind = mo.lastgroup
-        value = mo.group(kind)
         if kind == 'NEWLINE':
             line_start = mo.end()
             line_num += 1
+            yield line_start
         elif kind == 'SKIP':
             pass
         elif kind == 'MISMATCH':
             # TODO: Store current state
-            raise TokenError(value, line_num, column)
+            # TODO: The column is that of the preceding token
+            raise TokenError(mo.group(kind), line_num, column, mo.start())
         else:
-            if kind == 'ID' and value in lua_re.keywords:
-                kind = "KEYWORD"
-            column = mo.start() - line_start
-            yield Token(kind, value, line_num, column)
+            start, end = mo.span()
+            if kind == 'ID' and text[start:end] in _KEYWORDS:
+                add_category(_KEYWORD_ID)
+            else:
+                add_category(category_id[kind])
+            column = start - line_start
+            add_line(line_num)
+            add_column(column)
+            add_length(end - start)
 
 
-def tokenize(text):
-    tokens = []
+def _collect(tokens, line_start_iter):
+    """Reads tokens from the _read-generator, returns the errors"""
     errors = []
     try:
-        for t in read_next(text):
-            tokens.append(t)
+        for line_start in line_start_iter:
+            tokens.line_starts.append(line_start)
     except TokenError as e:
         # Note: List will have zero or one error, since the iteration
         # stops, which is probably for the best (the mismatch could be
         # passed on to allow for more context, but that would make the
         # later stages more complicated).
         errors.append(e)
+    return errors
+
 
+def tokenize(text):
+    """Returns a TokenBuffer and a list of TokenError:s"""
+    tokens = TokenBuffer(text)
+    errors = _collect(tokens, _read(text, 0, 0, 0, 0, tokens))
     return tokens, errors
 
 
+def read_next(text):
+    """Yields the Token:s in text, one at a time.
+
+    Raises TokenError for an unexpected character.
+
+    """
+    line_num = 0
+    line_start = 0
+    column = 0
+    for mo in lua_re.TOKEN.finditer(text):
+        kind = mo.lastgroup
+        if kind == 'NEWLINE':
+            line_start = mo.end()
+            line_num += 1
+        elif kind == 'SKIP':
+            pass
+        elif kind == 'MISMATCH':
+            raise TokenError(mo.group(kind), line_num, column, mo.start())
+        else:
+            value = mo.group(kind)
+            if kind == 'ID' and value in _KEYWORDS:
+                kind = "KEYWORD"
+            column = mo.start() - line_start
+            yield Token(kind, value, line_num, column)
+
+
+def _line_starts(text):
+    return [0] + [mo.end() for mo in re.finditer("\n", text)]
+
+
+def _index_of(items, value):
+    """Index of value in the sorted list items, or None"""
+    n = bisect.bisect_left(items, value)
+    if n < len(items) and items[n] == value:
+        return n
+    return None
+
+
+class IncrementalTokenizer:
+    """Tokens for a text that is edited.
+
+    After an edit, the text is re-tokenized from the start of the
+    first affected line until the tokens are in sync with the
+    previous tokens, whose remainder is then reused, with line numbers
+    shifted.
+
+    The tokens and errors are the same as from tokenize(text).
+
+    """
+    def __init__(self, text):
+        self.reset(text)
+
+    def reset(self, text):
+        self.text = text
+
+        # Start offset for each line in text
+        self.line_starts = _line_starts(text)
+
+        self.tokens, self.errors = tokenize(text)
+
+        # The first token changed since clear_changes, e.g. for
+        # resuming parsing before it
+        self.first_changed = 0
+
+    def clear_changes(self):
+        self.first_changed = len(self.tokens)
+
+    @property
+    def token_line_starts(self):
+        """Where the tokenizer can be restarted"""
+        return self.tokens.line_starts
+
+    def apply_change(self, change):
+        """Apply a TextDocumentContentChangeEvent"""
+        if change.range is None:
+            self.reset(change.text)
+        else:
+            self.edit(
+                self._offset(change.range.start),
+                self._offset(change.range.end),
+                change.text)
+
+    def _offset(self, position):
+        if position.line >= len(self.line_starts):
+            return len(self.text)
+        start = self.line_starts[position.line]
+        if position.line + 1 < len(self.line_starts):
+            end = self.line_starts[position.line + 1] - 1
+        else:
+            end = len(self.text)
+        return start + min(position.character, end - start)
+
+    def edit(self, start, end, new_text):
+        """Replace text[start:end] with new_text"""
+        delta = len(new_text) - (end - start)
+        text = self.text[:start] + new_text + self.text[end:]
+
+        # Lines starting inside the replaced text are removed
+        line_starts = self.line_starts
+        self.line_starts = (
+            line_starts[:bisect.bisect_right(line_starts, start)]
+            + [start + mo.end() for mo in re.finditer("\n", new_text)]
+            + [s + delta
+               for s in line_starts[bisect.bisect_right(line_starts, end):]])
+
+        self._retokenize(text, start, end, delta)
+        self.text = text
+
+    def _retokenize(self, text, start, end, delta):
+        tokens = self.tokens
+        token_line_starts = tokens.line_starts
+
+        # An unmatched character ends the tokenizing. Whether it is
+        # unmatched can depend on later text (an unterminated string),
+        # so restart before it.
+        if len(self.errors) != 0:
+            start = min(start, self.errors[0].offset)
+
+        line = bisect.bisect_right(token_line_starts, start) - 1
+        pos = token_line_starts[line]
+        first = tokens.first_on_line(line)
+        column = tokens.columns[first - 1] if first > 0 else 0
+
+        self.first_changed = min(self.first_changed, first)
+
+        edit_end = end + delta
+        new_tokens = TokenBuffer(text)
+        new_line_starts = []
+        sync = None
+        error = None
+        try:
+            for new_start in _read(text, pos, line, pos, column, new_tokens):
+                new_line_starts.append(new_start)
+                # Check if the new line starts where a line started
+                # before the edit, after which the tokens would be the
+                # same
+                if new_start >= edit_end:
+                    old_line = self._sync_line(new_start - delta)
+                    if old_line is not None:
+                        sync = (line + len(new_line_starts), old_line)
+                        break
+        except TokenError as e:
+            error = e
+
+        tokens.text = text
+        if sync is None:
+            tokens.replace(first, len(tokens), new_tokens, 0)
+            tokens.line_starts = (
+                token_line_starts[:line + 1] + new_line_starts)
+            self.errors = [] if error is None else [error]
+            return
+
+        new_line, old_line = sync
+        shift = new_line - old_line
+        old_first = tokens.first_on_line(old_line)
+        tokens.replace(first, old_first, new_tokens, shift)
+        tokens.line_starts = (
+            token_line_starts[:line + 1]
+            + new_line_starts[:-1]
+            + [s + delta for s in token_line_starts[old_line:]])
+        self.errors = [
+            TokenError(e.value, e.line + shift, e.column, e.offset + delta)
+            for e in self.errors]
+
+    def _sync_line(self, old_start):
+        """Returns the line that started at old_start before the edit, if
+        tokenizing can resume there.
+
+        """
+        line = _index_of(self.tokens.line_starts, old_start)
+        if line is None:
+            return None
+        if len(self.errors) != 0:
+            if self.tokens.first_on_line(line) == len(self.tokens):
+                # The error would be reported with the column of a
+                # token before the line, which may have changed
+                return None
+        return line
+
+
 def token_str(t):
     if t.category in lua_re.keywords:
         return f"{t.line}:{t.column} Keyword {t.category}"
@@ -1,3 +1,6 @@
 from lua import lua_server
 
-lua_server.run()
+# The guard keeps worker processes (see --load-workers) from starting
+# servers of their own
+if __name__ == '__main__':
+    lua_server.run()
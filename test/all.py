@@ -7,6 +7,13 @@ from . import test_build_lua_doc
 from . import test_annotation
 from . import test_invalid
 from . import test_tokenize
+from . import test_parser
+from . import test_async_server
+from . import test_diagnostics
+from . import test_stats
+from . import test_fuzzy
+from . import test_module_index
+from . import test_load_modules
 
 print_env = False
 
@@ -19,3 +26,10 @@ test_build_lua_doc.run(print_env)
 test_annotation.run(print_env)
 test_invalid.run(print_env)
 test_tokenize.run(print_env)
+test_parser.run(print_env)
+test_async_server.run(print_env)
+test_diagnostics.run(print_env)
+test_stats.run(print_env)
+test_fuzzy.run(print_env)
+test_module_index.run(print_env)
+test_load_modules.run(print_env)
@@ -1,7 +1,43 @@
-from lua.tokenize import tokenize
+"""Rough timing of parts of the server.
+
+Run all benchmarks (in the repository root folder) with:
+  python -m test.benchmark
+
+or only some of them, e.g.:
+  python -m test.benchmark tokenize framing
+
+"""
+import glob
+import io
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from lua.tokenize import tokenize, IncrementalTokenizer
 from time import time
 import lua.build_lua_doc as build_lua_doc
 import lua.lua_types as lt
+from lsp.parser import FrameReader, stream_read_f
+from lsp.util import make_header, make_notification, make_response
+from lsp.lsp_defs import Position, Range, TextDocumentContentChangeEvent
+from lsp.log import NullLog
+from lsp_server.doc import Document, lines_from_text
+from lua.lua_db import (
+    LuaDB,
+    complete_require,
+    complete_single,
+    complete_single_fuzzy,
+    make_completion,
+    make_file_completion,
+)
+from lua.module_index import ModuleIndex
+from lua.load_modules import ModuleCache, load_modules
+from lua import lua_re
+from pathlib import Path
+from lua.lua_doc import EMPTY_ENV
+from lua.cmdline import get_default_lua_server_options
+from lua import fuzzy
 
 
 def read_file(file_path):
@@ -40,11 +76,813 @@ def bench_build_lua_doc(file_path):
         print(f"{n}: {item:.3f}s")
 
 
-if __name__ == '__main__':
+def bench_comment_docs(file_path):
+    """Time for reading the file, and then for the documentation and
+    signatures of all of its functions, as for hovering every one.
+
+    """
+    text = read_file(file_path)
+
+    def functions(item):
+        if isinstance(item, lt.Function):
+            yield item
+        elif isinstance(item, lt.Table):
+            for key in item:
+                yield from functions(item[key])
+
+    best_read = best_docs = None
+    for n in range(3):
+        g_env = lt.GlobalEnv()
+        start = time()
+        build_lua_doc.read_lua(text, g_env, file_path)
+        read = time() - start
+        funcs = [f for key in g_env if key != "_G"
+                 for f in functions(g_env[key])]
+        start = time()
+        for f in funcs:
+            f.get_doc()
+            f.signature_str()
+        docs = time() - start
+        best_read = read if best_read is None else min(best_read, read)
+        best_docs = docs if best_docs is None else min(best_docs, docs)
+
+    print(f"{file_path}: {len(funcs)} functions")
+    print(f"read: {best_read * 1000:.0f}ms, "
+          f"all docs: {best_docs * 1000:.0f}ms")
+
+
+def bench_resumed_parse(file_path):
+    """Parsing after an edit near the end of the file, from the start
+    and resumed from the statement before the edit.
+
+    """
+    text = read_file(file_path)
+    offset = text.rindex("\nfunction ") + 1
+    edit = "local inserted = 1\n"
+
+    def timed(resume):
+        best = None
+        for n in range(3):
+            tokenizer = IncrementalTokenizer(text)
+            g_env = lt.GlobalEnv()
+            doc, state = build_lua_doc.read_lua_tokens_resumable(
+                tokenizer.tokens, tokenizer.errors, g_env, file_path)
+            tokenizer.clear_changes()
+            tokenizer.edit(offset, offset, edit)
+            start = time()
+            if resume:
+                doc, state = build_lua_doc.read_lua_tokens_resumable(
+                    tokenizer.tokens, tokenizer.errors, g_env, file_path,
+                    state, tokenizer.first_changed)
+            else:
+                doc, state = build_lua_doc.read_lua_tokens_resumable(
+                    tokenizer.tokens, tokenizer.errors, lt.GlobalEnv(),
+                    file_path)
+            elapsed = time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000, state.n - state.start
+
+    print(f"{file_path}: edit at line {text.count(chr(10), 0, offset)}")
+    for label, resume in (("full", False), ("resumed", True)):
+        ms, num_tokens = timed(resume)
+        print(f"{label}: {ms:.1f}ms, {num_tokens} tokens parsed")
+
+
+def bench_recovery(label, texts):
+    """Scopes and globals read from the texts when parsing stops at
+    the first error, and when statements with errors are skipped.
+
+    """
+    print(f"{label}: {len(texts)} files")
+    for mode, recover in (("stop", False), ("recover", True)):
+        num_scopes = num_globals = num_errors = 0
+        start = time()
+        for text in texts:
+            g_env = lt.GlobalEnv()
+            doc = build_lua_doc.read_lua(text, g_env, recover=recover)
+            num_scopes += len(doc.scopes)
+            num_globals += len(g_env) - 1  # Not _G
+            num_errors += len(doc.errors)
+        elapsed = time() - start
+        print(f"{mode}: {num_scopes} scopes, {num_globals} globals, "
+              f"{num_errors} errors, {elapsed * 1000:.1f}ms")
+
+
+def bench_first_completion(label, text):
+    """Time from didOpen to the first completion inside the last
+    function, with function bodies parsed when read or when needed.
+
+    """
+    offset = text.rindex("end")
+    line = text.count("\n", 0, offset)
+    position = Position(line, offset - text.rindex("\n", 0, offset) - 1)
+    print(f"{label}: {text.count(chr(10))} lines, completion at line {line}")
+    for mode, lazy in (("eager", False), ("lazy", True)):
+        options = get_default_lua_server_options()
+        options.lazy_function_bodies = lazy
+        best = None
+        for n in range(3):
+            db = LuaDB("", lt.GlobalEnv(), NullLog(), options)
+            doc = Document("file:///first_completion.lua", text)
+            start = time()
+            db.didOpen(doc)
+            db.completions(doc, position)
+            elapsed = time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        bodies = db.lua_docs[doc.uri].num_parsed_bodies
+        print(f"{mode}: {best * 1000:.1f}ms, {bodies} bodies parsed later")
+
+
+def _framed(message):
+    message = message.encode("utf-8")
+    return make_header(message) + message
+
+
+def bench_framing(label, data, num_messages):
+    times = []
+    for i in range(3):
+        reader = FrameReader(stream_read_f(io.BytesIO(data)))
+        start = time()
+        count = sum(1 for _ in reader)
+        end = time()
+        assert count == num_messages
+        times.append(end - start)
+
+    print(label)
+    for n, item in enumerate(times):
+        print(f"{n}: {item:.3f}s ({num_messages / item:.0f} messages/s)")
+
+
+def bench_framing_small():
+    num_messages = 10000
+    change = _framed(make_notification("textDocument/didChange", {
+        "textDocument": {"uri": "file:///a.lua", "version": 1},
+        "contentChanges": [{
+            "range": {"start": {"line": 1, "character": 2},
+                      "end": {"line": 1, "character": 2}},
+            "text": "x"}]}))
+    bench_framing(
+        f"{num_messages} didChange notifications",
+        change * num_messages,
+        num_messages)
+
+
+def bench_framing_large():
+    num_messages = 20
+    did_open = _framed(make_notification("textDocument/didOpen", {
+        "textDocument": {
+            "uri": "file:///a.lua",
+            "languageId": "lua",
+            "version": 0,
+            "text": "x" * (1024 * 1024)}}))
+    bench_framing(
+        f"{num_messages} 1 MB didOpen notifications",
+        did_open * num_messages,
+        num_messages)
+
+
+def type_changes(line, character, text):
+    """Single character insertions, as sent when typing text"""
+    changes = []
+    for n, c in enumerate(text):
+        pos = Position(line=line, character=character + n)
+        changes.append(
+            [TextDocumentContentChangeEvent(range=Range(pos, pos), text=c)])
+    return changes
+
+
+def bench_keystroke_storm(file_path, num_keys):
+    """Type num_keys characters into the file, then request a
+    completion. Compare with reading the document after every change
+    (as done before documents were read lazily).
+
+    """
+    text = read_file(file_path)
+    changes = type_changes(line=0, character=0, text="x" * num_keys)
+
+    def storm(read_every_change):
+        db = LuaDB("", lt.GlobalEnv(), NullLog())
+        doc = Document("file:///storm.lua", text)
+        db.didOpen(doc)
+        count = db.parse_count
+        start = time()
+        for version, change in enumerate(changes, start=1):
+            doc.contentChanges(change, version)
+            db.didChange(doc, change)
+            if read_every_change:
+                db.get_lua_doc(doc)
+        db.completions(doc, Position(line=0, character=num_keys))
+        end = time()
+        return end - start, db.parse_count - count
+
+    print(f"{file_path}: {num_keys} keystrokes, then completion")
+    for label, read_every_change in (("eager", True), ("lazy", False)):
+        duration, parses = storm(read_every_change)
+        print(f"{label}: {duration:.3f}s, {parses} parse(s)")
+
+
+class ListDocument:
+    """Document as done before lsp_server.doc.Lines, with the lines in a
+    list and the text joined for every getText
+
+    """
+    def __init__(self, text):
+        self.lines = lines_from_text(text)
+
+    def contentChanges(self, changes, version):
+        for ch in changes:
+            lines = self.lines
+            rng = ch.range
+            new_content = ch.text.split("\n")
+            pre = lines[rng.start.line][:rng.start.character]
+            post = lines[rng.end.line][rng.end.character:]
+            new_content[0] = pre + new_content[0]
+            new_content[-1] = new_content[-1] + post
+            del lines[rng.start.line:rng.end.line + 1]
+            for i in range(len(new_content)):
+                lines.insert(rng.start.line + i, new_content[i])
+
+    def getText(self):
+        return "\n".join(self.lines)
+
+
+def bench_document_edits(file_path):
+    """Edits on the list of lines and on Lines, with or without
+    getText after each edit, and on Lines with a snapshot taken after
+    each edit (as for publishing diagnostics).
+
+    """
+    text = read_file(file_path)
+    num_lines = text.count("\n")
+    middle = Position(line=num_lines // 2, character=0)
+    paste = "".join(f"local pasted_{n} = {n}\n" for n in range(5000))
+
+    def change(start, end, new_text):
+        return [TextDocumentContentChangeEvent(Range(start, end), new_text)]
+
+    edits = (
+        ("typing 200 characters", 1,
+         type_changes(line=num_lines // 2, character=0, text="x" * 200)),
+        ("pasting 5000 lines", 4,
+         [change(middle, middle, paste)]),
+        ("deleting 5000 lines", 4,
+         [change(Position(line=1000, character=0),
+                 Position(line=6000, character=0), "")]),
+        ("pasting 5000 lines, line by line", 1,
+         [change(Position(line=num_lines // 2 + n, character=0),
+                 Position(line=num_lines // 2 + n, character=0),
+                 f"local pasted_{n} = {n}\n")
+          for n in range(5000)]))
+
+    def timed(make_doc, changes, repeat, get_text, snapshot=False):
+        best = None
+        for n in range(repeat):
+            doc = make_doc(text)
+            doc.getText()
+            start = time()
+            for version, ch in enumerate(changes, start=1):
+                doc.contentChanges(ch, version)
+                reader = doc.snapshot() if snapshot else doc
+                if get_text:
+                    reader.getText()
+            elapsed = time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000
+
+    print(f"{file_path}: {num_lines} lines")
+    for label, repeat, changes in edits:
+        for get_text in (False, True):
+            def make_doc(text):
+                return Document("file:///edits.lua", text)
+
+            times = [timed(ListDocument, changes, repeat, get_text),
+                     timed(make_doc, changes, repeat, get_text),
+                     timed(make_doc, changes, repeat, get_text, True)]
+            print(f"{label}{', getText' if get_text else ''}:"
+                  f" list {times[0]:.1f}ms, Lines {times[1]:.1f}ms,"
+                  f" snapshots {times[2]:.1f}ms")
+
+
+def bench_token_memory(file_path):
+    """Peak memory allocated while tokenizing, and the memory held by
+    the tokens.
+
+    """
+    text = read_file(file_path)
+    tracemalloc.start()
+    tokens, errors = tokenize(text)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{file_path}: {len(tokens)} tokens")
+    print(f"held: {current / 1024:.0f} KiB, peak: {peak / 1024:.0f} KiB")
+
+
+def bench_model_memory(label, text):
+    """Memory held by the LuaDoc and globals read from already
+    tokenized text, per line.
+
+    """
+    tokens, token_errors = tokenize(text)
+    num_lines = text.count("\n") + 1
+    tracemalloc.start()
+    g_env = lt.GlobalEnv()
+    doc = build_lua_doc.read_lua_tokens(tokens, token_errors, g_env)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: {num_lines} lines, {len(doc.scopes)} scopes, "
+          f"{len(g_env)} globals")
+    print(f"held: {current / 1024:.0f} KiB, "
+          f"{current / num_lines:.0f} bytes per line")
+
+
+def synthetic_lua(num_lines):
+    """Lua source code with about num_lines lines"""
+    block = """-- Function number {n}
+function f{n}(a, b)
+  local x = a
+  local t = {{
+    y = b,
+    z = 42}}
+  return x
+end
+
+"""
+    num_block_lines = block.count("\n")
+    return "".join(block.format(n=n)
+                   for n in range(num_lines // num_block_lines))
+
+
+def bench_streaming(num_lines):
+    """Time and peak memory for reading a LuaDoc, with all tokens
+    first or with streamed tokens.
+
+    """
+    text = synthetic_lua(num_lines)
+    print(f"{text.count(chr(10))} lines, {len(text) // 1024} KiB")
+    for label, read_f in (("tokens first", build_lua_doc.read_lua),
+                          ("streaming", build_lua_doc.read_lua_streaming)):
+        start = time()
+        read_f(text, lt.GlobalEnv())
+        duration = time() - start
+
+        tracemalloc.start()
+        read_f(text, lt.GlobalEnv())
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label}: {duration:.3f}s, peak {peak / 2**20:.1f} MiB")
+
+
+def linear_scope_at(lua_doc, pos):
+    """Narrowest scope by linear search, as LuaDoc.scope_at was done
+    before indexing
+
+    """
+    narrowest = None
+    for r, scope in lua_doc.scopes:
+        if pos.line in r:
+            if narrowest is None or len(r) < len(narrowest[0]):
+                narrowest = (r, scope)
+    return None if narrowest is None else narrowest[1]
+
+
+def bench_scope_at(file_path, num_lookups):
+    text = read_file(file_path)
+    lua_doc = build_lua_doc.read_lua(text, lt.GlobalEnv(), file_path)
+    num_lines = text.count("\n") + 1
+    positions = [Position(line=(n * 7919) % num_lines, character=0)
+                 for n in range(num_lookups)]
+    print(f"{file_path}: {len(lua_doc.scopes)} scopes, "
+          f"{num_lookups} lookups")
+
+    start = time()
+    for pos in positions:
+        linear_scope_at(lua_doc, pos)
+    print(f"linear: {time() - start:.3f}s")
+
+    start = time()
+    lua_doc.scope_at(positions[0])
+    print(f"index build: {time() - start:.3f}s")
+
+    start = time()
+    for pos in positions:
+        lua_doc.scope_at(pos)
+    print(f"indexed: {time() - start:.3f}s")
+
+
+def scanning_complete_single(prefix, g_env, l_env):
+    """complete_single as done before GlobalEnv.keys_with_prefix"""
+    local_keys = [key for key in l_env.recursive_names()
+                  if key.startswith(prefix)]
+    local_completions = [make_completion(key, l_env[key])
+                         for key in local_keys]
+
+    global_completions = [make_completion(key, g_env[key])
+                          for key in g_env
+                          if key != "_G" and key.startswith(prefix)
+                          and key not in local_keys]
+    return local_completions + global_completions
+
+
+def bench_complete_single(num_globals, num_locals):
+    g_env = lt.GlobalEnv()
+    for n in range(num_globals):
+        g_env[f"global_{n * 7919 % num_globals}"] = lt.Number(n, None)
+    l_env = lt.LocalEnv(None, "outer")
+    for n in range(num_locals):
+        l_env.local_assign(f"global_{n}", lt.Number(n, None))
+
+    # First query sorts the names
+    start = time()
+    g_env.keys_with_prefix("")
+    print(f"{num_globals} globals, {num_locals} locals, "
+          f"sorting: {(time() - start) * 1000:.1f}ms")
+
+    for prefix in ("global_1234", "global_12", "x"):
+        for label, complete_f in (("scan", scanning_complete_single),
+                                  ("index", complete_single)):
+            start = time()
+            items = complete_f(prefix, g_env, l_env)
+            duration = time() - start
+            print(f"{prefix}: {label} {duration * 1000:.2f}ms, "
+                  f"{len(items)} items")
+
+
+def bench_fuzzy_completion(file_path, queries, limit):
+    """Latency and JSON response size for completing global names
+    from the file, with prefix matching (all matches) and fuzzy
+    matching (the limit best matches).
+
+    """
+    g_env = lt.GlobalEnv()
+    build_lua_doc.read_file(file_path, g_env)
+    _bench_fuzzy_completion(g_env, file_path, queries, limit)
+
+    # Also with every name in the file as a global, as for a large
+    # library
+    g_env = lt.GlobalEnv()
+    tokens, errors = tokenize(read_file(file_path))
+    for t in tokens:
+        if t.category == "ID":
+            g_env[t.value] = lt.Unknown(t.value, file_path)
+    _bench_fuzzy_completion(
+        g_env, f"{file_path} (all names)", queries, limit)
+
+
+def _bench_fuzzy_completion(g_env, label, queries, limit):
+    l_env = EMPTY_ENV
+    index = fuzzy.CandidateIndex()
+    start = time()
+    index.sync(g_env)
+    print(f"{label}: {len(g_env)} globals, "
+          f"fuzzy index: {(time() - start) * 1000:.1f}ms")
+
+    def prefix_f(query):
+        return complete_single(query, g_env, l_env)
+
+    def fuzzy_f(query):
+        return complete_single_fuzzy(query, g_env, l_env, index, limit)
+
+    for query in queries:
+        for label, complete_f in (("prefix", prefix_f), ("fuzzy", fuzzy_f)):
+            start = time()
+            result = complete_f(query)
+            payload = json.dumps(make_response(1, result))
+            duration = time() - start
+            num_items = len(result if isinstance(result, list)
+                            else result.items)
+            print(f"{query!r} {label}: {duration * 1000:.2f}ms, "
+                  f"{num_items} items, {len(payload) // 1024} KiB")
+
+
+def bench_completion_cache(num_fields, word):
+    """Latency per keystroke when typing word after "lib.", where lib
+    is a table with num_fields fields, with and without reusing the
+    completions for the previous keystroke.
+
+    """
+    table = lt.Table(None)
+    for n in range(num_fields):
+        # Names starting with varying letters, so that each keystroke
+        # narrows down the matches
+        name = "".join(chr(ord("a") + (n // 26 ** i) % 26) for i in range(4))
+        table[f"{name}_{n}"] = lt.Number(n, None)
+    changes = type_changes(line=1, character=4, text=word)
+
+    def typing(enable_cache):
+        options = get_default_lua_server_options()
+        options.enable_completion_cache = enable_cache
+        g_env = lt.GlobalEnv()
+        g_env["lib"] = table
+        db = LuaDB("", g_env, NullLog(), options)
+        doc = Document("file:///typing.lua", "local x = 1\nlib.")
+        db.didOpen(doc)
+        times = []
+        for version, change in enumerate(changes, start=1):
+            start = time()
+            doc.contentChanges(change, version)
+            db.didChange(doc, change)
+            db.completions(doc, Position(line=1, character=4 + version))
+            times.append(time() - start)
+        return times
+
+    print(f"Typing lib.{word}, {num_fields} fields (best of 5)")
+    for label, enable_cache in (("no cache", False), ("cache", True)):
+        times = [min(t) for t in zip(*[typing(enable_cache)
+                                       for i in range(5)])]
+        print(f"{label}: first {times[0] * 1000:.2f}ms, later "
+              + ", ".join(f"{t * 1000:.2f}" for t in times[1:]) + "ms")
+
+
+def scanning_complete_require(current_file, prefix_full, lua_path):
+    """complete_require as done before ModuleIndex, listing the
+    directories for each completion
+
+    """
+    prefix = lua_re.match_require(prefix_full).group(2)
+    candidates = []
+    for p in [Path(p[:-5]) for p in lua_path.split(";")
+              if p.endswith("?.lua")]:
+        if p.exists() and p.is_dir():
+            for f in p.iterdir():
+                if (f.is_file() and f.name.startswith(prefix)
+                        and not f.samefile(current_file)):
+                    candidates.append(f.stem)
+    return [make_file_completion(c) for c in candidates]
+
+
+def bench_require_completion(num_files, word):
+    """Completion per keystroke when typing require("word, with
+    num_files modules in the LUA_PATH.
+
+    """
+    with tempfile.TemporaryDirectory() as root:
+        for n in range(num_files):
+            if n % 10 == 0:
+                os.mkdir(os.path.join(root, f"pkg_{n}"))
+                path = os.path.join(root, f"pkg_{n}", "init.lua")
+            else:
+                path = os.path.join(root, f"mod_{n}.lua")
+            open(path, "w").close()
+        current_file = Path(root, "mod_1.lua")
+        uri = current_file.as_uri()
+        lua_path = f"{root}/?.lua;{root}/?/init.lua"
+        prefixes = [f'require("{word[:n]}' for n in range(1, len(word) + 1)]
+
+        def per_keystroke(label, complete):
+            times = []
+            for prefix in prefixes:
+                start = time()
+                complete(prefix)
+                times.append(time() - start)
+            print(f"{label}: " + ", ".join(f"{t * 1000:.2f}" for t in times)
+                  + "ms")
+
+        print(f"Typing require(\"{word}, {num_files} module files")
+        per_keystroke("scanning", lambda prefix: scanning_complete_require(
+            current_file, prefix, lua_path))
+
+        start = time()
+        index = ModuleIndex(lua_path)
+        print(f"index: {(time() - start) * 1000:.2f}ms to build")
+        per_keystroke("index", lambda prefix: complete_require(
+            uri, prefix, index))
+
+        def polling(prefix):
+            index.poll()
+            complete_require(uri, prefix, index)
+        index.poll_interval = 0
+        per_keystroke("index, polling each time", polling)
+
+
+def bench_module_cache(file_paths):
+    """Time for loading the modules, as done on start-up"""
+    def timed(label, load):
+        start = time()
+        load(lt.GlobalEnv())
+        print(f"{label}: {time() - start:.3f}s")
+
+    def sequential(g_env):
+        for file_path in file_paths:
+            build_lua_doc.read_file(file_path, g_env)
+
+    print(f"Loading {len(file_paths)} modules")
+    timed("no cache", sequential)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ModuleCache(cache_dir)
+        timed("cold cache", lambda g_env: load_modules(
+            file_paths, g_env, NullLog(), cache))
+        timed("warm cache", lambda g_env: load_modules(
+            file_paths, g_env, NullLog(), cache))
+
+
+def bench_load_workers(num_modules, num_lines, worker_counts):
+    """Time for loading the modules on different numbers of worker
+    processes, without the module cache.
+
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_paths = []
+        for n in range(num_modules):
+            file_path = os.path.join(directory, f"module_{n}.lua")
+            with open(file_path, "w") as f:
+                f.write(synthetic_lua(num_lines).replace(
+                    "function f", f"function m{n}_f"))
+            file_paths.append(file_path)
+
+        print(f"Loading {num_modules} modules of {num_lines} lines"
+              f" ({os.cpu_count()} CPUs)")
+        base = None
+        for workers in worker_counts:
+            start = time()
+            load_modules(file_paths, lt.GlobalEnv(), NullLog(),
+                         workers=workers)
+            elapsed = time() - start
+            if base is None:
+                base = elapsed
+            print(f"{workers} workers: {elapsed:.3f}s,"
+                  f" speedup {base / elapsed:.2f}")
+
+
+def bench_incremental_tokenize(file_path):
+    """Re-tokenize after inserting a single character at the start,
+    middle and end of the file, compared with tokenizing all of it.
+
+    """
+    text = read_file(file_path)
+    print(file_path)
+    for label, offset in (("start", 0),
+                          ("middle", text.index("\n", len(text) // 2)),
+                          ("end", len(text))):
+        tokenizer = IncrementalTokenizer(text)
+        start = time()
+        tokenizer.edit(offset, offset, " ")
+        incremental = time() - start
+
+        start = time()
+        tokenize(tokenizer.text)
+        full = time() - start
+        assert tokenizer.tokens == tokenize(tokenizer.text)[0]
+        print(f"{label}: incremental {incremental * 1000:.2f}ms, "
+              f"full {full * 1000:.2f}ms "
+              f"({full / incremental:.0f}x)")
+
+
+def run_tokenize():
     print("Measure time for tokenizing")
     bench_tokenize("test/workspace/main.lua")  # tiny
     bench_tokenize("test/testdata/big_file.lua")  # big
 
+
+def run_token_memory():
+    print("Measure memory for tokens")
+    bench_token_memory("test/testdata/big_file.lua")
+
+
+def run_model_memory():
+    print("Measure memory for the parsed scopes and globals")
+    bench_model_memory("test/testdata/big_file.lua",
+                       read_file("test/testdata/big_file.lua"))
+    bench_model_memory("synthetic", synthetic_lua(20000))
+
+
+def run_incremental_tokenize():
+    print("Measure time for re-tokenizing after a one character edit")
+    bench_incremental_tokenize("test/testdata/big_file.lua")
+
+
+def run_build_lua_doc():
     print("Measure time for finding scopes")
     bench_build_lua_doc("test/workspace/main.lua")  # tiny
     bench_build_lua_doc("test/testdata/big_file.lua")  # big
+
+
+def run_streaming():
+    print("Measure streaming tokens to the parser")
+    bench_streaming(100000)
+
+
+def run_scope_at():
+    print("Measure time for finding the scope at positions")
+    bench_scope_at("test/testdata/big_file.lua", 10000)
+
+
+def run_complete_single():
+    print("Measure completion of global names")
+    bench_complete_single(50000, 100)
+
+
+def run_fuzzy_completion():
+    print("Measure fuzzy completion")
+    bench_fuzzy_completion(
+        "test/testdata/big_file.lua", ["", "L", "Ja", "lakr"], 100)
+
+
+def run_completion_cache():
+    print("Measure completion while typing a word")
+    bench_completion_cache(20000, "field")
+
+
+def run_require_completion():
+    print("Measure completion in require()")
+    bench_require_completion(20000, "mod_19")
+
+
+def run_module_cache():
+    print("Measure start-up time with the module cache")
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic = os.path.join(directory, "synthetic.lua")
+        with open(synthetic, "w") as f:
+            f.write(synthetic_lua(20000))
+        bench_module_cache(["test/testdata/big_file.lua", synthetic])
+
+
+def run_load_workers():
+    print("Measure start-up time with parallel module loading")
+    bench_load_workers(8, 20000, [1, 2, 4, 8])
+
+
+def run_document_edits():
+    print("Measure document edits")
+    bench_document_edits("test/testdata/big_file.lua")
+
+
+def run_comment_docs():
+    print("Measure reading a file with comments and using them")
+    bench_comment_docs("test/testdata/big_file.lua")
+
+
+def run_resumed_parse():
+    print("Measure parsing again after an edit near the end")
+    bench_resumed_parse("test/testdata/big_file.lua")
+
+
+def run_recovery():
+    print("Measure what is read from files with errors")
+    invalid = sorted(glob.glob("test/testdata/invalid/*.lua"))
+    bench_recovery("test/testdata/invalid", [read_file(p) for p in invalid])
+
+    # The other files with a typo in the middle, as when editing
+    texts = []
+    for file_path in sorted(glob.glob("test/testdata/*.lua")):
+        lines = read_file(file_path).split("\n")
+        middle = len(lines) // 2
+        texts.append("\n".join(lines[:middle] + ["x = = 1"] + lines[middle:]))
+    bench_recovery("test/testdata with a typo", texts)
+
+
+def run_first_completion():
+    print("Measure the time to the first completion after opening")
+    bench_first_completion("test/testdata/big_file.lua",
+                           read_file("test/testdata/big_file.lua"))
+    block = """function f{n}(a, b)
+  local x = {n}
+  local y = x
+  local t = {{ n = {n} }}
+  x = y
+  print(x, t)
+  return x
+end
+"""
+    text = "".join(block.format(n=n) for n in range(2500))
+    bench_first_completion("functions with bodies", text)
+
+
+def run_framing():
+    print("Measure LSP message framing throughput")
+    bench_framing_small()
+    bench_framing_large()
+
+
+def run_keystroke_storm():
+    print("Measure time for typing into a document")
+    bench_keystroke_storm("test/testdata/big_file.lua", 50)
+
+
+BENCHMARKS = {
+    "tokenize": run_tokenize,
+    "incremental_tokenize": run_incremental_tokenize,
+    "token_memory": run_token_memory,
+    "model_memory": run_model_memory,
+    "build_lua_doc": run_build_lua_doc,
+    "streaming": run_streaming,
+    "scope_at": run_scope_at,
+    "complete_single": run_complete_single,
+    "fuzzy_completion": run_fuzzy_completion,
+    "completion_cache": run_completion_cache,
+    "require_completion": run_require_completion,
+    "module_cache": run_module_cache,
+    "load_workers": run_load_workers,
+    "document_edits": run_document_edits,
+    "comment_docs": run_comment_docs,
+    "resumed_parse": run_resumed_parse,
+    "first_completion": run_first_completion,
+    "recovery": run_recovery,
+    "framing": run_framing,
+    "keystroke_storm": run_keystroke_storm,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -1,4 +1,5 @@
 from lua.annotations import parse_comment, strip_prefix, strip_annotations
+from lua.lua_types import Arg, Comment, Function, Number
 
 
 COMMENT_1 = """-- Hello
@@ -96,10 +97,34 @@ def test_strip_annotations(print_env):
     assert c == "Hello"
 
 
+def test_function_doc(print_env):
+    _title(print_env, "test_function_doc")
+    comment = Comment(COMMENT_1)
+    f = Function(name="f", args=[Arg("Arg1"), Arg("Arg3"), Arg("Other")],
+                 doc=comment)
+
+    # The annotations are parsed when first needed
+    assert comment._annotations is None
+    f.add_returns([Number(1, None)])
+    assert comment._annotations is not None
+    if print_env:
+        print(f.signature_str())
+    assert [arg.lua_type for arg in f.args] == [
+        "FirstType", "ThirdType", None]
+    assert f.returns == ["integer", "Some.Other.Type"]
+    assert f.get_doc().startswith("Hello\n\n**Parameter notes**")
+
+    f = Function(name="g", args=[])
+    f.add_returns([Number(1, None)])
+    assert len(f.returns) == 1
+    _end(print_env)
+
+
 def run(print_env):
     test_strip_prefix(print_env)
     test_parse_comment(print_env)
     test_strip_annotations(print_env)
+    test_function_doc(print_env)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import time
+
+from lsp.lsp_defs import ErrorCodes
+from lsp.log import NullLog
+from lsp.parser import FrameReader
+from lsp.util import make_request, make_notification
+from lsp_server.lsp_async_server import AsyncServer
+
+
+class SlowDB:
+    """Stand-in for LuaDB with a slow didOpen"""
+    def __init__(self):
+        self.opened = []
+
+    def get_capabilities(self):
+        return {}
+
+    def didOpen(self, doc):
+        time.sleep(0.2)
+        self.opened.append(doc.uri)
+
+    def didChange(self, doc, changes):
+        pass
+
+    def get_PublishDiagnosticsParams(self, doc):
+        return None
+
+    def completions(self, doc, position):
+        return []
+
+
+def position_params(uri):
+    return {"textDocument": {"uri": uri},
+            "position": {"line": 0, "character": 0}}
+
+
+def serve(messages):
+    """Run an AsyncServer on the messages and return the responses
+    keyed by request id.
+
+    """
+    messages = list(messages)
+    messages.reverse()
+
+    def read_message():
+        if len(messages) == 0:
+            return None
+        return json.loads(messages.pop())
+
+    output = []
+    server = AsyncServer(SlowDB(), read_message, output.append, NullLog())
+    asyncio.run(server.serve())
+
+    reader = FrameReader(iter([b"".join(output), b""]).__next__)
+    responses = {}
+    for _, content in reader:
+        response = json.loads(content.decode("utf-8"))
+        if "id" in response:
+            responses[response["id"]] = response
+    return server.lsp_state, responses
+
+
+def test_cancel_queued(print_env):
+    uri = "file:///a.lua"
+    lsp_state, responses = serve([
+        make_notification("textDocument/didOpen", {
+            "textDocument": {"uri": uri, "text": "x = 1"}}),
+        make_request(1, "textDocument/completion", position_params(uri)),
+        make_notification("$/cancelRequest", {"id": 1}),
+        make_request(2, "textDocument/completion", position_params(uri)),
+        make_request(3, "shutdown", None),
+        make_notification("exit", None)])
+
+    assert responses[1]["error"]["code"] == ErrorCodes.RequestCancelled
+    assert responses[2]["result"] == []
+    assert responses[3]["result"] is None
+    assert lsp_state.shutdown and lsp_state.exit
+
+
+def test_stale_after_change(print_env):
+    uri = "file:///a.lua"
+    lsp_state, responses = serve([
+        make_notification("textDocument/didOpen", {
+            "textDocument": {"uri": uri, "text": "x = 1"}}),
+        make_request(1, "textDocument/hover", position_params(uri)),
+        make_notification("textDocument/didChange", {
+            "textDocument": {"uri": "file:///other.lua", "version": 1},
+            "contentChanges": []}),
+        make_request(2, "textDocument/completion", position_params(uri)),
+        make_notification("textDocument/didChange", {
+            "textDocument": {"uri": uri, "version": 1},
+            "contentChanges": []}),
+        make_request(3, "shutdown", None),
+        make_notification("exit", None)])
+
+    assert responses[1]["error"]["code"] == ErrorCodes.ContentModified
+    assert responses[2]["error"]["code"] == ErrorCodes.ContentModified
+    assert lsp_state.exit
+
+
+def test_closed_input(print_env):
+    lsp_state, responses = serve([
+        make_request(1, "shutdown", None)])
+    assert responses[1]["result"] is None
+    assert not lsp_state.exit
+
+
+def test_malformed_input(print_env):
+    """A message that can't be read ends serve, after the earlier
+    messages
+
+    """
+    lsp_state, responses = serve([
+        make_request(1, "shutdown", None),
+        "{"])
+    assert responses[1]["result"] is None
+    assert not lsp_state.exit
+
+
+def run(print_env):
+    test_cancel_queued(print_env)
+    test_stale_after_change(print_env)
+    test_closed_input(print_env)
+    test_malformed_input(print_env)
+
+
+if __name__ == '__main__':
+    run(print_env=True)
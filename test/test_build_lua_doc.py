@@ -1,5 +1,11 @@
+import glob
+import random
+
 import lua.build_lua_doc as build_lua_doc
 import lua.lua_types as lt
+from lsp.lsp_defs import Position
+from lua.lua_doc import LuaDoc, EMPTY_ENV
+from lua.tokenize import IncrementalTokenizer, tokenize
 
 
 def check_for_file(print_env, file_path, check):
@@ -159,6 +165,42 @@ def test_scope(print_env):
     check_for_file(print_env, "test/testdata/scope.lua", check)
 
 
+def test_scope_at(print_env):
+    text = "\n".join([
+        "function f(a) local x = 1 end local y = 2",
+        "g = function()",
+        "  local z = 3 end"])
+    doc = build_lua_doc.read_lua(text, lt.GlobalEnv())
+
+    def name_at(line, character):
+        return doc.scope_at(Position(line, character)).scopeName
+
+    assert name_at(0, 0) == "outer"
+    assert name_at(0, 12) == "outer"  # Before ")"
+    assert name_at(0, 13) == "f"
+    assert name_at(0, 28) == "f"  # Within "end"
+    assert name_at(0, 29) == "outer"  # After "end"
+    assert name_at(1, 14) == "anonymous at 1:4"
+    assert name_at(2, 16) == "anonymous at 1:4"
+    assert name_at(2, 17) == "outer"
+    assert name_at(3, 0) == "outer"
+    assert doc.scope_at(Position(4, 0)) is EMPTY_ENV
+
+    # Line ranges only, the narrowest range containing the line
+    outer = lt.LocalEnv(None, scopeName="outer")
+    a = outer.push_new(scopeName="a")
+    b = a.push_new(scopeName="b")
+    c = outer.push_new(scopeName="c")
+    doc = LuaDoc([(range(2, 4), b),
+                  (range(1, 5), a),
+                  (range(5, 6), c),
+                  (range(0, 8), outer)])
+    expected = ["outer", "a", "b", "b", "a", "c", "outer", "outer"]
+    for line, name in enumerate(expected):
+        assert name_at(line, 3) == name
+    assert doc.scope_at(Position(8, 0)) is EMPTY_ENV
+
+
 def test_call(print_env):
     def check_f1_scope(ranged_scope):
         r, scope = ranged_scope
@@ -285,9 +327,221 @@ def test_build_lua_doc(print_env):
     test_mega(print_env)
 
 
+def describe_doc(doc, g_env):
+    """Comparable description of the scopes, errors and globals"""
+    return (
+        [(r, scope.scopeName, scope.pretty_str(indent=0))
+         for r, scope in doc.scopes],
+        [(type(e), e.get_message(), e.line_num, e.char_num)
+         for e in doc.errors],
+        sorted((key, type(g_env[key]).__name__) for key in g_env))
+
+
+def test_streaming(print_env):
+    paths = (glob.glob("test/testdata/*.lua")
+             + glob.glob("test/testdata/invalid/*.lua"))
+    for file_path in sorted(paths):
+        if "big_file" in file_path:
+            continue
+        with open(file_path, "r") as f:
+            text = f.read()
+        g_env = lt.GlobalEnv()
+        doc = build_lua_doc.read_lua(text, g_env, file_path, recover=False)
+        streamed_g_env = lt.GlobalEnv()
+        streamed = build_lua_doc.read_lua_streaming(
+            text, streamed_g_env, file_path)
+        assert (describe_doc(doc, g_env)
+                == describe_doc(streamed, streamed_g_env)), file_path
+
+    # Unexpected character, after a parse error
+    text = "x = = 1\ny = 2 !"
+    doc = build_lua_doc.read_lua_streaming(text, lt.GlobalEnv())
+    assert len(doc.errors) == 2
+    assert doc.errors[1].get_message() == ' Unexpected "!"'
+
+
+def globals_str(g_env):
+    return [(key, lt._pretty_str(g_env[key], 0))
+            for key in g_env if key != "_G"]
+
+
+def probe(doc, positions):
+    """The names in scope at the positions, which parses the lazy
+    function bodies there
+
+    """
+    try:
+        return [sorted(doc.scope_at(pos).recursive_names())
+                for pos in positions]
+    except Exception:
+        # Not handled by the parser
+        return None
+
+
+def check_resume(print_env, lazy):
+    snippets = ["", "x", "\n", "end", "=", " = 1", "local y = 2\n",
+                "function f(a) return a end\n", "t = {}\n", "t.a = 1\n",
+                "function t.g() g_in_t = 1 end\n", "-- c\n", '"',
+                "_G.z = 3\n"]
+    rnd = random.Random(4)
+    paths = (glob.glob("test/testdata/*.lua")
+             + glob.glob("test/testdata/invalid/*.lua"))
+    for file_path in sorted(paths):
+        if "big_file" in file_path:
+            continue
+        with open(file_path, "r") as f:
+            text = f.read()
+        tokenizer = IncrementalTokenizer(text)
+        g_env = lt.GlobalEnv()
+        state = None
+        for n in range(20):
+            start = rnd.randint(0, len(tokenizer.text))
+            end = min(len(tokenizer.text), start + rnd.randint(0, 10))
+            tokenizer.edit(start, end, rnd.choice(snippets))
+            full_g_env = lt.GlobalEnv()
+            tokens, token_errors = tokenize(tokenizer.text)
+            try:
+                full, _ = build_lua_doc.read_lua_tokens_resumable(
+                    tokens, token_errors, full_g_env, lazy=lazy)
+            except Exception:
+                full = None
+
+            try:
+                doc, state = build_lua_doc.read_lua_tokens_resumable(
+                    tokenizer.tokens, tokenizer.errors, g_env, None,
+                    state, tokenizer.first_changed, lazy)
+            except Exception:
+                # Some invalid code isn't handled by the parser, after
+                # which the state can't be used
+                assert full is None, file_path
+                g_env = lt.GlobalEnv()
+                state = None
+                continue
+            finally:
+                tokenizer.clear_changes()
+
+            # Parses some of the lazy bodies, which is undone when
+            # resuming after the next edit
+            num_lines = tokenizer.text.count("\n") + 1
+            positions = [Position(rnd.randrange(num_lines), rnd.randint(0, 30))
+                         for n in range(10)]
+            names = probe(doc, positions)
+            assert probe(full, positions) == names
+            if names is None:
+                g_env = lt.GlobalEnv()
+                state = None
+                continue
+
+            assert (describe_doc(doc, g_env)
+                    == describe_doc(full, full_g_env)), file_path
+            assert doc.spans == full.spans
+            assert globals_str(g_env) == globals_str(full_g_env)
+
+
+def test_resume(print_env):
+    """Parsing resumed after edits gives the same as parsing it all"""
+    check_resume(print_env, lazy=False)
+    check_resume(print_env, lazy=True)
+
+    # Only the statements from the one before an edit are parsed again
+    text = "".join(f"local v{n} = {n}\n" for n in range(1000))
+    tokenizer = IncrementalTokenizer(text)
+    doc, state = build_lua_doc.read_lua_tokens_resumable(
+        tokenizer.tokens, tokenizer.errors, lt.GlobalEnv())
+    tokenizer.clear_changes()
+    offset = text.index("local v990")
+    tokenizer.edit(offset, offset, "function late() end\n")
+    doc, state = build_lua_doc.read_lua_tokens_resumable(
+        tokenizer.tokens, tokenizer.errors, state.g_env, None,
+        state, tokenizer.first_changed)
+    if print_env:
+        print(f"resumed at token {state.start} of {len(tokenizer.tokens)}")
+    assert state.start == 989 * 4
+    assert get_scope("late", doc.scopes) is not None
+
+
+def test_lazy_bodies(print_env):
+    """Lazily parsed function bodies give the same scopes as parsing
+    all of them, for files without errors
+
+    """
+    for file_path in sorted(glob.glob("test/testdata/*.lua")):
+        with open(file_path, "r") as f:
+            text = f.read()
+        eager = build_lua_doc.read_lua(text, lt.GlobalEnv())
+        if len(eager.errors) != 0 or "big_file" in file_path:
+            continue
+        tokens, token_errors = tokenize(text)
+        lazy, state = build_lua_doc.read_lua_tokens_resumable(
+            tokens, token_errors, lt.GlobalEnv(), lazy=True)
+        num_functions = len(eager.scopes) - 1
+        assert len(lazy.lazy_bodies) == len(state.lazy_bodies)
+        positions = [Position(*start) for start, end in eager.spans]
+        positions += [Position(line, 0) for line in range(len(
+            text.split("\n")))]
+        for pos in positions:
+            assert (sorted(eager.scope_at(pos).recursive_names())
+                    == sorted(lazy.scope_at(pos).recursive_names())), (
+                        file_path, pos)
+        assert sorted(lazy.spans) == sorted(eager.spans)
+        if print_env:
+            print(f"{file_path}: {num_functions} functions,"
+                  f" {lazy.num_parsed_bodies} bodies parsed")
+
+    # Only the body containing the position is parsed
+    text = "function f()\n  local in_f = 1\n  function g() end\nend\n"
+    tokens, token_errors = tokenize(text)
+    g_env = lt.GlobalEnv()
+    lazy, _ = build_lua_doc.read_lua_tokens_resumable(
+        tokens, token_errors, g_env, lazy=True)
+    assert len(lazy.scopes) == 2
+    assert lazy.scope_at(Position(1, 0)).has("in_f", recursive=False)
+    assert lazy.num_parsed_bodies == 1
+    assert get_scope("g", lazy.scopes) is not None
+    assert isinstance(lazy.scope_at(Position(2, 14)), lt.LocalEnv)
+    assert lazy.num_parsed_bodies == 2
+
+
+def test_recovery(print_env):
+    """Statements with errors are skipped, and parsing continues"""
+    text = """local a = 1
+function f(x)
+  local inner = 2
+  if x then
+    local hidden = 3
+  end
+  local after = 4
+end
+b = = 2
+function g() end
+function h()
+  local y = 1
+"""
+    g_env = lt.GlobalEnv()
+    doc = build_lua_doc.read_lua(text, g_env)
+    if print_env:
+        for e in doc.errors:
+            print(e.get_message(), e.line_num, e.char_num)
+    assert [e.line_num for e in doc.errors] == [3, 8, 11]
+    assert [(scope.scopeName, sorted(scope.names))
+            for _, scope in doc.scopes] == [
+        ("f", ["after", "inner"]), ("g", []), ("h", ["y"]), ("outer", ["a"])]
+    # The function missing its end extends to the end of the file
+    assert doc.spans[2] == ((10, 12), (12, 0))
+    assert g_env.get("g") is not None
+
+    doc = build_lua_doc.read_lua(text, lt.GlobalEnv(), recover=False)
+    assert len(doc.errors) == 1
+
+
 def run(print_env):
     test_build_lua_doc(print_env)
     test_scope(print_env)
+    test_scope_at(print_env)
+    test_streaming(print_env)
+    test_resume(print_env)
+    test_lazy_bodies(print_env)
+    test_recovery(print_env)
 
 
 if __name__ == '__main__':
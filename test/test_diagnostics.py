@@ -0,0 +1,115 @@
+import threading
+import time
+
+from lsp.lsp_defs import (
+    Diagnostic,
+    Position,
+    PublishDiagnosticsParams,
+    Range,
+    TextDocumentContentChangeEvent,
+)
+from lsp.log import NullLog
+from lsp_server.diagnostics import DiagnosticsScheduler
+from lsp_server.doc import Document
+
+
+class FakeDB:
+    """Returns one diagnostic per line in the document"""
+    def __init__(self):
+        self.num_computed = 0
+
+    def get_PublishDiagnosticsParams(self, doc):
+        self.num_computed += 1
+        pos = Position(0, 0)
+        return PublishDiagnosticsParams(
+            uri=doc.uri,
+            version=doc.version,
+            diagnostics=[Diagnostic(Range(pos, pos), line)
+                         for line in doc.lines])
+
+
+def create_scheduler(quiet_period):
+    db = FakeDB()
+    published = []
+    scheduler = DiagnosticsScheduler(
+        db.get_PublishDiagnosticsParams,
+        published.append,
+        quiet_period,
+        threading.RLock(),
+        NullLog())
+    return db, scheduler, published
+
+
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out"
+        time.sleep(0.01)
+
+
+def test_debounce(print_env):
+    db, scheduler, published = create_scheduler(quiet_period=0.05)
+    doc = Document("file:///a.lua", "x = 1")
+    for i in range(20):
+        scheduler.schedule(doc)
+
+    wait_for(lambda: len(published) == 1)
+    assert db.num_computed == 1
+    assert published[0]["method"] == "textDocument/publishDiagnostics"
+    scheduler.stop()
+
+
+def test_unchanged(print_env):
+    db, scheduler, published = create_scheduler(quiet_period=10.0)
+    doc = Document("file:///a.lua", "x = 1")
+    other = Document("file:///b.lua", "y = 2")
+
+    scheduler.schedule(doc)
+    scheduler.schedule(other)
+    scheduler.flush()
+    assert len(published) == 2
+
+    # Same diagnostics, not published again
+    scheduler.schedule(doc)
+    scheduler.flush()
+    assert len(published) == 2
+    assert scheduler.num_suppressed == 1
+
+    doc.lines = ["x = 2"]
+    scheduler.schedule(doc)
+    scheduler.flush()
+    assert len(published) == 3
+
+    # Published again after being forgotten (e.g. closed)
+    scheduler.forget(other.uri)
+    assert scheduler.message(other) is not None
+    scheduler.stop()
+
+
+def test_superseded(print_env):
+    db, scheduler, published = create_scheduler(quiet_period=10.0)
+    doc = Document("file:///a.lua", "x = 1")
+    old = doc.snapshot()
+    doc.contentChanges([TextDocumentContentChangeEvent(None, "x = 2")], 1)
+    scheduler.schedule(doc.snapshot())
+
+    # The snapshot isn't changed by the edit, but is discarded
+    assert old.lines[0] == "x = 1"
+    assert scheduler.message(old) is None
+    assert scheduler.num_discarded == 1
+    assert db.num_computed == 0
+
+    scheduler.flush()
+    assert len(published) == 1
+    assert published[0]["params"]["version"] == 1
+    scheduler.stop()
+
+
+def run(print_env):
+    test_debounce(print_env)
+    test_unchanged(print_env)
+    test_superseded(print_env)
+
+
+if __name__ == '__main__':
+    run(print_env=True)
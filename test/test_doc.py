@@ -1,5 +1,20 @@
 import lsp_server.doc as doc
-from lsp.lsp_defs import Position
+from lsp.lsp_defs import (
+    Location,
+    Position,
+    Range,
+    TextDocumentContentChangeEvent,
+)
+from lsp.log import NullLog
+from lsp.util import make_notification, make_request
+from lsp_server.lsp_state import LSP_state
+from lua.load_modules import load_modules
+from lua.lua_db import LuaDB
+from lua.lua_types import GlobalEnv
+from pathlib import Path
+import json
+import random
+import tempfile
 
 text = """local util = require("util")
 local Small = require("small")
@@ -36,9 +51,208 @@ def test_doc_simple(print_env):
     assert doc.word_at("abc(123", 2) == "abc"
 
 
+def test_lines(print_env):
+    class SmallLines(doc.Lines):
+        BLOCK_SIZE = 4
+
+    rnd = random.Random(1)
+    expected = [f"line {n}" for n in range(50)]
+    lines = SmallLines(list(expected))
+    for n in range(500):
+        first = rnd.randint(0, len(expected))
+        last = rnd.randint(first, min(len(expected), first + 20))
+        new_lines = [f"new {n}.{i}" for i in range(rnd.randint(0, 20))]
+        expected[first:last] = new_lines
+        lines.replace(first, last, new_lines)
+
+        assert list(lines) == expected
+        assert len(lines) == len(expected)
+        assert [lines[i] for i in range(len(lines))] == expected
+        assert lines.text() == "\n".join(expected)
+    if print_env:
+        print(f"{len(lines)} lines in {len(lines.blocks)} blocks")
+
+
+def test_changes(print_env):
+    d = doc.Document(uri="", text=text)
+
+    def change(start, end, new_text):
+        rng = Range(Position(*start), Position(*end))
+        d.contentChanges(
+            [TextDocumentContentChangeEvent(rng, new_text)], d.version + 1)
+
+    change((0, 6), (0, 10), "tool")
+    assert d.line_n(0) == 'local tool = require("util")'
+    change((2, 0), (4, 0), "x\ny\n")
+    assert d.getText() == (
+        'local tool = require("util")\n'
+        'local Small = require("small")\n'
+        "x\ny\n"
+        "a_function(x, y)\n")
+    assert d.getText() is d.getText()  # Joined once per version
+    change((0, 0), (5, 0), "")
+    assert d.getText() == ""
+
+    # Random edits, with the text retrieved now and then
+    rnd = random.Random(2)
+    expected = d.getText()
+
+    def random_position():
+        lines = expected.split("\n")
+        line = rnd.randrange(len(lines))
+        return line, rnd.randint(0, len(lines[line]))
+
+    def offset(line, character):
+        lines = expected.split("\n")[:line]
+        return sum(len(ln) + 1 for ln in lines) + character
+
+    for n in range(300):
+        start, end = sorted([random_position(), random_position()])
+        new_text = rnd.choice(["", "x", "ab\n", "\n\n", f"line {n}\nz"])
+        change(start, end, new_text)
+        expected = (expected[:offset(*start)] + new_text
+                    + expected[offset(*end):])
+        if rnd.random() < 0.3:
+            assert d.getText() == expected
+
+
+def test_position_encoding(print_env):
+    line = "-- Å 😀 x"
+    # Character indices of Å, 😀 and x: 3, 5 and 7
+    assert [doc.to_units(line, n, "utf-16") for n in (3, 5, 7)] == [3, 5, 8]
+    assert [doc.to_units(line, n, "utf-8") for n in (3, 5, 7)] == [3, 6, 11]
+    assert [doc.from_units(line, n, "utf-16") for n in (3, 5, 6, 8)] == [
+        3, 5, 5, 7]
+    assert doc.from_units(line, 11, "utf-8") == 7
+    assert doc.from_units(line, 9, "utf-16") == 8  # End of line
+    assert doc.to_units("ascii", 3, "utf-16") == 3
+
+    assert doc.choose_position_encoding(None) == "utf-16"
+    assert doc.choose_position_encoding(["utf-8", "utf-16"]) == "utf-16"
+    assert doc.choose_position_encoding(["utf-32", "utf-16"]) == "utf-32"
+
+    def character(position):
+        return position.character
+
+    d = doc.Document("", "x = '😀' y", encoding="utf-16")
+    assert character(d.from_client(Position(0, 8))) == 7
+    assert character(d.to_client(Position(0, 7))) == 8
+    rng = Range(Position(0, 9), Position(0, 10))
+    applied = d.contentChanges(
+        [TextDocumentContentChangeEvent(rng, "z")], 1)
+    assert d.line_n(0) == "x = '😀' z"
+    assert character(applied[0].range.start) == 8
+
+
+def test_negotiation(print_env):
+    state = LSP_state(LuaDB("", GlobalEnv(), NullLog()), NullLog())
+    response = state.method(json.loads(make_request(1, "initialize", {
+        "capabilities": {"general": {"positionEncodings": ["utf-16"]}}})))
+    assert response["result"]["capabilities"]["positionEncoding"] == "utf-16"
+
+    # The diagnostic for ")" is in UTF-16 code units
+    message = state.method(json.loads(make_notification(
+        "textDocument/didOpen", {"textDocument": {
+            "uri": "file:///u.lua", "text": 'x = "\U0001F600" )\n',
+            "version": 0}})))
+    if print_env:
+        print(message)
+    diagnostic = message["params"]["diagnostics"][0]
+    assert diagnostic["range"]["start"]["character"] == 9
+
+
+def test_location_not_open(print_env):
+    with tempfile.TemporaryDirectory() as directory:
+        # A function after non-ASCII text, from a module file
+        path = Path(directory, "m.lua")
+        path.write_text('s = "\u00e5\u00e4" function f() end\n',
+                        encoding="utf-8")
+        g_env = GlobalEnv()
+        load_modules([path], g_env, NullLog())
+        state = LSP_state(LuaDB("", g_env, NullLog()), NullLog())
+        state.method(json.loads(make_request(1, "initialize", {
+            "capabilities": {"general": {"positionEncodings": ["utf-8"]}}})))
+        state.method(json.loads(make_notification(
+            "textDocument/didOpen", {"textDocument": {
+                "uri": "file:///u.lua", "text": "f()\n", "version": 0}})))
+        response = state.method(json.loads(make_request(
+            2, "textDocument/definition", {
+                "textDocument": {"uri": "file:///u.lua"},
+                "position": {"line": 0, "character": 0}})))
+        if print_env:
+            print(response)
+        start = response["result"]["range"]["start"]
+        # Each of the two characters is two bytes in UTF-8
+        character = g_env.get("f").char_num + 2
+        assert start == {"line": 0, "character": character}
+
+    # A closed document, not on disk
+    uri = "file:///closed.lua"
+    state.method(json.loads(make_notification(
+        "textDocument/didOpen", {"textDocument": {
+            "uri": uri, "text": 'x = "\U0001F600" y = 1\n', "version": 0}})))
+    state.method(json.loads(make_notification(
+        "textDocument/didClose", {"textDocument": {"uri": uri}})))
+    rng = Range(Position(0, 9), Position(0, 10))
+    location = state._location(Location(uri, rng))
+    assert location.range.toDict() == {
+        "start": {"line": 0, "character": 12},
+        "end": {"line": 0, "character": 13}}
+
+
+def test_snapshots(print_env):
+    class SmallLines(doc.Lines):
+        BLOCK_SIZE = 4
+
+    rnd = random.Random(3)
+    expected = [f"line {n}" for n in range(50)]
+    lines = SmallLines(list(expected))
+    snapshots = []
+    for n in range(300):
+        if n % 10 == 0:
+            snapshots.append((lines.snapshot(), list(expected)))
+        first = rnd.randint(0, len(expected))
+        last = rnd.randint(first, min(len(expected), first + 3))
+        new_lines = [f"new {n}.{i}" for i in range(rnd.randint(0, 3))]
+        expected[first:last] = new_lines
+        lines.replace(first, last, new_lines)
+        if rnd.random() < 0.1:
+            expected.append("appended")
+            lines.append("appended")
+
+    assert list(lines) == expected
+    for snapshot, snapshot_lines in snapshots:
+        assert list(snapshot) == snapshot_lines
+        assert snapshot.text() == "\n".join(snapshot_lines)
+
+    # Only the changed block is copied
+    snapshot = lines.snapshot()
+    lines.replace(0, 1, ["changed"])
+    assert lines.blocks[0] is not snapshot.blocks[0]
+    assert all(a is b for a, b in zip(lines.blocks[1:], snapshot.blocks[1:]))
+
+    d = doc.Document(uri="file:///a.lua", text=text)
+    before = d.getText()
+    s = d.snapshot()
+    d.contentChanges([TextDocumentContentChangeEvent(
+        Range(Position(0, 0), Position(0, 5)), "global")], 1)
+    later = d.snapshot()
+    d.contentChanges([TextDocumentContentChangeEvent(None, "")], 2)
+    assert s.version == 0 and s.getText() == before
+    assert later.version == 1
+    assert later.getText() == "global" + before[5:]
+    assert later.line_n(0) == 'global util = require("util")'
+
+
 def run(print_env):
     test_doc_simple(print_env)
     test_Document(print_env)
+    test_lines(print_env)
+    test_changes(print_env)
+    test_snapshots(print_env)
+    test_position_encoding(print_env)
+    test_negotiation(print_env)
+    test_location_not_open(print_env)
 
 
 if __name__ == '__main__':
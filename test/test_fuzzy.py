@@ -0,0 +1,98 @@
+from lua import fuzzy
+from lua import lua_types
+from lua.lua_db import LuaDB
+from lua.cmdline import get_default_lua_server_options
+from lsp.lsp_defs import Position
+from lsp.log import NullLog
+from lsp_server.doc import Document
+
+
+def ranked(query, names, limit=10):
+    top, incomplete = fuzzy.best(fuzzy.match_names(query, names), limit)
+    return [name for _, name in top]
+
+
+def test_word_starts(print_env):
+    assert fuzzy.word_starts("get_fileName2") == [
+        True, False, False, False,
+        True, False, False, False,
+        True, False, False, False,
+        True]
+
+
+def test_matching(print_env):
+    names = ["get_file_name", "getFileName", "target", "gfx", "other"]
+    assert set(ranked("gfn", names)) == {"get_file_name", "getFileName"}
+
+    # The first character must match at a word start
+    assert ranked("arg", names) == []
+
+    # Subsequences
+    assert ranked("gtfl", names) == ["getFileName", "get_file_name"]
+    assert ranked("ther", names) == []
+    assert ranked("OTH", names) == ["other"]
+
+
+def test_ranking(print_env):
+    names = ["print_table", "pairs", "print", "xprint", "p_r_i_n_t"]
+
+    # Prefix first, shorter names first
+    assert ranked("print", names) == ["print", "print_table", "p_r_i_n_t"]
+
+    # Word starts before other matches
+    assert ranked("pt", ["print", "print_table"]) == ["print_table", "print"]
+
+
+def test_index(print_env):
+    index = fuzzy.CandidateIndex()
+    index.sync(["alpha", "beta", "alphaBeta"])
+    assert sorted(name for _, name in index.matches("b")) == [
+        "alphaBeta", "beta"]
+
+    index.sync(["beta"])
+    assert [name for _, name in index.matches("b")] == ["beta"]
+    assert [name for _, name in index.matches("a")] == []
+
+
+def test_db_completions(print_env):
+    options = get_default_lua_server_options()
+    options.fuzzy_completion = True
+    options.max_completions = 3
+
+    g_env = lua_types.GlobalEnv()
+    for n in range(5):
+        g_env[f"name_{n}"] = lua_types.Number(n, None)
+    db = LuaDB("", g_env, NullLog(), options)
+
+    doc = Document("file:///fuzzy.lua", "local nx = 1\nn")
+    db.didOpen(doc)
+    result = db.completions(doc, Position(line=1, character=1))
+    if print_env:
+        print(result.toDict())
+    assert result.isIncomplete
+    assert [item.label for item in result.items] == [
+        "nx", "name_0", "name_1"]
+    assert [item.sortText for item in result.items] == [
+        "00000", "00001", "00002"]
+
+    # Added globals are found
+    g_env["nq_added"] = lua_types.Number(0, None)
+    db.completions(doc, Position(line=1, character=1))
+    assert "nq_added" in db.fuzzy_index.candidates
+
+    options.max_completions = 100
+    result = db.completions(doc, Position(line=1, character=1))
+    assert not result.isIncomplete
+    assert len(result.items) == 7
+
+
+def run(print_env):
+    test_word_starts(print_env)
+    test_matching(print_env)
+    test_ranking(print_env)
+    test_index(print_env)
+    test_db_completions(print_env)
+
+
+if __name__ == '__main__':
+    run(print_env=True)
@@ -0,0 +1,106 @@
+from lua import build_lua_doc
+from lua.load_modules import ModuleCache, load_modules, read_module
+from lua.lua_types import GlobalEnv
+from lsp.log import NullLog
+from pathlib import Path
+import os
+import tempfile
+
+MODULES = {
+    "lib.lua": """
+lib = {}
+function lib.open(path) end
+value = 1
+""",
+    # Extends a table from lib.lua
+    "lib_ext.lua": """
+function lib.close(f) end
+""",
+    "other.lua": """
+other = { x = 1 }
+value = "redefined"
+""",
+}
+
+
+def write_modules(directory):
+    paths = []
+    for name, text in MODULES.items():
+        path = Path(directory, name)
+        path.write_text(text)
+        paths.append(path)
+    return paths
+
+
+def test_same_as_sequential(print_env):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_modules(directory)
+
+        expected = GlobalEnv()
+        for path in paths:
+            build_lua_doc.read_file(path, expected)
+
+        g_env = GlobalEnv()
+        load_modules(paths, g_env, NullLog())
+        if print_env:
+            g_env.pretty_print()
+        assert g_env.pretty_str(0) == expected.pretty_str(0)
+        assert g_env["lib"].get("close") is not None
+        assert g_env["value"].value == "redefined"
+
+
+def test_workers(print_env):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_modules(directory)
+
+        expected = GlobalEnv()
+        load_modules(paths, expected, NullLog())
+
+        cache = ModuleCache(os.path.join(directory, "cache"))
+        for n in range(2):
+            g_env = GlobalEnv()
+            load_modules(paths, g_env, NullLog(), cache, workers=2)
+            assert g_env.pretty_str(0) == expected.pretty_str(0)
+        assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_cache(print_env):
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_modules(directory)[0]
+        cache = ModuleCache(os.path.join(directory, "cache"))
+
+        def loaded():
+            g_env = GlobalEnv()
+            load_modules([path], g_env, NullLog(), cache)
+            return g_env.pretty_str(0)
+
+        cold = loaded()
+        assert (cache.hits, cache.misses, cache.errors) == (0, 1, 0)
+        assert loaded() == cold
+        assert (cache.hits, cache.misses, cache.errors) == (1, 1, 0)
+
+        # Changed module
+        path.write_text(MODULES["lib.lua"] + "\nadded = 2\n")
+        assert "added" in loaded()
+        assert cache.misses == 2
+
+        # Corrupt entries are replaced
+        for entry in os.listdir(cache.directory):
+            Path(cache.directory, entry).write_bytes(b"not a pickle")
+        assert "added" in loaded()
+        assert cache.errors == 1
+        assert "added" in loaded()
+        assert cache.hits == 2
+
+        contribution = read_module(path, cache)
+        assert len(contribution.lua_doc.scopes) != 0
+
+
+def run(print_env):
+    test_same_as_sequential(print_env)
+    test_workers(print_env)
+    test_cache(print_env)
+
+
+if __name__ == '__main__':
+    run(print_env=True)
@@ -1,12 +1,22 @@
 import lua.lua_db as lua_db
 from lua.lua_db import LuaDB
 from lua.lua_types import GlobalEnv
-from lsp.lsp_defs import CompletionItemKind, Position
+from lua.doc_cache import ClosedDoc, ClosedDocCache
+from lsp.lsp_defs import (
+    CompletionItemKind,
+    Position,
+    Range,
+    TextDocumentContentChangeEvent,
+)
+from lua.tokenize import tokenize
 from pathlib import Path
 from lua import lua_types
 from lsp_server.doc import Document
 from lsp.log import stdout_logger
+from lua.cmdline import get_default_lua_server_options
 from lua import build_lua_doc
+import gc
+import tracemalloc
 
 
 def get_workspace_dir():
@@ -168,10 +178,402 @@ t1={
     assert len(f.args) == 2
 
 
+def test_db_changes(print_env, log):
+    """Checks that the incrementally tokenized document matches the
+    changed text.
+
+    """
+    db = LuaDB("", GlobalEnv(), log)
+    doc = Document("file:///changes.lua", "local a = 1\nfunction f()\nend\n")
+    db.didOpen(doc)
+
+    def change(start, end, text):
+        changes = [TextDocumentContentChangeEvent(
+            Range(Position(*start), Position(*end)), text)]
+        doc.contentChanges(changes, doc.version + 1)
+        db.didChange(doc, changes)
+
+    change((1, 12), (1, 12), "\n  local b = 2 .. '\n")
+    change((2, 18), (2, 18), "'")
+    change((0, 6), (0, 7), "renamed")
+    change((3, 0), (4, 0), "")
+
+    lua_doc = db.get_lua_doc(doc)
+    tokenizer = db.tokenizers[doc.uri]
+    assert tokenizer.text == doc.getText()
+    assert tokenizer.tokens == tokenize(doc.getText())[0]
+    # The function missing its end extends to the end of the file
+    assert [scope.scopeName for _, scope in lua_doc.scopes] == ["f", "outer"]
+    assert lua_doc.scopes[0][1].has("b", recursive=False)
+    assert db.parse_count == 2
+
+    # A full document change resets the tokens
+    changes = [TextDocumentContentChangeEvent(None, "x = 1")]
+    doc.contentChanges(changes, doc.version + 1)
+    db.didChange(doc, changes)
+    db.get_lua_doc(doc)
+    assert tokenizer.tokens == tokenize(doc.getText())[0]
+
+
+def test_change_burst(print_env, log):
+    """A burst of changes is only parsed once, when the LuaDoc is next
+    needed, and gives the same LuaDoc as reading the changed text.
+
+    """
+    db = LuaDB("", GlobalEnv(), log)
+    doc = Document("file:///burst.lua", "local a = 1\n")
+    db.didOpen(doc)
+    assert db.parse_count == 1
+
+    for n, word in enumerate(["local", " b", " =", " a", "\nfunction",
+                              " f()", "\n  local c = b", "\nend\n"]):
+        line = len(doc.lines) - 1
+        column = len(doc.lines[line])
+        changes = [TextDocumentContentChangeEvent(
+            Range(Position(line, column), Position(line, column)), word)]
+        doc.contentChanges(changes, doc.version + 1)
+        db.didChange(doc, changes)
+    assert db.parse_count == 1
+
+    db.completions(doc, Position(4, 2))
+    assert db.parse_count == 2
+
+    g_env = GlobalEnv()
+    expected = build_lua_doc.read_lua(doc.getText(), g_env, doc.uri)
+    lua_doc = db.get_lua_doc(doc)
+    assert db.parse_count == 2
+    assert ([(r, scope.pretty_str(indent=0)) for r, scope in lua_doc.scopes]
+            == [(r, scope.pretty_str(indent=0))
+                for r, scope in expected.scopes])
+    assert lua_doc.spans == expected.spans
+    assert lua_doc.errors == expected.errors == []
+    assert db.g_env.get("f") is not None
+
+
+def test_completion_cache_tables(print_env, log):
+    """Cached completions are dropped when another document changes the
+    fields of a global table
+
+    """
+    db = LuaDB("", GlobalEnv(), log)
+    b = Document("file:///b.lua", "lib = {}\nlib.alpha = 1\nlocal y = 1\n")
+    a = Document("file:///a.lua", "x = 1\nlib.a")
+    db.didOpen(b)
+    db.didOpen(a)
+
+    def complete():
+        return sorted(item.label for item in db.completions(
+            a, Position(1, len(a.lines[1]))))
+
+    assert complete() == ["alpha"]
+    changes = [TextDocumentContentChangeEvent(
+        Range(Position(3, 0), Position(3, 0)), "lib.abc = 2\n")]
+    b.contentChanges(changes, b.version + 1)
+    db.didChange(b, changes)
+    db.get_lua_doc(b)
+    assert sorted(db.g_env["lib"]) == ["abc", "alpha"]
+
+    changes = [TextDocumentContentChangeEvent(
+        Range(Position(1, 5), Position(1, 5)), "b")]
+    a.contentChanges(changes, a.version + 1)
+    db.didChange(a, changes)
+    assert complete() == ["abc"]
+
+
+def test_complete_single(print_env, log):
+    g_env = GlobalEnv()
+    names = ["abc", "ab", "b", "abd", "a", "x_ab", "ab_"]
+    for n, name in enumerate(names):
+        g_env[name] = lua_types.Number(n, None)
+        # Query between additions, to check the incremental sort
+        assert g_env.keys_with_prefix("ab") == sorted(
+            key for key in names[:n + 1] if key.startswith("ab"))
+    assert g_env.keys_with_prefix("") == sorted(names + ["_G"])
+    assert g_env.keys_with_prefix("abz") == []
+
+    # The local shadows the global
+    l_env = lua_types.LocalEnv(None, "outer")
+    l_env.local_assign("abd", lua_types.Function(name="abd"))
+    items = lua_db.complete_single("ab", g_env, l_env)
+    assert [item.label for item in items] == ["abd", "ab", "ab_", "abc"]
+    assert items[0].kind == CompletionItemKind.Function
+
+
+def test_completion_cache(print_env, log):
+    g_env = GlobalEnv()
+    table = lua_types.Table(None)
+    for name in ("field", "fine", "other"):
+        table[name] = lua_types.Number(0, None)
+    g_env["t"] = table
+    db = LuaDB("", g_env, log)
+    doc = Document("file:///cache.lua", "x = 1\n")
+    db.didOpen(doc)
+
+    def type_text(line, character, text):
+        pos = Position(line, character)
+        changes = [TextDocumentContentChangeEvent(Range(pos, pos), text)]
+        doc.contentChanges(changes, doc.version + 1)
+        db.didChange(doc, changes)
+
+    def complete(line):
+        pos = Position(line, len(doc.lines[line]))
+        return sorted(item.label for item in db.completions(doc, pos))
+
+    type_text(1, 0, "t.f")
+    assert complete(1) == ["field", "fine"]
+    assert db.completion_cache_misses == 1
+
+    type_text(1, 3, "i")
+    assert complete(1) == ["field", "fine"]
+    type_text(1, 4, "e")
+    assert complete(1) == ["field"]
+    assert db.completion_cache_hits == 2
+    assert db.parse_count == 2  # Not re-read for cached completions
+
+    # Deleting text gives a shorter word, not cached
+    pos = Position(1, 4)
+    changes = [TextDocumentContentChangeEvent(
+        Range(pos, Position(1, 5)), "")]
+    doc.contentChanges(changes, doc.version + 1)
+    db.didChange(doc, changes)
+    assert complete(1) == ["field", "fine"]
+    assert db.completion_cache_misses == 2
+
+    # A change to another line drops the cached completions
+    type_text(0, 0, "y = 2 ")
+    type_text(1, 4, "e")
+    assert complete(1) == ["field"]
+    assert db.completion_cache_misses == 3
+
+    # So does a change to the globals
+    table["fiesta"] = lua_types.Number(0, None)
+    g_env["t"] = table
+    type_text(1, 5, "")
+    assert complete(1) == ["field", "fiesta"]
+    assert db.completion_cache_misses == 4
+
+
+def test_global_contributions(print_env, log):
+    g_env = GlobalEnv()
+    g_env["lib"] = lua_types.Number(0, None)
+
+    def value(key):
+        o = g_env.get(key)
+        return None if o is None else o.value
+
+    g_env.set_contribution("a", {"lib": lua_types.Number(1, None),
+                                 "x": lua_types.Number(1, None)})
+    g_env.set_contribution("b", {"x": lua_types.Number(2, None)})
+    assert (value("lib"), value("x")) == (1, 2)
+
+    # The last definition is used, earlier ones are restored
+    g_env.set_contribution("b", {"y": lua_types.Number(2, None)})
+    assert (value("x"), value("y")) == (1, 2)
+    g_env.release("a")
+    assert (value("lib"), value("x")) == (0, None)
+    assert g_env.keys_with_prefix("") == ["_G", "lib", "y"]
+    g_env.release("b")
+    assert len(g_env) == 2
+    assert g_env.contributions == {}
+    assert g_env.definers == {}
+    assert g_env.shadowed == {}
+
+    # Reading a document again, with its globals unchanged, doesn't
+    # change the globals
+    db = LuaDB("", g_env, log)
+    doc = Document("file:///contributions.lua",
+                   "g = 1\nlocal x = 1\nlocal y = 2\n")
+    db.didOpen(doc)
+    num_changes = g_env.num_changes
+    changes = [TextDocumentContentChangeEvent(
+        Range(Position(2, 10), Position(2, 11)), "3")]
+    doc.contentChanges(changes, doc.version + 1)
+    db.didChange(doc, changes)
+    db.get_lua_doc(doc)
+    assert db.parse_count == 2
+    assert g_env.num_changes == num_changes
+
+
+def test_edit_cycles(print_env, log):
+    """Renaming a global, and a field of a global table, in a document
+    many times doesn't grow the globals, or memory use.
+
+    """
+    g_env = GlobalEnv()
+    g_env["lib"] = lua_types.Number(0, None)
+    mylib = g_env["mylib"] = lua_types.Table(None)
+    db = LuaDB("", g_env, log)
+    doc = Document("file:///cycles.lua",
+                   "name_0 = 1 mylib.f_0 = 1\nlocal y = 2\n")
+    db.didOpen(doc)
+
+    def cycle(n):
+        changes = [TextDocumentContentChangeEvent(
+            Range(Position(0, 0), Position(0, len(doc.lines[0]))),
+            f"name_{n} = 1 mylib.f_{n} = 1")]
+        doc.contentChanges(changes, doc.version + 1)
+        db.didChange(doc, changes)
+        db.completions(doc, Position(1, 0))
+
+    tracemalloc.start()
+    try:
+        # Warm-up, for caches in the re module etc.
+        for n in range(1, 301):
+            cycle(n)
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        for n in range(301, 1301):
+            cycle(n)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    if print_env:
+        print(f"Memory before {before}, after {after}")
+    assert sorted(g_env) == ["_G", "lib", "mylib", "name_1300"]
+    assert list(mylib) == ["f_1300"]
+    # Keeping the globals from each cycle would take several hundred
+    # kB, other caches grow a little
+    assert after - before < 50000
+
+    db.didClose(doc.uri)
+    assert sorted(g_env) == ["_G", "lib", "mylib"]
+    assert len(mylib) == 0
+    assert doc.uri not in db.lua_docs
+
+    # Also when opened again, and when reopened from closed_docs, also
+    # for completion in another document
+    other = Document("file:///other.lua", "x = 1\nmylib.a")
+    db.didOpen(other)
+
+    def complete_other():
+        return [item.label for item in db.completions(other, Position(1, 7))]
+
+    for n in range(50):
+        field = f"added_{n}"
+        text = f"mylib.{field} = 1\n"
+        for reopen in range(3):
+            db.didOpen(Document(doc.uri, text))
+            assert list(mylib) == [field]
+            assert complete_other() == [field]
+            if reopen != 0:
+                db.didClose(doc.uri)
+                assert len(mylib) == 0
+                assert complete_other() == []
+    assert db.closed_docs.hits == 50
+
+
+def test_closed_docs(print_env, log):
+    db = LuaDB("", GlobalEnv(), log)
+    text = "g = 1\nlocal x = 2\n"
+    doc = Document("file:///closed.lua", text)
+    db.didOpen(doc)
+    db.didClose(doc.uri)
+    assert db.g_env.get("g") is None
+    assert len(db.closed_docs) == 1
+
+    # Reopened without reading it again
+    doc = Document("file:///closed.lua", text)
+    db.didOpen(doc)
+    assert db.parse_count == 1
+    assert db.g_env.get("g") is not None
+    assert db.get_local_env(doc, Position(1, 0)).has("x", recursive=False)
+    assert len(db.closed_docs) == 0
+
+    # Changed since closed
+    db.didClose(doc.uri)
+    db.didOpen(Document("file:///closed.lua", "h = 1\n"))
+    assert db.parse_count == 2
+    assert db.g_env.get("g") is None
+    assert db.get_stats()["closed_docs"] == {
+        "docs": 0, "bytes": 0, "hits": 1, "misses": 2, "evictions": 0}
+
+    # The least recently closed documents are evicted
+    cache = ClosedDocCache(max_bytes=1500)
+    for n in range(3):
+        doc = Document(f"file:///{n}.lua", f"x{n} = {' ' * 300}1")
+        db.didOpen(doc)
+        tokenizer = db.tokenizers[doc.uri]
+        cache.put(doc.uri, ClosedDoc(tokenizer, None, {}))
+    assert list(cache.docs) == ["file:///1.lua", "file:///2.lua"]
+    assert cache.num_bytes == sum(d.size for d in cache.docs.values())
+    assert cache.evictions == 1
+
+
+def test_resumed_parse(print_env, log):
+    """After an edit, only the statements from the one before it are
+    parsed again.
+
+    """
+    db = LuaDB("", GlobalEnv(), log)
+    text = "".join(f"local v{n} = {n}\n" for n in range(200)) + "g_old = 1\n"
+    doc = Document("file:///resumed.lua", text)
+    db.didOpen(doc)
+    full = db.parsed_tokens
+
+    changes = [TextDocumentContentChangeEvent(
+        Range(Position(200, 0), Position(200, 5)), "g_new")]
+    doc.contentChanges(changes, doc.version + 1)
+    db.didChange(doc, changes)
+    l_env = db.get_local_env(doc, Position(201, 0))
+    if print_env:
+        print(f"Parsed {full}, then {db.parsed_tokens - full} tokens")
+    assert db.parsed_tokens - full < 10
+    assert l_env.has("v0", recursive=False)
+    assert l_env.has("v199", recursive=False)
+    assert db.g_env.get("g_old") is None
+    assert db.g_env.get("g_new") is not None
+
+
+def test_lazy_bodies(print_env, log):
+    """With --lazy-function-bodies, only the function body that is
+    completed in is parsed.
+
+    """
+    options = get_default_lua_server_options()
+    options.lazy_function_bodies = True
+    db = LuaDB("", GlobalEnv(), log, options)
+    text = ("function first()\n  local inner = 1\n  g_first = 2\n  \nend\n"
+            "function second()\n  local other = 1\nend\n")
+    doc = Document("file:///lazy.lua", text)
+    db.didOpen(doc)
+    assert db.lua_docs[doc.uri].num_parsed_bodies == 0
+    assert db.g_env.get("g_first") is None
+
+    labels = [item.label for item in db.completions(doc, Position(3, 2))]
+    if print_env:
+        print(labels)
+    assert "inner" in labels
+    assert "other" not in labels
+    assert db.lua_docs[doc.uri].num_parsed_bodies == 1
+    assert db.g_env.get("g_first") is not None
+
+    # Reopened from closed_docs, before the body is parsed
+    doc = Document("file:///reopened.lua", text)
+    db.didOpen(doc)
+    db.didClose(doc.uri)
+    db.didOpen(Document(doc.uri, text))
+    assert db.closed_docs.hits == 1
+    db.completions(doc, Position(3, 2))
+    assert db.lua_docs[doc.uri].num_parsed_bodies == 1
+    assert db.g_env.contributions[doc.uri].get("g_first") is not None
+
+
 def run(print_env):
     with stdout_logger(log_level=2) as log:
         test_db_completions(print_env, log)
         test_db_misc(print_env, log)
+        test_db_changes(print_env, log)
+        test_change_burst(print_env, log)
+        test_complete_single(print_env, log)
+        test_completion_cache(print_env, log)
+        test_completion_cache_tables(print_env, log)
+        test_global_contributions(print_env, log)
+        test_edit_cycles(print_env, log)
+        test_closed_docs(print_env, log)
+        test_resumed_parse(print_env, log)
+        test_lazy_bodies(print_env, log)
 
 
 if __name__ == '__main__':
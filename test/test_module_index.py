@@ -0,0 +1,143 @@
+from lua.module_index import ModuleIndex, PathTemplate
+from lua.lua_db import LuaDB
+from lua.cmdline import get_default_lua_server_options
+from lua import lua_types
+from lsp.lsp_defs import (
+    DidChangeWatchedFilesParams,
+    FileChangeType,
+    FileEvent,
+    Position,
+)
+from lsp.log import NullLog
+from lsp_server.doc import Document
+from pathlib import Path
+import os
+import tempfile
+
+
+def write(root, relative_path):
+    path = Path(root, relative_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("")
+    return path
+
+
+def test_template(print_env):
+    t = PathTemplate("c:/lib/?.lua")
+    assert t.directory == "c:/lib/"
+    assert t.module_name("socket.lua") == "socket"
+    assert t.module_name("socket/http.lua") == "socket.http"
+    assert t.module_name("socket.txt") is None
+    assert t.module_name("x.y.lua") is None
+
+    t = PathTemplate("c:/lib/?/init.lua")
+    assert t.module_name("socket/init.lua") == "socket"
+    assert t.module_name("init.lua") is None
+
+    t = PathTemplate("lib_?.lua")
+    assert t.directory == "."
+    assert t.module_name("lib_x.lua") == "x"
+
+    t = PathTemplate("c:/lib/?/?.lua")
+    assert t.module_name("a/a.lua") == "a"
+    assert t.module_name("a/b.lua") is None
+
+
+def test_index(print_env):
+    with tempfile.TemporaryDirectory() as root:
+        for f in ["alpha.lua", "alpine/init.lua", "alpine/peak.lua",
+                  "beta.lua", "notes.txt", ".hidden/alps.lua"]:
+            write(root, f)
+        lua_path = f"{root}/?.lua;{root}/?/init.lua"
+
+        index = ModuleIndex(lua_path)
+        names = list(index.names_with_prefix("alp"))
+        if print_env:
+            print(names)
+        # alpine/init.lua is found both as alpine and alpine.init
+        assert names == ["alpha", "alpine", "alpine.init", "alpine.peak"]
+        assert list(index.names_with_prefix("b")) == ["beta"]
+
+        index.created(write(root, "alps.lua"))
+        index.deleted(Path(root, "alpha.lua"))
+        assert list(index.names_with_prefix("alp")) == [
+            "alpine", "alpine.init", "alpine.peak", "alps"]
+
+        index.deleted(Path(root, "alpine"))
+        assert list(index.names_with_prefix("alp")) == ["alps"]
+
+        write(root, "new/init.lua")
+        index.created(Path(root, "new"))
+        assert list(index.names_with_prefix("n")) == ["new", "new.init"]
+
+
+def test_poll(print_env):
+    with tempfile.TemporaryDirectory() as root:
+        write(root, "first.lua")
+        index = ModuleIndex(f"{root}/?.lua", poll_interval=0)
+        assert index.num_scans == 1
+
+        # Nothing changed
+        index.poll()
+        assert index.num_scans == 1
+
+        path = write(root, "second.lua")
+        os.utime(root, ns=(0, 0))  # The mtime could be unchanged
+        index.poll()
+        assert index.num_scans == 2
+        assert list(index.names_with_prefix("")) == ["first", "second"]
+
+        path.unlink()
+        index.poll()
+        assert list(index.names_with_prefix("")) == ["first"]
+
+        index.poll_interval = 1000
+        write(root, "third.lua")
+        index.poll()
+        assert list(index.names_with_prefix("")) == ["first"]
+
+
+def test_db_watched_files(print_env):
+    with tempfile.TemporaryDirectory() as root:
+        current = write(root, "current.lua")
+        write(root, "cursor.lua")
+        db = LuaDB(f"{root}/?.lua", lua_types.GlobalEnv(), NullLog(),
+                   get_default_lua_server_options())
+
+        doc = Document(current.as_uri(), 'require("cu')
+        db.didOpen(doc)
+
+        def labels():
+            items = db.completions(doc, Position(0, len(doc.lines[0])))
+            return [item.label for item in items]
+
+        # The current file is not completed
+        assert labels() == ["cursor"]
+
+        created = write(root, "cube.lua")
+        db.didChangeWatchedFiles(DidChangeWatchedFilesParams([
+            FileEvent(created.as_uri(), FileChangeType.Created),
+            FileEvent(Path(root, "cursor.lua").as_uri(),
+                      FileChangeType.Deleted)]))
+        assert labels() == ["cube"]
+        assert db.module_index.poll_interval is None
+        assert db.get_stats()["modules"] == 2
+
+        # File events before the index is created
+        db = LuaDB(f"{root}/?.lua", lua_types.GlobalEnv(), NullLog(),
+                   get_default_lua_server_options())
+        db.didChangeWatchedFiles(DidChangeWatchedFilesParams([]))
+        db.didOpen(doc)
+        assert labels() == ["cube", "cursor"]
+        assert db.module_index.poll_interval is None
+
+
+def run(print_env):
+    test_template(print_env)
+    test_index(print_env)
+    test_poll(print_env)
+    test_db_watched_files(print_env)
+
+
+if __name__ == '__main__':
+    run(print_env=True)
@@ -0,0 +1,81 @@
+import io
+import json
+
+from lsp.parser import FrameReader, Parser, stream_read_f
+from lsp.log import NullLog
+from lsp.util import make_header, make_notification
+
+
+def frame(method, params):
+    message = make_notification(method, params).encode("utf-8")
+    return make_header(message) + message
+
+
+def chunked_read_f(data, chunk_size):
+    """Simulates a stream that delivers at most chunk_size bytes per read"""
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    chunks.reverse()
+
+    def read():
+        return chunks.pop() if len(chunks) != 0 else b""
+    return read
+
+
+def read_all(reader):
+    return [json.loads(content.decode("utf-8")) for _, content in reader]
+
+
+def test_several_per_read(print_env):
+    data = b"".join(frame("test", {"n": n}) for n in range(10))
+    reads = []
+
+    def read_f():
+        reads.append(None)
+        return data if len(reads) == 1 else b""
+
+    messages = read_all(FrameReader(read_f))
+    assert [m["params"]["n"] for m in messages] == list(range(10))
+
+    # One read for the data, one for detecting the end
+    assert len(reads) == 2
+
+
+def test_split_messages(print_env):
+    data = b"".join(frame("test", {"text": "å" * n}) for n in range(20))
+    for chunk_size in (1, 2, 3, 7, 64):
+        messages = read_all(FrameReader(chunked_read_f(data, chunk_size)))
+        assert [m["params"]["text"] for m in messages] == [
+            "å" * n for n in range(20)]
+
+
+def test_incomplete(print_env):
+    data = frame("test", {})
+    reader = FrameReader(chunked_read_f(data[:-1], 16))
+    assert reader.read() is None
+
+
+def test_read_response(print_env):
+    stream = io.BytesIO(frame("first", None) + frame("second", None))
+    p = Parser(NullLog())
+    assert p.read_response(stream)["method"] == "first"
+    assert p.read_response(stream)["method"] == "second"
+
+
+def test_stream_read_f(print_env):
+    stream = io.BytesIO(b"abc")
+    read = stream_read_f(stream, chunk_size=2)
+    assert read() == b"ab"
+    assert read() == b"c"
+    assert read() == b""
+
+
+def run(print_env):
+    test_several_per_read(print_env)
+    test_split_messages(print_env)
+    test_incomplete(print_env)
+    test_read_response(print_env)
+    test_stream_read_f(print_env)
+
+
+if __name__ == '__main__':
+    run(print_env=True)
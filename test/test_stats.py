@@ -0,0 +1,63 @@
+from lsp.db import DB
+from lsp.log import NullLog
+from lsp.stats import LatencyHistogram
+from lsp.util import make_request
+from lsp_server.lsp_state import LSP_state, STATS_METHOD
+import json
+
+
+def close_to(value, expected):
+    return abs(value - expected) <= expected * 0.1
+
+
+def test_histogram(print_env):
+    h = LatencyHistogram()
+    assert h.toDict() == {
+        "count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    # 1 to 100 ms
+    for n in range(1, 101):
+        h.add(n / 1000)
+
+    d = h.toDict()
+    if print_env:
+        print(d)
+    assert d["count"] == 100
+    assert close_to(d["p50"], 50)
+    assert close_to(d["p95"], 95)
+    assert close_to(d["p99"], 99)
+    assert d["max"] == 100
+
+
+def test_stats_request(print_env):
+    class StatsDB(DB):
+        def get_capabilities(self):
+            return {}
+
+        def get_PublishDiagnosticsParams(self, doc):
+            return None
+
+        def get_stats(self):
+            return {"some_stat": 1}
+
+    state = LSP_state(StatsDB(), NullLog())
+    for n in range(3):
+        state.method(json.loads(make_request(n, "initialize", {})))
+    state.method(json.loads(make_request(4, "unknown/method", None)))
+
+    response = state.method(json.loads(make_request(5, STATS_METHOD, None)))
+    result = response["result"]
+    if print_env:
+        print(result)
+    assert result["methods"]["initialize"]["count"] == 3
+    assert "unknown/method" not in result["methods"]
+    assert result["db"] == {"some_stat": 1}
+
+
+def run(print_env):
+    test_histogram(print_env)
+    test_stats_request(print_env)
+
+
+if __name__ == '__main__':
+    run(print_env=True)
@@ -1,4 +1,7 @@
-from lua.tokenize import tokenize, Token, TokenError
+import glob
+import random
+
+from lua.tokenize import tokenize, Token, TokenError, IncrementalTokenizer
 
 TEXT_OK = """local var = 5
 function f()
@@ -52,9 +55,53 @@ def test_tokenize_errors(print_env):
     assert error_eq(errors[0], "!", 1, 6)
     assert len(errors) == 1
 
+# Inserted text for test_incremental, chosen to start and end
+# strings, comments, lines and blocks
+SNIPPETS = [
+    "", "x", "\n", "\n\n", '"', '"a\nb"', "'", "--c", "-- comment\n",
+    "--[[", "]]", "!", "=", "==", " ", "\t", "12", "{", "}", "end",
+    "local y = 2\n", "function f()\nend\n"]
+
+
+def line_starts(text):
+    return [0] + [n + 1 for n, c in enumerate(text) if c == "\n"]
+
+
+def random_edits(text, rng, num_edits):
+    tokenizer = IncrementalTokenizer(text)
+    for i in range(num_edits):
+        start = rng.randint(0, len(tokenizer.text))
+        end = min(len(tokenizer.text), start + rng.choice([0, 0, 1, 2, 20]))
+        tokenizer.edit(start, end, rng.choice(SNIPPETS))
+
+        tokens, errors = tokenize(tokenizer.text)
+        assert tokenizer.tokens == tokens, repr(tokenizer.text)
+        assert ([(e.value, e.line, e.column) for e in tokenizer.errors]
+                == [(e.value, e.line, e.column) for e in errors])
+        assert tokenizer.line_starts == line_starts(tokenizer.text)
+
+
+def test_incremental(print_env):
+    rng = random.Random(1)
+    paths = (glob.glob("test/testdata/*.lua")
+             + glob.glob("test/testdata/invalid/*.lua"))
+    assert len(paths) > 0
+    for path in sorted(paths):
+        with open(path) as f:
+            text = f.read()
+        if len(text) > 10000:
+            # Too slow to compare with tokenizing everything
+            continue
+        if print_env:
+            print(f"Random edits: {path}")
+        for n in range(5):
+            random_edits(text, rng, 20)
+
+
 def run(print_env):
     test_tokenize_ok(print_env)
     test_tokenize_errors(print_env)
+    test_incremental(print_env)
 
 if __name__ == '__main__':
     run(True)